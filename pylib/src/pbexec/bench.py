@@ -0,0 +1,354 @@
+"""
+
+Benchmarks for the hot paths of pbexec.
+
+Each benchmark times one operation the notebook does all the time: running small and
+large cells, duplicating realistic states, cells printing a lot of output through
+wrapped_run_cell, and reading and writing .pbnb files. Cells run in plain CPython with
+the headless stand-in installed as the `pybook` module.
+
+Timing follows timeit: the number of loops is calibrated so one sample takes at least
+min_time seconds, then several samples are taken with the garbage collector disabled.
+Results are per loop. The median is the number to compare, min and stdev show how noisy
+the machine was.
+
+Results are written as JSON with sorted keys so runs on different commits can be diffed
+and compared with --compare:
+
+    python -m pbexec.bench -o new.json --compare old.json
+
+"""
+
+import argparse
+import array
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+from . import headless
+from . import notebook
+
+# Version of the JSON results layout
+FORMAT = 1
+
+# Registered benchmarks, name -> setup function returning the operation to time
+BENCHMARKS = {}
+
+def benchmark(name):
+    ''' Decorator registering setup function for benchmark called name '''
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+class Context:
+    '''
+    Shared resources of a benchmark run, cleaned up when the run ends.
+
+    '''
+    def __init__(self):
+        headless.install()
+        from . import pbexec
+        pbexec.register_pickle()
+        self.pbexec = pbexec
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.mkdtemp(prefix='pbexec_bench_')
+        self.files = []
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def open(self, name, mode):
+        f = open(os.path.join(self.directory, name), mode)
+        self.files.append(f)
+        return f
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.loop.close()
+        for name in os.listdir(self.directory):
+            os.unlink(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+def _large_cell(functions=200):
+    # Cell with many definitions and statements, like a long lecture example
+    lines = []
+    for index in range(functions):
+        lines.append(f'def f{index}(x, y=2):')
+        lines.append(f'    """ Helper number {index} """')
+        lines.append(f'    total = 0')
+        lines.append(f'    for i in range(x):')
+        lines.append(f'        total += i * y + {index}')
+        lines.append(f'    return total')
+        lines.append(f'v{index} = f{index}(3)')
+    lines.append('sum([' + ', '.join(f'v{index}' for index in range(functions)) + '])')
+    return '\n'.join(lines) + '\n'
+
+@benchmark('run_cell.small')
+def bench_run_cell_small(ctx):
+    state = {}
+    ctx.run(ctx.pbexec.run_cell('x = 1', state, func=None))
+    return lambda: ctx.run(ctx.pbexec.run_cell('y = x + 1\ny * 2', state, func=ctx.pbexec.show_value_noarrow, history=False))
+
+@benchmark('run_cell.small_uncached')
+def bench_run_cell_small_uncached(ctx):
+    state = {}
+    ctx.run(ctx.pbexec.run_cell('x = 1', state, func=None))
+    return lambda: ctx.run(ctx.pbexec.run_cell('y = x + 1\ny * 2', state, func=ctx.pbexec.show_value_noarrow, history=False, cache=False))
+
+@benchmark('run_cell.large')
+def bench_run_cell_large(ctx):
+    state = {}
+    script = _large_cell()
+    return lambda: ctx.run(ctx.pbexec.run_cell(script, state, func=ctx.pbexec.show_value_noarrow, history=False))
+
+@benchmark('run_cell.large_uncached')
+def bench_run_cell_large_uncached(ctx):
+    state = {}
+    script = _large_cell()
+    return lambda: ctx.run(ctx.pbexec.run_cell(script, state, func=ctx.pbexec.show_value_noarrow, history=False, cache=False))
+
+def _realistic_state(ctx):
+    # Typical state after a few lecture cells: modules, data, helpers and an open file
+    state = {}
+    ctx.run(ctx.pbexec.run_cell('''
+import math
+import json
+import random
+import collections
+random.seed(1)
+numbers = list(range(100000))
+words = { f'word{i}': i for i in range(10000) }
+points = [(random.random(), random.random()) for i in range(5000)]
+table = [{ 'name': f'row{i}', 'values': [i, i * 2, i * 3] } for i in range(2000)]
+counts = collections.Counter(w[:5] for w in words)
+def distance(p, q):
+    return math.hypot(p[0] - q[0], p[1] - q[1])
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+objects = [Point(x, y) for x, y in points[:1000]]
+''', state, func=None))
+    state['samples'] = array.array('d', range(100000))
+    state['raw'] = bytearray(256 * 1024)
+    state['log'] = ctx.open('log.txt', 'w')
+    state['log'].write('started\n')
+    return state
+
+@benchmark('duplicate_state.realistic')
+def bench_duplicate_state(ctx):
+    state = _realistic_state(ctx)
+    return lambda: ctx.pbexec.duplicate_state(state)
+
+@benchmark('duplicate_state.copy_on_write')
+def bench_duplicate_state_cow(ctx):
+    state = ctx.pbexec.fresh_state(copy_on_write=True)
+    for key, value in _realistic_state(ctx).items():
+        state[key] = value
+    return lambda: ctx.pbexec.duplicate_state(state)
+
+def _output_cell(ctx, output_buffer):
+    state = {}
+    script = 'for i in range(2000):\n    print("line", i)\n'
+    def step():
+        headless.reset_outputs()
+        ctx.run(ctx.pbexec.wrapped_run_cell(script, state, func=None, history=False, output_buffer=output_buffer))
+    return step
+
+@benchmark('output.print_lines')
+def bench_output(ctx):
+    return _output_cell(ctx, None)
+
+@benchmark('output.print_lines_buffered')
+def bench_output_buffered(ctx):
+    return _output_cell(ctx, True)
+
+def _notebook_pages(pages=20, cells=20):
+    result = []
+    for page in range(pages):
+        cells_of_page = [{ 'cell_type': 'markdown', 'source': f'# Page {page}\n\nSome *explanation* here.' }]
+        for cell in range(cells):
+            source = '\n'.join(f'x{line} = {page} * {cell} + {line}' for line in range(10))
+            cells_of_page.append({ 'cell_type': 'python', 'id': f'c{page}_{cell}', 'source': source })
+        result.append(cells_of_page)
+    return result
+
+@benchmark('pbnb.parse_tagged')
+def bench_parse_tagged(ctx):
+    text = notebook.unparse(_notebook_pages())
+    return lambda: notebook.parse(text)
+
+@benchmark('pbnb.parse_prefixed')
+def bench_parse_prefixed(ctx):
+    pages = _notebook_pages()
+    chunks = []
+    for page in pages:
+        cells = []
+        for cell in page:
+            if cell['cell_type'] == 'markdown':
+                cells.append('\n'.join('#m> ' + line for line in cell['source'].split('\n')))
+            else:
+                cells.append(cell['source'])
+        chunks.append('\n#---#\n'.join(cells))
+    text = '\n#---page---#\n'.join(chunks)
+    return lambda: notebook.parse(text)
+
+@benchmark('pbnb.round_trip')
+def bench_round_trip(ctx):
+    path = os.path.join(ctx.directory, 'nb.pbnb')
+    pages = _notebook_pages()
+    def step():
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(notebook.unparse(pages))
+        notebook.parse_file(path)
+    return step
+
+@benchmark('pbnb.load_page')
+def bench_load_page(ctx):
+    path = os.path.join(ctx.directory, 'nb_index.pbnb')
+    pages = _notebook_pages()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(notebook.unparse(pages))
+    index = notebook.index_path(path)
+    def step():
+        with open(path, 'rb') as f:
+            index.load_page(f, len(pages) // 2)
+    return step
+
+def measure(step, min_time=0.1, repeat=7):
+    """
+    Return timing dict for calling step, seconds are per call
+
+    Dict has 'loops' (calls per sample), 'samples' and 'min', 'median', 'mean' and
+    'stdev' of the samples.
+
+    """
+    # Warm up caches, then find number of loops taking at least min_time
+    step()
+    loops = 1
+    while True:
+        seconds = _sample(step, loops)
+        if seconds >= min_time:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(seconds, 1e-9) * 1.2))
+    samples = [_sample(step, loops) / loops for index in range(repeat)]
+    return {
+        'loops': loops,
+        'samples': len(samples),
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.fmean(samples),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+def _sample(step, loops):
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for index in range(loops):
+            step()
+        return time.perf_counter() - start
+    finally:
+        if enabled:
+            gc.enable()
+
+def run(pattern=None, min_time=0.1, repeat=7):
+    """
+    Run benchmarks whose name matches regular expression pattern, return results dict
+
+    """
+    results = {}
+    ctx = Context()
+    try:
+        # Values shown by cells go nowhere, the terminal would dominate the timings
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for name, setup in BENCHMARKS.items():
+                if pattern is not None and not re.search(pattern, name):
+                    continue
+                results[name] = measure(setup(ctx), min_time, repeat)
+    finally:
+        ctx.close()
+    return {
+        'format': FORMAT,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'min_time': min_time,
+        'repeat': repeat,
+        'benchmarks': results,
+    }
+
+def compare(old, new):
+    """
+    Return list of (name, old median, new median, ratio) for benchmarks in both results
+
+    Ratio above 1 means the new run is slower.
+
+    """
+    rows = []
+    for name in sorted(new['benchmarks']):
+        if name in old['benchmarks']:
+            before = old['benchmarks'][name]['median']
+            after = new['benchmarks'][name]['median']
+            rows.append((name, before, after, after / before))
+    return rows
+
+def _format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.3g} {unit}'
+    return f'{seconds / 1e-9:.3g} ns'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pbexec-bench', description='Benchmark pbexec hot paths')
+    parser.add_argument('-o', '--output', default=None, help='results JSON file')
+    parser.add_argument('-k', '--select', default=None, metavar='PATTERN', help='only run benchmarks whose name matches regular expression')
+    parser.add_argument('--min-time', type=float, default=0.1, help='minimum seconds per sample (default 0.1)')
+    parser.add_argument('--repeat', type=int, default=7, help='number of samples (default 7)')
+    parser.add_argument('--compare', default=None, metavar='JSON', help='earlier results to compare with')
+    parser.add_argument('--list', action='store_true', help='list benchmarks and exit')
+    args = parser.parse_args(argv)
+    if args.list:
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+    results = run(args.select, args.min_time, args.repeat)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+    if args.compare is None:
+        for name, result in results['benchmarks'].items():
+            print(f'{name:32} {_format_seconds(result["median"]):>10} +- {_format_seconds(result["stdev"])}')
+    else:
+        with open(args.compare, encoding='utf-8') as f:
+            old = json.load(f)
+        for name, before, after, ratio in compare(old, results):
+            print(f'{name:32} {_format_seconds(before):>10} -> {_format_seconds(after):>10}  {ratio:.2f}x')
+    return 0
+
+def test_bench():
+    ''' Every benchmark runs and results round trip through JSON '''
+    results = run(min_time=0.001, repeat=2)
+    assert(set(results['benchmarks']) == set(BENCHMARKS))
+    for result in results['benchmarks'].values():
+        assert(result['loops'] >= 1 and result['samples'] == 2 and 0 < result['min'] <= result['median'])
+    loaded = json.loads(json.dumps(results, sort_keys=True))
+    assert(loaded == results)
+    rows = compare(loaded, results)
+    assert(len(rows) == len(BENCHMARKS) and all(row[3] == 1 for row in rows))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""
+
+Cache of compiled cell code objects.
+
+Compiling a cell means parsing, rewriting expressions to call __expr_callback, fixing
+locations and compiling with top-level await allowed. The same cell source gets compiled
+again and again when replaying checkpoints or grading, so keep the code objects around.
+
+There are two tiers: a bounded in-memory LRU, and an optional directory of marshaled
+code objects that survives restarts of the interpreter.
+
+"""
+
+import collections
+import hashlib
+import importlib.util
+import marshal
+import os
+import tempfile
+
+class CodeCache:
+    '''
+    LRU cache of code objects keyed by cell source and compile options.
+
+    '''
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, script, *options):
+        """
+        Return cache key for script compiled with given options
+
+        Options are anything that changes the compiled code, e.g. whether expressions
+        are rewritten to call __expr_callback.
+
+        """
+        h = hashlib.sha256()
+        for option in options:
+            h.update(repr(option).encode('utf-8'))
+            h.update(b'\0')
+        h.update(script.encode('utf-8', errors='surrogatepass'))
+        return h.hexdigest()
+
+    def get(self, key):
+        ''' Return cached code object for key, or None '''
+        code = self._entries.get(key)
+        if code is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return code
+        code = self._load(key)
+        if code is not None:
+            self._remember(key, code)
+            self.disk_hits += 1
+            return code
+        self.misses += 1
+        return None
+
+    def put(self, key, code):
+        ''' Store code object for key in memory, and on disk if directory is set '''
+        self._remember(key, code)
+        self._save(key, code)
+
+    def clear(self):
+        ''' Forget everything in memory (disk tier is kept) '''
+        self._entries.clear()
+
+    def stats(self):
+        ''' Return dictionary of counters '''
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
+
+    def _remember(self, key, code):
+        self._entries[key] = code
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.code')
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        # Marshal format is specific to the interpreter version
+        magic = importlib.util.MAGIC_NUMBER
+        if data[:len(magic)] != magic:
+            return None
+        try:
+            return marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def _save(self, key, code):
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename so concurrent readers never see partial files
+            fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(importlib.util.MAGIC_NUMBER)
+                f.write(marshal.dumps(code))
+            os.replace(tmpname, self._path(key))
+        except OSError:
+            pass
+
+def with_filename(code, filename):
+    """
+    Return code object with co_filename set to filename, including nested code objects
+
+    """
+    if code.co_filename == filename:
+        return code
+    consts = tuple(with_filename(const, filename) if isinstance(const, type(code)) else const
+        for const in code.co_consts)
+    return code.replace(co_filename=filename, co_consts=consts)
+
+def test_code_cache():
+    ''' Memory and disk tiers with counters '''
+    with tempfile.TemporaryDirectory() as directory:
+        cache = CodeCache(maxsize=1, directory=directory)
+        key = cache.key('x = 1', True)
+        assert(key != cache.key('x = 1', False))
+        assert(cache.get(key) is None)
+        code = compile('def f(): pass\nx = 1', '<a>', 'exec')
+        cache.put(key, code)
+        assert(cache.get(key) is code)
+        cache.put(cache.key('y = 2', True), code)
+        # Evicted from memory, comes back from disk
+        assert(cache.get(key) == code)
+        assert(cache.stats()['hits'] == 1 and cache.stats()['disk_hits'] == 1 and cache.stats()['misses'] == 1)
+        renamed = with_filename(code, '<b>')
+        assert(renamed.co_filename == '<b>' and renamed.co_consts[0].co_filename == '<b>')
+
+if __name__ == '__main__':
+    test_code_cache()
@@ -0,0 +1,248 @@
+"""
+
+Copy-on-write states for notebook checkpoints.
+
+A CowState is a dict that can be used as globals for run_cell and duplicated without
+copying its values. Duplicated states share values with their parent. The first time a
+cell looks up a shared mutable value, the state doing the lookup gets a private copy
+(or keeps the original if no other state refers to it anymore). Names bound to the same
+value are copied together, and all copies a state makes go through one memo, so names
+and values aliasing each other in the parent still do in the copy. Rebinding or deleting
+a shared name never copies anything.
+
+Lookups are the only way for cell code to get at a value to mutate it in place, so
+copying on lookup covers both rebinding and in-place mutation of containers.
+
+"""
+
+import copy
+
+from .statecopy import INTERPRETER_KEYS, StateCopier, is_shareable
+
+class _Shared:
+    '''
+    Value shared between several states, with count of states still referring to it.
+
+    owner is the id of the state the value was shared from. uncopyable is set when the
+    owner kept the value because it could not be copied (see LazyState).
+
+    '''
+    __slots__ = ('value', 'refs', 'owner', 'uncopyable')
+    def __init__(self, value, owner=None):
+        self.value = value
+        self.refs = 0
+        self.owner = owner
+        self.uncopyable = False
+
+class CowState(dict):
+    '''
+    Dictionary of globals that shares values with states it was duplicated from.
+
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Map from key to _Shared for values not yet private to this state
+        self._shared = {}
+        # Map from id of _Shared to keys of this state bound to it. Names aliasing one
+        # value share one box, so they are copied together and stay aliased.
+        self._aliases = {}
+        # Single memo for all copies out of shared values, keeps aliasing between values
+        self._copier = StateCopier()
+
+    def duplicate(self):
+        """
+        Return new CowState sharing all values with this one
+
+        Cost is proportional to the number of keys, values are not copied.
+
+        """
+        res = self.__class__()
+        # One box per distinct value, reusing boxes still holding the value of their key
+        boxes = {}
+        for key, shared in self._shared.items():
+            if shared.value is dict.__getitem__(self, key):
+                boxes[id(shared.value)] = shared
+        for key, value in dict.items(self):
+            if key not in INTERPRETER_KEYS and not is_shareable(value):
+                shared = boxes.get(id(value))
+                if shared is None:
+                    shared = boxes[id(value)] = _Shared(value, id(self))
+                if self._shared.get(key) is not shared:
+                    self._release(key)
+                    self._bind(key, shared)
+                res._bind(key, shared)
+            dict.__setitem__(res, key, value)
+        return res
+
+    def shared_keys(self):
+        ''' Return list of keys whose values are still shared with other states '''
+        return [key for key, shared in self._shared.items() if shared.refs > 1]
+
+    def _bind(self, key, shared):
+        # Share key through box, box counts each state holding it once
+        keys = self._aliases.get(id(shared))
+        if keys is None:
+            keys = self._aliases[id(shared)] = set()
+            shared.refs += 1
+        keys.add(key)
+        self._shared[key] = shared
+
+    def _release(self, key):
+        # Stop sharing key without copying, value is being replaced or removed
+        shared = self._shared.pop(key, None)
+        if shared is not None:
+            keys = self._aliases[id(shared)]
+            keys.discard(key)
+            if not keys:
+                del self._aliases[id(shared)]
+                shared.refs -= 1
+        if not self._shared:
+            self._copier = StateCopier()
+
+    def _needs_copy(self, shared):
+        # Another state still holds the value, or this state already copied values that
+        # may be inside it and must keep referring to the copies
+        return shared.refs > 1 or bool(self._copier.memo)
+
+    def _copy_shared(self, key, shared):
+        # Return private copy of shared value first looked up as key
+        try:
+            return self._copier.copy_key(key, shared.value)
+        except Exception as err:
+            raise copy.Error(f"Could not copy value of '{key}' shared with another state") from err
+
+    def _alias(self, key, value):
+        # Value to bind to key aliasing the value just copied
+        return value
+
+    def _materialize(self, key):
+        # Make value for key and all keys aliasing it private to this state, return it
+        value = dict.__getitem__(self, key)
+        shared = self._shared.get(key)
+        if shared is None:
+            return value
+        if shared.value is not value:
+            # Rebound without going through __setitem__ (e.g. global statement in a function)
+            self._release(key)
+            return value
+        keys = self._aliases[id(shared)]
+        if self._needs_copy(shared):
+            value = self._copy_shared(key, shared)
+            for alias in keys:
+                if alias != key and dict.get(self, alias) is shared.value:
+                    dict.__setitem__(self, alias, self._alias(alias, value))
+            dict.__setitem__(self, key, value)
+        # Otherwise we are the last state holding the value, nothing needs to be copied
+        for alias in list(keys):
+            self._release(alias)
+        return value
+
+    def _materialize_all(self):
+        for key in list(self._shared):
+            self._materialize(key)
+
+    def __getitem__(self, key):
+        if key in self._shared:
+            return self._materialize(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def __setitem__(self, key, value):
+        self._release(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._release(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        if self:
+            key = next(reversed(self))
+            return key, self.pop(key)
+        return dict.popitem(self)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self._shared):
+            self._release(key)
+        dict.clear(self)
+
+    def values(self):
+        self._materialize_all()
+        return dict.values(self)
+
+    def items(self):
+        self._materialize_all()
+        return dict.items(self)
+
+    def copy(self):
+        return self.duplicate()
+
+    def __deepcopy__(self, memo):
+        return self.duplicate()
+
+    def __reduce__(self):
+        # Reading values for pickling does not mutate them, no need to materialize
+        return (self.__class__, (dict(dict.items(self)),))
+
+    def __del__(self):
+        for shared in set(self._shared.values()):
+            shared.refs -= 1
+
+async def test_cow_state():
+    ''' Check that duplicated states diverge independently '''
+    from .pbexec import run_cell
+    parent = CowState()
+    await run_cell('x = [1, 2]; y = x; n = 5', parent, func=None, write=False)
+    child = parent.duplicate()
+    assert(dict.__getitem__(child, 'x') is dict.__getitem__(parent, 'x'))
+    # History is immutable, shared without a box
+    assert(sorted(child.shared_keys()) == ['x', 'y'])
+    # In-place mutation in child copies, names aliasing the same list stay aliased
+    # even when only one of them is looked up
+    await run_cell('x.append(3)', child, func=None, write=False)
+    assert(dict.__getitem__(child, 'x') is dict.__getitem__(child, 'y') and child.shared_keys() == [])
+    await run_cell('y.append(4)', child, func=None, write=False)
+    assert(child['x'] == [1, 2, 3, 4] and child['x'] is child['y'])
+    assert(parent['x'] == [1, 2])
+    # Parent was last holder of originals, it keeps them without copying
+    assert(parent.shared_keys() == [])
+    # Rebinding does not leak between states
+    await run_cell('n = 6', child, func=None, write=False)
+    assert(parent['n'] == 5 and child['n'] == 6)
+    # Mutation in parent after duplication is not seen by child
+    second = parent.duplicate()
+    await run_cell('x.append(9)', parent, func=None, write=False)
+    assert(second['x'] == [1, 2] and parent['x'] == [1, 2, 9])
+    assert(len(parent['__history']) == 2 and len(second['__history']) == 1)
+    # Last state holding a value copies it anyway if it copied values the value refers to
+    parent = CowState({ 'a': [0], 'b': None })
+    parent['b'] = [parent['a']]
+    child = parent.duplicate()
+    parent['a'].append(1)
+    del child
+    assert(parent['b'][0] is parent['a'] and parent['a'] == [0, 1])
+
+if __name__ == '__main__':
+    import asyncio
+    asyncio.run(test_cow_state())
@@ -0,0 +1,485 @@
+"""
+
+Dependency analysis of cells for incremental re-execution.
+
+When an early cell is edited, the green bar model reruns everything after it starting
+from the last checkpoint. Most of the time the later cells do not touch the names the
+edited cell binds. analyze() looks at the AST of a cell and finds the names it reads,
+binds and imports and whether it does things that cannot be tracked by names (files,
+randomness, time, exec, ...). plan() compares the history of a state with the current
+cells of the notebook and decides which cells have to run again in that state to bring
+it up to date, or that the state has to be rebuilt because the analysis cannot be trusted.
+
+The analysis is conservative:
+
+    * Assigning to items or attributes of a name or calling a method on it counts as
+      mutating it (`x.append(1)` changes `x`), unless the name is bound by an import.
+    * Names read inside function bodies count as inputs of the cell defining the
+      function, so changing them reruns the definition and then the callers.
+    * Names a function body mutates count as bound by the cells calling the function
+      (`add(1)` changes `x` if `add` appends to `x`).
+    * Names passed to calls of anything but builtins count as mutated too, the callee
+      may change them in place (`heapq.heappush(h, 1)` or `add(x, 1)` changes `h` or `x`).
+    * Cells with side effects always rerun, cells using star imports, `global`
+      statements, exec/eval or globals() force a full rerun.
+
+"""
+
+import ast
+import builtins
+import functools
+
+# Calls of these names interact with the world outside the state
+SIDE_EFFECT_CALLS = frozenset(['open', 'input', 'exec', 'eval', 'breakpoint', '__import__'])
+# Calling anything from these modules counts as a side effect
+SIDE_EFFECT_MODULES = frozenset([
+    'os', 'sys', 'io', 'shutil', 'subprocess', 'pathlib', 'tempfile', 'glob', 'random',
+    'secrets', 'time', 'datetime', 'socket', 'urllib', 'http', 'requests', 'pyodide',
+    'js', 'pybook', 'micropip', 'asyncio', 'threading', 'multiprocessing', 'sqlite3',
+])
+# Calls of these names can bind arbitrary names in the state
+UNCERTAIN_CALLS = frozenset(['exec', 'eval', 'globals', 'locals', 'vars', '__import__'])
+# Names set by the notebook machinery, not by cells
+EXTERNAL_NAMES = frozenset(['__input'])
+IGNORED_NAMES = frozenset(['__builtins__', '__expr_callback', '__history', '__statement_timer'])
+# Builtins that never change their arguments in place
+PURE_BUILTINS = frozenset(dir(builtins)) - frozenset(['next', 'setattr', 'delattr', 'exec', 'eval', '__import__'])
+
+class CellInfo:
+    '''
+    Names a cell reads and binds, as found by analyze().
+
+    '''
+    def __init__(self):
+        # Names read before the cell binds them
+        self.reads = set()
+        # Names read inside bodies of functions the cell defines
+        self.deferred = set()
+        # Names bound or deleted at top level
+        self.binds = set()
+        # Names bound by top level statements that always run
+        self.always_binds = set()
+        # Names whose items or attributes are assigned or called, mutated in place
+        self.mutates = set()
+        # Map from name bound by import to top level module name
+        self.modules = {}
+        # Names called directly and names at the root of called attributes
+        self.calls = set()
+        # Same for calls inside each function defined at top level
+        self.function_calls = {}
+        # Global names mutated inside each function defined at top level
+        self.function_mutates = {}
+        # Map from called name (or root of called attribute) to names passed to it as
+        # arguments, calls of pure builtins left out
+        self.call_arguments = {}
+        self.side_effects = False
+        # Reason analysis cannot be trusted, or None
+        self.uncertain = None
+
+    @property
+    def imports(self):
+        return set(self.modules.values())
+
+    @property
+    def arguments(self):
+        ''' Names passed as arguments to calls that may change them in place '''
+        return set().union(*self.call_arguments.values())
+
+def _root_name(node):
+    # Return name at the root of x.a[1].b, or None
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+class _Collector(ast.NodeVisitor):
+    '''
+    Collect names loaded and stored by one top level statement.
+
+    Function bodies are collected separately into deferred, names local to them are
+    left out.
+
+    '''
+    def __init__(self, info):
+        self.info = info
+        self.loads = set()
+        self.stores = set()
+        self.mutates = set()
+        self.calls = set()
+        # Map from callee to names passed to it, see CellInfo.call_arguments
+        self.arguments = {}
+        # Names mutated inside bodies of functions defined in the statement
+        self.deferred_mutates = set()
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.loads.add(node.id)
+        else:
+            self.stores.add(node.id)
+            if isinstance(node.ctx, ast.Del):
+                # Deleting fails unless the name exists
+                self.loads.add(node.id)
+
+    def _target(self, node):
+        # Assigning to x.a or x[i] mutates x
+        if isinstance(node, (ast.Attribute, ast.Subscript)):
+            name = _root_name(node)
+            if name is not None:
+                self.mutates.add(name)
+                self.loads.add(name)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._target(node)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._target(node)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        name = _root_name(node.target)
+        if name is not None:
+            self.loads.add(name)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name):
+            name = node.func.id
+            self.calls.add(name)
+            if name in UNCERTAIN_CALLS:
+                self.info.uncertain = f'calls {name}()'
+        else:
+            name = _root_name(node.func)
+            if name is not None:
+                self.calls.add(name)
+                if isinstance(node.func, ast.Attribute):
+                    self.mutates.add(name)
+        if not (isinstance(node.func, ast.Name) and name in PURE_BUILTINS):
+            # Callee may change what it gets in place
+            for arg in node.args + [keyword.value for keyword in node.keywords]:
+                if isinstance(arg, ast.Starred):
+                    arg = arg.value
+                if isinstance(arg, ast.Name):
+                    self.arguments.setdefault(name, set()).add(arg.id)
+        self.generic_visit(node)
+
+    def arguments_passed(self):
+        return set().union(*self.arguments.values())
+
+    def _merge_arguments(self, other, local=frozenset()):
+        for name, names in other.arguments.items():
+            if names - local:
+                self.arguments.setdefault(name, set()).update(names - local)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            bound = alias.asname or alias.name.split('.')[0]
+            self.stores.add(bound)
+            self.info.modules[bound] = alias.name.split('.')[0]
+
+    def visit_ImportFrom(self, node):
+        module = (node.module or '').split('.')[0]
+        for alias in node.names:
+            if alias.name == '*':
+                self.info.uncertain = 'star import'
+                continue
+            bound = alias.asname or alias.name
+            self.stores.add(bound)
+            self.info.modules[bound] = module if node.level == 0 else ''
+
+    def visit_Global(self, node):
+        self.info.uncertain = 'global statement'
+
+    def _function(self, node, args, body):
+        # Everything outside the body is evaluated when the definition runs
+        for default in args.defaults + [default for default in args.kw_defaults if default is not None]:
+            self.visit(default)
+        for decorator in getattr(node, 'decorator_list', []):
+            self.visit(decorator)
+        inner = _Collector(self.info)
+        for statement in body if isinstance(body, list) else [body]:
+            inner.visit(statement)
+        params = set(arg.arg for arg in args.posonlyargs + args.args + args.kwonlyargs)
+        for arg in (args.vararg, args.kwarg):
+            if arg is not None:
+                params.add(arg.arg)
+        local = params | inner.stores
+        self.info.deferred |= inner.loads - local
+        # Nested functions may be called by this one, count what they mutate too
+        mutated = (inner.mutates | inner.arguments_passed() | inner.deferred_mutates) - local
+        self.deferred_mutates |= mutated
+        return inner, mutated
+
+    def visit_FunctionDef(self, node):
+        inner, mutated = self._function(node, node.args, node.body)
+        self.stores.add(node.name)
+        self.info.function_calls.setdefault(node.name, set()).update(inner.calls)
+        self.info.function_mutates.setdefault(node.name, set()).update(mutated)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        inner, mutated = self._function(node, node.args, node.body)
+        # Lambdas are usually called right away or by functions of the same cell
+        self.calls |= inner.calls
+        self.mutates |= mutated
+
+    def _comprehension(self, node, elements):
+        # Loop variables are local to the comprehension, the first iterable is not
+        self.visit(node.generators[0].iter)
+        inner = _Collector(self.info)
+        targets = _Collector(self.info)
+        for generator in node.generators:
+            targets.visit(generator.target)
+            if generator is not node.generators[0]:
+                inner.visit(generator.iter)
+            for condition in generator.ifs:
+                inner.visit(condition)
+        for element in elements:
+            inner.visit(element)
+        self.loads |= inner.loads - targets.stores
+        self.stores |= inner.stores - targets.stores
+        self.mutates |= inner.mutates - targets.stores
+        self.calls |= inner.calls - targets.stores
+        self._merge_arguments(inner, targets.stores)
+
+    def visit_ListComp(self, node):
+        self._comprehension(node, [node.elt])
+
+    visit_SetComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        self._comprehension(node, [node.key, node.value])
+
+    def visit_ClassDef(self, node):
+        # Class bodies run right away, names they store are class attributes
+        inner = _Collector(self.info)
+        for child in node.bases + node.keywords + node.decorator_list + node.body:
+            inner.visit(child)
+        self.loads |= inner.loads - inner.stores
+        self.mutates |= inner.mutates - inner.stores
+        self.calls |= inner.calls
+        self._merge_arguments(inner, inner.stores)
+        self.deferred_mutates |= inner.deferred_mutates
+        self.stores.add(node.name)
+
+# Statements whose bindings always happen when the statement runs
+_UNCONDITIONAL = (ast.Assign, ast.AnnAssign, ast.AugAssign, ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Delete)
+
+@functools.lru_cache(maxsize=1024)
+def analyze(script):
+    """
+    Analyze source of a cell, return CellInfo
+
+    Scripts with syntax errors are analyzed as binding nothing and uncertain.
+
+    """
+    info = CellInfo()
+    try:
+        tree = ast.parse(script)
+    except SyntaxError:
+        info.uncertain = 'syntax error'
+        return info
+    bound = set()
+    for statement in tree.body:
+        collector = _Collector(info)
+        collector.visit(statement)
+        info.reads |= collector.loads - bound
+        info.binds |= collector.stores
+        info.mutates |= collector.mutates
+        info.calls |= collector.calls
+        for name, names in collector.arguments.items():
+            info.call_arguments.setdefault(name, set()).update(names - IGNORED_NAMES)
+        if isinstance(statement, _UNCONDITIONAL):
+            bound |= collector.stores
+    info.always_binds = bound - IGNORED_NAMES
+    info.reads -= IGNORED_NAMES
+    info.deferred -= IGNORED_NAMES
+    info.binds -= IGNORED_NAMES
+    effectful = SIDE_EFFECT_CALLS | set(name for name, module in info.modules.items() if module in SIDE_EFFECT_MODULES)
+    if info.reads & EXTERNAL_NAMES or info.calls & effectful:
+        info.side_effects = True
+    return info
+
+def effectful_names(infos):
+    """
+    Return tuple of set of names whose calls have side effects (side effect modules,
+    builtins like open and functions calling them) and set of names bound by imports,
+    for cells with infos
+
+    """
+    modules = {}
+    for info in infos:
+        modules.update(info.modules)
+    effectful = set(SIDE_EFFECT_CALLS)
+    effectful.update(name for name, module in modules.items() if module in SIDE_EFFECT_MODULES)
+    changed = True
+    while changed:
+        changed = False
+        for info in infos:
+            for name, calls in info.function_calls.items():
+                if name not in effectful and calls & effectful:
+                    effectful.add(name)
+                    changed = True
+    return effectful, set(modules)
+
+def has_side_effects(scripts):
+    """
+    Return True if any of scripts has side effects or cannot be analyzed, counting calls
+    of functions defined in scripts that have side effects
+
+    """
+    infos = [analyze(script) for script in scripts]
+    effectful, module_names = effectful_names(infos)
+    return any(info.side_effects or info.uncertain is not None or info.calls & effectful for info in infos)
+
+def function_mutates(infos):
+    """
+    Return map from function name to global names it mutates, directly or through
+    functions it calls, for functions defined in cells with infos
+
+    """
+    calls = {}
+    mutates = {}
+    for info in infos:
+        for name, names in info.function_mutates.items():
+            mutates.setdefault(name, set()).update(names)
+            calls.setdefault(name, set()).update(info.function_calls.get(name, ()))
+    changed = True
+    while changed:
+        changed = False
+        for name, called in calls.items():
+            for other in called & mutates.keys():
+                if not mutates[other] <= mutates[name]:
+                    mutates[name] |= mutates[other]
+                    changed = True
+    return mutates
+
+def plan(history, cells):
+    """
+    Decide how to bring a state whose __history is history up to date with cells
+
+    Returns dict with 'mode' either 'incremental' or 'restart'. For 'incremental',
+    'run' lists the indices of cells to run in order in the existing state, 'delete'
+    lists names to delete from the state first. For 'restart', 'reason' says why the
+    state has to be rebuilt by running cells from the start (or a checkpoint).
+
+    """
+    history = list(history)
+    cells = list(cells)
+    m, n = len(history), len(cells)
+    prefix = 0
+    while prefix < min(m, n) and history[prefix] == cells[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(m, n) - prefix and history[m - 1 - suffix] == cells[n - 1 - suffix]:
+        suffix += 1
+    old = [analyze(script) for script in history]
+    new = [analyze(script) for script in cells]
+    def restart(reason):
+        return { 'mode': 'restart', 'reason': reason, 'run': list(range(n)), 'delete': [] }
+    for index, info in list(enumerate(old))[prefix:] + list(enumerate(new))[prefix:]:
+        if info.uncertain is not None:
+            return restart(f'cell {index} is uncertain ({info.uncertain})')
+    effectful, module_names = effectful_names(old + new)
+    called_mutates = function_mutates(old + new)
+    def mutated(info):
+        # Mutated by the cell itself, passed to calls or by notebook functions it calls
+        names = info.mutates | info.arguments
+        for name in info.calls & called_mutates.keys():
+            names |= called_mutates[name]
+        return names - module_names
+    def binds(info):
+        return info.binds | mutated(info)
+    def side_effects(info):
+        return info.side_effects or bool(info.calls & effectful)
+    dirty = set()
+    old_changed = set()
+    for info in old[prefix:m - suffix]:
+        old_changed |= binds(info)
+    dirty |= old_changed
+    for info in new[prefix:n - suffix]:
+        dirty |= binds(info)
+    # Names only the old versions of changed cells bound must go away
+    still_bound = set()
+    for info in new[prefix:]:
+        still_bound |= binds(info)
+    delete = old_changed - still_bound
+    prefix_bound = set()
+    for info in old[:prefix]:
+        prefix_bound |= binds(info)
+    if delete & prefix_bound:
+        return restart(f'earlier value of {sorted(delete & prefix_bound)[0]} was overwritten')
+    # later[k] is set of names bound by old cells at index k and after
+    later = [set() for k in range(m + 1)]
+    for k in range(m - 1, -1, -1):
+        later[k] = later[k + 1] | binds(old[k])
+    run = []
+    # Names already bound again by cells run in this plan, their values are up to date
+    fresh = set()
+    for j in range(prefix, n):
+        info = new[j]
+        changed = j < n - suffix
+        if not (changed or side_effects(info) or (info.reads | info.deferred | binds(info)) & dirty):
+            continue
+        # In the state the inputs of this cell must not have been overwritten by itself or later cells
+        first_old = prefix if changed else j - (n - m)
+        overwritten = ((info.reads | mutated(info)) & later[first_old]) - fresh
+        if overwritten:
+            return restart(f'cell {j} reads {sorted(overwritten)[0]} which was bound again later')
+        run.append(j)
+        dirty |= binds(info)
+        fresh |= info.always_binds
+    return { 'mode': 'incremental', 'reason': None, 'run': run, 'delete': sorted(delete) }
+
+def test_analyze():
+    ''' Names read, bound and imported '''
+    info = analyze('import numpy as np\nx = np.zeros(3)\ny = x + z\ndef f(a):\n    return a * k\nlst.append(y)\n')
+    assert(info.reads == {'z', 'lst'})
+    assert(info.binds == {'np', 'x', 'y', 'f'} and info.mutates == {'np', 'lst'})
+    assert(info.deferred == {'k'})
+    assert(info.imports == {'numpy'} and not info.side_effects and info.uncertain is None)
+    assert(analyze('x = x + 1').reads == {'x'})
+    info = analyze('y = [v * k for v in x if v]')
+    assert(info.reads == {'k', 'x'} and info.binds == {'y'})
+    assert(analyze('x[0] = 1').mutates == {'x'} and analyze('if c:\n    x = 1').always_binds == set())
+    assert(analyze('f = open("a")').side_effects and analyze('import os\nos.remove("a")').side_effects)
+    assert(analyze('from os import *').uncertain == 'star import')
+    assert(has_side_effects(['import os\ndef f():\n    os.remove("a")', 'f()']) and not has_side_effects(['x = 1', 'y = x']))
+    info = analyze('def add(v):\n    x.append(v)\n    def inner():\n        y[0] = v\n    w = []\n    w.append(v)\n')
+    assert(info.function_mutates == { 'add': {'x', 'y'}, 'inner': {'y'} } and info.mutates == set())
+    info = analyze('import heapq\nheapq.heappush(h, v)\nn = len(h)\nadd(*x, key=k)\n[f(a) for a in b]\n')
+    assert(info.call_arguments == { 'heapq': {'h', 'v'}, 'add': {'x', 'k'} } and info.arguments == {'h', 'v', 'x', 'k'})
+    assert(analyze('def f():\n    g(z)').function_mutates == { 'f': {'z'} })
+
+def test_plan():
+    ''' Only cells depending on edited cell rerun '''
+    history = ['a = 1', 'b = 2', 'c = a + 1', 'd = b + 1', 'import random\nr = random.random()']
+    cells = ['a = 10', 'b = 2', 'c = a + 1', 'd = b + 1', 'import random\nr = random.random()']
+    assert(plan(history, cells) == { 'mode': 'incremental', 'reason': None, 'run': [0, 2, 4], 'delete': [] })
+    assert(plan(history, history)['run'] == [])
+    # Dropped binding is deleted, appended cell runs
+    assert(plan(['a = 1', 'z = 3'], ['a = 1', 'y = 3', 'print(a)']) == { 'mode': 'incremental', 'reason': None, 'run': [1, 2], 'delete': ['z'] })
+    # In-place updates cannot be redone in the state
+    assert(plan(['x = 1', 'x += 1'], ['x = 1', 'x += 2'])['mode'] == 'restart')
+    assert(plan(['x = []', 'x.append(1)', 'y = len(x)'], ['x = [0]', 'x.append(1)', 'y = len(x)'])['run'] == [0, 1, 2])
+    assert(plan(['x = []', 'x.append(1)', 'y = 0'], ['x = []', 'x.append(1)', 'y = 1'])['run'] == [2])
+    assert(plan(['x = 1', 'x = 2', 'y = x'], ['x = 5', 'x = 2', 'y = x'])['run'] == [0, 1, 2])
+    # Function bodies
+    assert(plan(['k = 2', 'def f(v):\n    return v * k', 'y = f(1)'], ['k = 3', 'def f(v):\n    return v * k', 'y = f(1)'])['run'] == [0, 1, 2])
+    # Mutation through a called function cannot be redone in the state either
+    history = ['x = []', 'def add(v):\n    x.append(v)', 'def twice(v):\n    add(v)\n    add(v)', 'add(1)', 'n = len(x)']
+    assert(plan(history, history[:3] + ['add(2)'] + history[4:])['mode'] == 'restart')
+    assert(plan(history, history[:3] + ['twice(1)'] + history[4:])['mode'] == 'restart')
+    assert(plan(history, ['x = [0]'] + history[1:])['run'] == [0, 1, 2, 3, 4])
+    # So is mutation of an argument
+    history = ['x = []', 'def add(l, v):\n    l.append(v)', 'add(x, 1)']
+    assert(plan(history, history[:2] + ['add(x, 2)'])['mode'] == 'restart')
+    assert(plan(['h = []', 'import heapq\nheapq.heappush(h, 1)', 'n = 0'], ['h = []', 'import heapq\nheapq.heappush(h, 1)', 'n = 1'])['run'] == [2])
+
+if __name__ == '__main__':
+    test_analyze()
+    test_plan()
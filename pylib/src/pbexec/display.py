@@ -0,0 +1,278 @@
+"""
+
+Rich display of cell values.
+
+Objects can describe how to show themselves with the IPython display protocol:
+`_repr_mimebundle_` returning a dict from MIME type to data, or one method per type such
+as `_repr_html_`, `_repr_svg_` and `_repr_png_`. The Display pipeline used by
+default_func picks one output for each value and sends it with pybook.output_content.
+
+Types are tried in order of cost (ACCEPTED): text formats first because they are cheap to
+make and to send, images last. The first type the value provides whose data fits in
+MAX_BYTES is used. Values without any acceptable rich output are shown as text with the
+fallback function (the usual repr).
+
+Rendering and encoding images (calling `_repr_png_`, decoding base64 from a mime bundle,
+checking sizes) happens on a worker thread so the cell keeps running meanwhile. Outputs
+are still sent in order: pending ones are sent as they complete and before any later
+output of the cell (see wrapped_run_cell), and all of them at the latest when the cell
+ends. Where threads cannot be started (Pyodide) the same work is done inline.
+
+"""
+
+import base64
+import collections
+import concurrent.futures
+import sys
+
+# MIME types shown, in order they are tried
+ACCEPTED = ('text/html', 'image/svg+xml', 'image/png')
+
+# Largest data sent for each type, bigger outputs fall through to the next type
+MAX_BYTES = {
+    'text/html': 1024 * 1024,
+    'image/svg+xml': 1024 * 1024,
+    'image/png': 8 * 1024 * 1024,
+    'image/jpeg': 8 * 1024 * 1024,
+}
+
+# Methods providing each type
+REPR_METHODS = {
+    'text/html': '_repr_html_',
+    'image/svg+xml': '_repr_svg_',
+    'image/png': '_repr_png_',
+    'image/jpeg': '_repr_jpeg_',
+    'text/markdown': '_repr_markdown_',
+    'text/latex': '_repr_latex_',
+    'application/json': '_repr_json_',
+}
+
+# Binary types, rendered and encoded on the worker thread
+BINARY_TYPES = ('image/png', 'image/jpeg')
+
+def _method(value, name):
+    # Look up on the type so objects answering every attribute (mocks, proxies) and
+    # classes themselves do not look displayable
+    if getattr(type(value), name, None) is None:
+        return None
+    try:
+        return getattr(value, name)
+    except Exception:
+        return None
+
+def has_rich_repr(value):
+    ''' Return True if value implements any part of the display protocol '''
+    return any(_method(value, name) is not None for name in ('_repr_mimebundle_',) + tuple(REPR_METHODS.values()))
+
+def _call(method, *args, **kwargs):
+    # Broken repr methods mean the type is not available, like IPython
+    try:
+        return method(*args, **kwargs)
+    except Exception:
+        return None
+
+def _mimebundle(value, accepted):
+    method = _method(value, '_repr_mimebundle_')
+    if method is None:
+        return {}
+    bundle = _call(method, include=list(accepted), exclude=None)
+    if isinstance(bundle, tuple):
+        # (data, metadata)
+        bundle = bundle[0]
+    return bundle if isinstance(bundle, dict) else {}
+
+def _text(data, content_type, max_bytes):
+    if not isinstance(data, str) or len(data.encode('utf-8', errors='surrogatepass')) > max_bytes.get(content_type, sys.maxsize):
+        return None
+    return data
+
+def _binary(data, content_type, max_bytes):
+    if isinstance(data, str):
+        try:
+            data = base64.b64decode(data, validate=False)
+        except ValueError:
+            return None
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        return None
+    data = bytes(data)
+    if len(data) > max_bytes.get(content_type, sys.maxsize):
+        return None
+    return data
+
+def _render_binary(value, bundle, content_types, max_bytes):
+    # Runs on the worker thread, return (content_type, bytes) or None
+    for content_type in content_types:
+        data = bundle.get(content_type)
+        if data is None:
+            method = _method(value, REPR_METHODS[content_type])
+            if method is None:
+                continue
+            data = _call(method)
+        data = _binary(data, content_type, max_bytes)
+        if data is not None:
+            return content_type, data
+    return None
+
+class Display:
+    '''
+    Pipeline choosing and sending rich outputs of values, in order.
+
+    '''
+    def __init__(self, accepted=ACCEPTED, max_bytes=None, threaded=True):
+        self.accepted = tuple(accepted)
+        self.max_bytes = dict(MAX_BYTES if max_bytes is None else max_bytes)
+        self.threaded = threaded
+        self._executor = None
+        # Outputs not sent yet: (future or None, function sending it)
+        self._pending = collections.deque()
+        # True while sending, text written by a send must not flush later outputs first
+        self._sending = False
+
+    def show(self, value, fallback):
+        """
+        Show value with its cheapest acceptable rich output, or with fallback(value)
+
+        """
+        if getattr(sys.stdout, 'dropping', False):
+            # Output is being dropped, don't spend time formatting value
+            return
+        pybook = sys.modules.get('pybook')
+        if pybook is None or not has_rich_repr(value):
+            self._send(None, lambda result: fallback(value))
+            return
+        bundle = _mimebundle(value, self.accepted)
+        for index, content_type in enumerate(self.accepted):
+            if content_type in BINARY_TYPES:
+                # Rest of the work is rendering images, do it off the cell's thread
+                binary_types = [name for name in self.accepted[index:] if name in BINARY_TYPES]
+                future = self._submit(_render_binary, value, bundle, binary_types, self.max_bytes)
+                def send(result):
+                    if result is None:
+                        fallback(value)
+                    else:
+                        self._output(*result)
+                self._send(future, send)
+                return
+            data = bundle.get(content_type)
+            if data is None:
+                method = _method(value, REPR_METHODS.get(content_type, ''))
+                if method is None:
+                    continue
+                data = _call(method)
+            data = _text(data, content_type, self.max_bytes)
+            if data is not None:
+                self._send(None, lambda result: self._output(content_type, data))
+                return
+        self._send(None, lambda result: fallback(value))
+
+    def _output(self, content_type, data):
+        # Look up at send time, output_content may be wrapped (result cache, timing)
+        sys.modules['pybook'].output_content(content_type, data)
+
+    def _submit(self, function, *args):
+        if self.threaded:
+            try:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='pbexec-display')
+                return self._executor.submit(function, *args)
+            except RuntimeError:
+                # No threads here (Pyodide), encode inline from now on
+                self.threaded = False
+                self._executor = None
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+    def _send(self, future, send):
+        if future is None and not self._pending:
+            send(None)
+            return
+        if not self._pending:
+            # Text written before this value must come out before it
+            for stream in (sys.stdout, sys.stderr):
+                stream.flush()
+        self._pending.append((future, send))
+        self.drain()
+
+    def drain(self):
+        ''' Send pending outputs that are ready, without waiting '''
+        self._send_pending(wait=False)
+
+    def flush(self):
+        ''' Wait for all pending outputs and send them '''
+        self._send_pending(wait=True)
+
+    def _send_pending(self, wait):
+        if self._sending:
+            return
+        self._sending = True
+        try:
+            while self._pending:
+                future, send = self._pending[0]
+                if future is not None and not wait and not future.done():
+                    return
+                self._pending.popleft()
+                result = None
+                if future is not None:
+                    try:
+                        result = future.result()
+                    except Exception:
+                        result = None
+                send(result)
+        finally:
+            self._sending = False
+
+    def __len__(self):
+        return len(self._pending)
+
+# Pipeline used by default_func and show_value_noarrow
+display = Display()
+
+def test_display():
+    ''' Cheapest acceptable type is chosen and outputs stay in order '''
+    import asyncio
+    from . import headless
+    headless.install()
+    from .pbexec import run_cell, wrapped_run_cell
+    class Html:
+        def _repr_html_(self):
+            return '<b>hi</b>'
+        def _repr_png_(self):
+            raise Exception('PNG should not be rendered when HTML is available')
+    class Png:
+        def _repr_html_(self):
+            return '<p>' + 'x' * (2 * 1024 * 1024) + '</p>'
+        def _repr_png_(self):
+            return b'\x89PNG fake'
+    class Bundle:
+        def _repr_mimebundle_(self, include=None, exclude=None):
+            return { 'text/plain': 'bundle', 'image/png': base64.b64encode(b'bundled').decode('ascii') }, {}
+    class Broken:
+        def _repr_svg_(self):
+            raise ValueError('broken')
+        def __repr__(self):
+            return 'Broken()'
+    state = { 'Html': Html, 'Png': Png, 'Bundle': Bundle, 'Broken': Broken }
+    headless.reset_outputs()
+    asyncio.run(wrapped_run_cell('Html()\nPng()\nprint("between")\nBundle()\nBroken()\nHtml\n', state, print_exception=False, propagate_exception=True))
+    outputs = headless.get_outputs()
+    assert(outputs[0] == { 'text/html': '<b>hi</b>' })
+    assert(outputs[1] == { 'image/png': base64.b64encode(b'\x89PNG fake').decode('ascii'), 'encoding': 'base64' })
+    assert(outputs[2] == { 'name': 'stdout', 'text/plain': 'between\n' })
+    assert(outputs[3]['image/png'] == base64.b64encode(b'bundled').decode('ascii'))
+    assert(outputs[4]['text/plain'].startswith('→ Broken()\n→ <class '))
+    assert(len(display) == 0)
+    # Without threads the same outputs are made inline
+    inline = Display(threaded=False)
+    inline.show(Png(), print)
+    assert(headless.get_outputs()[0]['image/png'] == base64.b64encode(b'\x89PNG fake').decode('ascii'))
+    # Values without rich output are left to fallback
+    shown = []
+    inline.show(42, shown.append)
+    assert(shown == [42] and headless.get_outputs() == [])
+
+if __name__ == '__main__':
+    test_display()
@@ -0,0 +1,196 @@
+'''
+
+Pure Python stand-in for the pybook module outside the browser.
+
+In the browser the worker registers a JavaScript module named `pybook` that sends output
+to the page. This module provides the same functions but collects outputs into a Python
+list, the same way src/pybook_test.py does for testing. It also has the helpers used by
+`test` cells in notebooks (sync_exec, get_outputs, assertions, ...).
+
+Call install() before importing pbexec.pbexec so that `import pybook` finds this module.
+
+'''
+
+import asyncio
+import base64
+import copy
+import sys
+import unittest
+
+from .outputs import OutputAccumulator
+
+# This global variable represents the outputs of the cell being run, it reads like a
+# list of output dicts but keeps a bounded amount of text (see pbexec.outputs)
+outputs = OutputAccumulator()
+
+# Text waiting to be read from stdin
+_pending_input = []
+
+def install():
+    ''' Make this module importable as `pybook` '''
+    sys.modules.setdefault('pybook', sys.modules[__name__])
+
+def fresh_state():
+    return {}
+
+def duplicate_state(state):
+    res = {}
+    for key, value in state.items():
+        try:
+            res[key] = copy.deepcopy(state[key])
+        except Exception as err:
+            raise KeyError(key)
+    return res
+
+def sleep(sec):
+    # Nobody is watching a countdown, don't make CI wait for it
+    pass
+
+def output_stdout(msg):
+    return _add_output({ 'name': 'stdout', 'text/plain': msg })
+
+def output_stderr(msg):
+    return _add_output({ 'name': 'stderr', 'text/plain': msg })
+
+def output_text_content(content_type, content_data):
+    if content_type == 'text/html':
+        _add_output({ 'text/html': content_data })
+    elif content_type == 'text/plain':
+        _add_output({ 'name': 'stdout', 'text/plain': content_data })
+    elif content_type == 'image/svg+xml':
+        _add_output({ 'image/svg+xml': content_data })
+
+def output_content(content_type, content_data):
+    if isinstance(content_data, str):
+        _add_output({ content_type: content_data })
+    else:
+        # Binary content is kept as base64 text so outputs stay JSON friendly
+        _add_output({ content_type: base64.b64encode(bytes(content_data)).decode('ascii'), 'encoding': 'base64' })
+
+def output_file(content_type, filename):
+    with open(filename, 'rb') as f:
+        output_content(content_type, f.read())
+
+def download_file(filename):
+    _add_output({ 'download': filename })
+
+def upload_file(filename):
+    # No browser to upload from, file must already exist locally
+    pass
+
+def input_stdin():
+    data = input_stdin_chunk(1)
+    return None if data is None else data[0]
+
+def input_stdin_chunk(max_bytes):
+    if not _pending_input:
+        return None
+    data = _pending_input.pop(0)
+    if data is not None and len(data) > max_bytes:
+        _pending_input.insert(0, data[max_bytes:])
+        data = data[:max_bytes]
+    return data
+
+## Following are specific to running outside the browser
+
+def set_input(text):
+    ''' Provide text to be read from stdin by the next cells, followed by EOF '''
+    _pending_input.clear()
+    if text:
+        _pending_input.append(text.encode('utf-8'))
+    _pending_input.extend([None, None])
+
+def _add_output(data):
+    ''' Add output, text on same channel as last message is merged with it. Return False once output stopped '''
+    return outputs.add(data)
+
+def reset_outputs():
+    outputs.clear()
+
+def get_outputs():
+    ''' Return current outputs and clear them '''
+    result = outputs.outputs()
+    outputs.clear()
+    return result
+
+async def _exec(txt, state=None, user=''):
+    if state is None:
+        state = globals()
+    state['__input'] = user
+    from . import pbexec
+    await pbexec.wrapped_run_cell(txt, globals_=state, locals_=state, print_exception=False, propagate_exception=True)
+
+async def exec_outputs(txt, state=None, user=''):
+    reset_outputs()
+    await _exec(txt, state, user)
+    return outputs
+
+def _run_sync(coro):
+    # Run coroutine to completion from synchronous code, even inside a running event loop
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    try:
+        import nest_asyncio
+    except ImportError:
+        nest_asyncio = None
+    if nest_asyncio is not None:
+        nest_asyncio.apply()
+        return asyncio.get_event_loop().run_until_complete(coro)
+    # Without nest_asyncio drive the coroutine by hand, works unless it waits on real futures
+    try:
+        while True:
+            coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+def sync_exec(txt, state=None, user=''):
+    _run_sync(_exec(txt, state, user))
+
+def sync_exec_outputs(txt, state=None, user=''):
+    reset_outputs()
+    sync_exec(txt, state, user)
+    return outputs
+
+tc = unittest.TestCase()
+
+assertEqual = tc.assertEqual
+assertNotEqual = tc.assertNotEqual
+assertTrue = tc.assertTrue
+assertFalse = tc.assertFalse
+assertIs = tc.assertIs
+assertIsNot = tc.assertIsNot
+assertIsNone = tc.assertIsNone
+assertIsNotNone = tc.assertIsNotNone
+assertIn = tc.assertIn
+assertNotIn = tc.assertNotIn
+assertIsInstance = tc.assertIsInstance
+assertNotIsInstance = tc.assertNotIsInstance
+
+assertRaises = tc.assertRaises
+assertRaisesRegex = tc.assertRaisesRegex
+assertWarns = tc.assertWarns
+assertWarnsRegex = tc.assertWarnsRegex
+assertLogs = tc.assertLogs
+assertNoLogs = tc.assertNoLogs
+
+assertAlmostEqual = tc.assertAlmostEqual
+assertNotAlmostEqual = tc.assertNotAlmostEqual
+assertGreater = tc.assertGreater
+assertGreaterEqual = tc.assertGreaterEqual
+assertLess = tc.assertLess
+assertLessEqual = tc.assertLessEqual
+assertRegex = tc.assertRegex
+assertNotRegex = tc.assertNotRegex
+assertCountEqual = tc.assertCountEqual
+
+addTypeEqualityFunc = tc.addTypeEqualityFunc
+assertMultiLineEqual = tc.assertMultiLineEqual
+assertSequenceEqual = tc.assertSequenceEqual
+assertListEqual = tc.assertListEqual
+assertTupleEqual = tc.assertTupleEqual
+assertSetEqual = tc.assertSetEqual
+assertDictEqual = tc.assertDictEqual
+
+fail = tc.fail
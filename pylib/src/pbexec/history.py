@@ -0,0 +1,230 @@
+"""
+
+Compact history of the cells run in a state.
+
+Every state has a `__history` recording the cells run in it, so the notebook can check
+that a state matches what is shown (see Invalidation in NOTES.md). Keeping the full
+source of every cell in a list per state makes the list grow without bound, get deep
+copied on every duplicate_state, and makes checking a state against the notebook a
+comparison of whole strings.
+
+A History is an immutable chain of (cell id, source hash) entries. Each entry also has
+a rolling digest of all entries up to it, so two histories are equal exactly when their
+last digests are, and checking a state against a prefix of the notebook is one hash
+comparison. Sources are interned in a shared store, each distinct source is kept once
+and only as long as some history refers to it. Appending creates a new entry pointing to the old one, so duplicated states share their
+history and only the new entries differ.
+
+"""
+
+import hashlib
+import weakref
+
+class _Source:
+    '''
+    Interned source of a cell, alive while some history entry refers to it.
+
+    '''
+    __slots__ = ('key', 'text', '__weakref__')
+    def __init__(self, key, text):
+        self.key = key
+        self.text = text
+
+class SourceStore:
+    '''
+    Deduplicated sources of cells keyed by their hash, held weakly.
+
+    '''
+    def __init__(self):
+        self._sources = weakref.WeakValueDictionary()
+
+    def intern(self, source):
+        ''' Return _Source for source, the same one for equal sources while it is alive '''
+        key = hashlib.sha256(source.encode('utf-8', errors='surrogatepass')).hexdigest()
+        res = self._sources.get(key)
+        if res is None:
+            res = self._sources[key] = _Source(key, source)
+        return res
+
+    def get(self, key):
+        return self._sources[key].text
+
+    def __len__(self):
+        return len(self._sources)
+
+    def stats(self):
+        ''' Return dictionary with number of sources and their total size '''
+        texts = [source.text for source in list(self._sources.values())]
+        return { 'sources': len(texts), 'chars': sum(len(text) for text in texts) }
+
+# Sources of all histories
+sources = SourceStore()
+
+_ROOT_DIGEST = hashlib.sha256(b'pbexec history').hexdigest()
+
+def _chain(digest, cell_id, source_hash):
+    h = hashlib.sha256(digest.encode('ascii'))
+    h.update(b'\0')
+    h.update(repr(cell_id).encode('utf-8'))
+    h.update(b'\0')
+    h.update(source_hash.encode('ascii'))
+    return h.hexdigest()
+
+class History:
+    '''
+    Immutable chain of cells run in a state, compared by rolling digest.
+
+    '''
+    __slots__ = ('parent', 'cell_id', 'source', 'digest', 'length')
+
+    def __init__(self, parent=None, cell_id=None, source=None):
+        self.parent = parent
+        self.cell_id = cell_id
+        # _Source from the shared store, keeps the text alive
+        self.source = source
+        if parent is None:
+            self.digest = _ROOT_DIGEST
+            self.length = 0
+        else:
+            self.digest = _chain(parent.digest, cell_id, source.key)
+            self.length = parent.length + 1
+
+    @property
+    def source_hash(self):
+        return None if self.source is None else self.source.key
+
+    def append(self, source, cell_id=None):
+        ''' Return new history with cell appended '''
+        return History(self, cell_id, sources.intern(source))
+
+    def extend(self, cells):
+        """
+        Return new history with cells appended
+
+        Each cell is either a source string or a tuple (cell_id, source).
+
+        """
+        res = self
+        for cell in cells:
+            if isinstance(cell, tuple):
+                res = res.append(cell[1], cell[0])
+            else:
+                res = res.append(cell)
+        return res
+
+    def _nodes(self):
+        # Entries from first to last
+        nodes = []
+        node = self
+        while node.parent is not None:
+            nodes.append(node)
+            node = node.parent
+        nodes.reverse()
+        return nodes
+
+    def entries(self):
+        ''' Return list of (cell_id, source_hash) from first cell to last '''
+        return [(node.cell_id, node.source_hash) for node in self._nodes()]
+
+    def sources(self):
+        ''' Return list of sources from first cell to last '''
+        return [node.source.text for node in self._nodes()]
+
+    def prefix(self, length):
+        ''' Return history of the first length cells '''
+        node = self
+        while node.length > length:
+            node = node.parent
+        return node
+
+    def matches(self, other):
+        """
+        Return True if this history is exactly other
+
+        other is a History (e.g. one the notebook keeps for its cells, or its prefix) or
+        a digest, both compared with a single hash comparison. A list of cells (source
+        strings or (cell_id, source)) is hashed first, which takes time proportional to
+        their size.
+
+        """
+        if isinstance(other, History):
+            return self.digest == other.digest
+        if isinstance(other, str):
+            return self.digest == other
+        return self.length == len(other) and self.digest == EMPTY.extend(other).digest
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.sources())
+
+    def __getitem__(self, index):
+        return self.sources()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, History):
+            return self.digest == other.digest
+        if isinstance(other, list):
+            return self.sources() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return f'<History of {self.length} cells {self.digest[:12]}>'
+
+    # Immutable, so duplicates of a state can share it
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # Pickles carry the sources so they can be loaded in another process
+        return (_from_cells, ([(node.cell_id, node.source.text) for node in self._nodes()],))
+
+def _from_cells(cells):
+    return EMPTY.extend(cells)
+
+EMPTY = History()
+
+def get_history(state):
+    """
+    Return History of state, converting a plain list of sources from older states
+
+    """
+    value = state.get('__history', EMPTY)
+    if not isinstance(value, History):
+        value = EMPTY.extend(value)
+    return value
+
+def test_history():
+    ''' Chains compare by digest and share entries '''
+    import copy
+    import pickle
+    first = EMPTY.append('x = 1', 'a').append('y = 2', 'b')
+    second = first.append('z = 3')
+    assert(len(second) == 3 and second.sources() == ['x = 1', 'y = 2', 'z = 3'])
+    assert(second.prefix(2) is first and second.parent is first)
+    assert(first.matches([('a', 'x = 1'), ('b', 'y = 2')]) and not first.matches(['x = 1', 'y = 2']))
+    notebook = EMPTY.extend([('a', 'x = 1'), ('b', 'y = 2'), 'w = 4'])
+    assert(first.matches(notebook.prefix(2)) and first.matches(notebook.prefix(2).digest) and not first.matches(notebook))
+    assert(EMPTY.extend(['x = 1', 'y = 2']) == ['x = 1', 'y = 2'])
+    assert(copy.deepcopy(second) is second)
+    loaded = pickle.loads(pickle.dumps(second))
+    assert(loaded == second and loaded is not second and loaded.entries() == second.entries())
+    before = len(sources)
+    EMPTY.extend(['x = 1'] * 100)
+    assert(len(sources) == before)
+    # Sources go away with the last history using them
+    unique = EMPTY.append('u = "only here"')
+    assert(len(sources) == before + 1)
+    del unique
+    assert(len(sources) == before)
+    assert(get_history({ '__history': ['x = 1'] }).sources() == ['x = 1'] and get_history({}) is EMPTY)
+
+if __name__ == '__main__':
+    test_history()
@@ -0,0 +1,324 @@
+"""
+
+Resolve and install the packages imported by cells.
+
+Before running a cell the worker makes sure the packages it imports are available.
+Checking every imported name with a real import and installing missing packages one
+at a time repeats the same work for every cell. An ImportResolver remembers, across
+cells and states, which top level module names are importable and which could not be
+installed. Only names it has not seen before are checked (with importlib.util.find_spec,
+which does not run the module).
+
+Import names are mapped to distribution names (png is provided by pypng, bs4 by
+beautifulsoup4, ...). All distributions missing for a cell are handed to the installer
+at once, installers fetch them concurrently:
+
+    * MicropipInstaller - micropip in Pyodide (PyPI or the Pyodide repository)
+    * WheelDirInstaller - pure Python wheels in a local directory, e.g. a mirror made
+      with `pip download --only-binary :all: -d DIR`
+    * IndexInstaller - a PEP 503 simple package index (http, https or file URL)
+
+The last two unpack wheels into a target directory added to sys.path.
+
+"""
+
+import asyncio
+import html.parser
+import importlib
+import importlib.util
+import os
+import re
+import sys
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+
+from . import dataflow
+
+# Import names whose distribution has a different name
+DISTRIBUTIONS = {
+    'png': 'pypng',
+    'bs4': 'beautifulsoup4',
+    'PIL': 'Pillow',
+    'sklearn': 'scikit-learn',
+    'skimage': 'scikit-image',
+    'yaml': 'PyYAML',
+    'cv2': 'opencv-python',
+    'dateutil': 'python-dateutil',
+    'attr': 'attrs',
+}
+
+def find_imports(script):
+    """
+    Return sorted list of top level module names imported by script
+
+    """
+    names = set()
+    for module in dataflow.analyze(script).imports:
+        if module and not module.startswith('.'):
+            names.add(module.split('.')[0])
+    return sorted(names)
+
+def normalize(distribution):
+    ''' Normalized distribution name (PEP 503) '''
+    return re.sub(r'[-_.]+', '-', distribution).lower()
+
+async def _in_thread(function, *args):
+    # Run blocking function on a thread, inline where threads cannot start (Pyodide)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+    except RuntimeError:
+        return function(*args)
+
+class ImportResolver:
+    '''
+    Cache of importable and unavailable module names with an installer for the rest.
+
+    '''
+    def __init__(self, installer=None, distributions=None, notify=None):
+        self.installer = installer
+        self.distributions = dict(DISTRIBUTIONS)
+        if distributions is not None:
+            self.distributions.update(distributions)
+        # Called with a message before installing
+        self.notify = notify
+        self.resolved = set()
+        self.unresolvable = set()
+        self.checks = 0
+
+    def add_distributions(self, mapping):
+        ''' Add import name to distribution name mappings '''
+        self.distributions.update(mapping)
+
+    def distribution(self, name):
+        return self.distributions.get(name, name)
+
+    def _importable(self, name):
+        if name in sys.modules:
+            return True
+        self.checks += 1
+        try:
+            return importlib.util.find_spec(name) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def missing(self, names):
+        """
+        Return names not known to be importable, recording the importable ones
+
+        Names that could not be installed before are not returned again.
+
+        """
+        result = []
+        for name in names:
+            if name in self.resolved or name in self.unresolvable:
+                continue
+            if self._importable(name):
+                self.resolved.add(name)
+            else:
+                result.append(name)
+        return result
+
+    async def prepare(self, script):
+        """
+        Make modules imported by script available, return report
+
+        Report is a dict with 'imports' (names imported), 'installed' and 'failed'
+        (distribution names) and 'seconds'. Names that still cannot be imported are
+        left for the cell to fail on with the usual ImportError.
+
+        """
+        start = time.perf_counter()
+        names = find_imports(script)
+        missing = self.missing(names)
+        report = { 'imports': names, 'installed': [], 'failed': [] }
+        if missing and self.installer is not None:
+            wanted = {}
+            for name in missing:
+                wanted.setdefault(self.distribution(name), []).append(name)
+            if self.notify is not None:
+                for distribution in wanted:
+                    self.notify(f'Installing {distribution}\n')
+            errors = await self.installer.install(list(wanted))
+            importlib.invalidate_caches()
+            for distribution, modules in wanted.items():
+                if errors.get(distribution) is None and not self.missing(modules):
+                    report['installed'].append(distribution)
+                else:
+                    report['failed'].append(distribution)
+            missing = self.missing(missing)
+        self.unresolvable.update(missing)
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+    def forget(self, name=None):
+        ''' Check name (or all names) again next time, e.g. after installing by hand '''
+        if name is None:
+            self.resolved.clear()
+            self.unresolvable.clear()
+        else:
+            self.resolved.discard(name)
+            self.unresolvable.discard(name)
+
+    def stats(self):
+        return { 'resolved': len(self.resolved), 'unresolvable': len(self.unresolvable), 'checks': self.checks }
+
+class MicropipInstaller:
+    '''
+    Install with micropip, which fetches all requested packages concurrently.
+
+    '''
+    async def install(self, distributions):
+        import micropip
+        try:
+            await micropip.install(distributions)
+            return {}
+        except Exception:
+            pass
+        # Find out which ones failed, still all at once
+        results = await asyncio.gather(*(micropip.install(name) for name in distributions), return_exceptions=True)
+        return { name: result for name, result in zip(distributions, results) if isinstance(result, BaseException) }
+
+def _wheel_name(filename):
+    # Return (normalized distribution, version tuple) of wheel filename or None
+    if not filename.endswith('.whl'):
+        return None
+    parts = filename[:-4].split('-')
+    if len(parts) < 5:
+        return None
+    python, abi, platform = parts[-3:]
+    if platform != 'any' or not any(tag.startswith('py3') or tag == 'py2.py3' for tag in python.split('.')):
+        return None
+    version = tuple(int(piece) if piece.isdigit() else 0 for piece in re.split(r'[.+]', parts[1]))
+    return normalize(parts[0]), version
+
+def _best_wheel(filenames, distribution):
+    # Pure Python wheel of distribution with highest version
+    best = None
+    for filename in filenames:
+        parsed = _wheel_name(os.path.basename(filename))
+        if parsed is not None and parsed[0] == normalize(distribution):
+            if best is None or parsed[1] > best[0]:
+                best = (parsed[1], filename)
+    return None if best is None else best[1]
+
+def _unpack(path, target):
+    with zipfile.ZipFile(path) as wheel:
+        wheel.extractall(target)
+
+class _TargetInstaller:
+    '''
+    Base for installers unpacking wheels into target directory on sys.path.
+
+    '''
+    def __init__(self, target):
+        self.target = target
+
+    def _add_target(self):
+        os.makedirs(self.target, exist_ok=True)
+        if self.target not in sys.path:
+            sys.path.insert(0, self.target)
+
+    async def install(self, distributions):
+        self._add_target()
+        results = await asyncio.gather(*(_in_thread(self._install_one, name) for name in distributions), return_exceptions=True)
+        return { name: result for name, result in zip(distributions, results) if isinstance(result, BaseException) }
+
+class WheelDirInstaller(_TargetInstaller):
+    '''
+    Install pure Python wheels found in a local directory.
+
+    '''
+    def __init__(self, directory, target):
+        super().__init__(target)
+        self.directory = directory
+
+    def _install_one(self, distribution):
+        filenames = []
+        for root, dirs, files in os.walk(self.directory):
+            filenames.extend(os.path.join(root, name) for name in files)
+        path = _best_wheel(filenames, distribution)
+        if path is None:
+            raise LookupError(f'No wheel for {distribution} in {self.directory}')
+        _unpack(path, self.target)
+
+class _Links(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links = []
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+class IndexInstaller(_TargetInstaller):
+    '''
+    Install pure Python wheels from a PEP 503 simple package index.
+
+    '''
+    def __init__(self, url, target, download_dir=None):
+        super().__init__(target)
+        self.url = url.rstrip('/') + '/'
+        self.download_dir = download_dir or os.path.join(target, '.downloads')
+
+    def _install_one(self, distribution):
+        page_url = urllib.parse.urljoin(self.url, normalize(distribution) + '/')
+        # Directories of a file URL index serve their index.html
+        fetch_url = page_url + 'index.html' if page_url.startswith('file:') else page_url
+        with urllib.request.urlopen(fetch_url) as response:
+            parser = _Links()
+            parser.feed(response.read().decode('utf-8'))
+        links = { urllib.parse.urljoin(page_url, link).split('#')[0]: None for link in parser.links }
+        url = _best_wheel(list(links), distribution)
+        if url is None:
+            raise LookupError(f'No wheel for {distribution} at {page_url}')
+        os.makedirs(self.download_dir, exist_ok=True)
+        path = os.path.join(self.download_dir, os.path.basename(urllib.parse.urlparse(url).path))
+        if not os.path.exists(path):
+            with urllib.request.urlopen(url) as response, open(path + '.tmp', 'wb') as f:
+                f.write(response.read())
+            os.replace(path + '.tmp', path)
+        _unpack(path, self.target)
+
+# Resolver shared by all cells and states
+resolver = ImportResolver()
+
+def test_import_resolver():
+    ''' Missing packages come from a wheel directory and an index, results are cached '''
+    import pathlib
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        wheels = os.path.join(directory, 'wheels')
+        os.makedirs(wheels)
+        for distribution, module, version in (('pypng', 'png', '0.1'), ('pypng', 'png', '0.2'), ('fake_dist', 'fakemod', '1.0')):
+            with zipfile.ZipFile(os.path.join(wheels, f'{distribution}-{version}-py3-none-any.whl'), 'w') as wheel:
+                wheel.writestr(f'{module}_pbexec_test.py' if module == 'png' else f'{module}.py', f'VERSION = {version!r}\n')
+        # Module is called png_pbexec_test so a real png package does not interfere
+        resolver = ImportResolver(WheelDirInstaller(wheels, os.path.join(directory, 'site')), { 'png_pbexec_test': 'pypng', 'fakemod': 'fake_dist' })
+        messages = []
+        resolver.notify = messages.append
+        script = 'import os\nimport png_pbexec_test\nfrom fake_dist_missing import x\nimport fakemod.sub as s\n'
+        report = asyncio.run(resolver.prepare(script))
+        assert(report['imports'] == ['fake_dist_missing', 'fakemod', 'os', 'png_pbexec_test'])
+        assert(report['failed'] == ['fake_dist_missing'] and sorted(report['installed']) == ['fake_dist', 'pypng'])
+        assert('Installing pypng\n' in messages and len(messages) == 3)
+        assert(importlib.import_module('png_pbexec_test').VERSION == '0.2')
+        checks = resolver.checks
+        report = asyncio.run(resolver.prepare(script))
+        assert(report['installed'] == [] and report['failed'] == [] and resolver.checks == checks)
+        # Simple index over file URLs
+        index = pathlib.Path(directory, 'index', 'fake-dist')
+        index.mkdir(parents=True)
+        index.joinpath('index.html').write_text('<a href="../../wheels/fake_dist-1.0-py3-none-any.whl#sha256=0">fake_dist-1.0</a>')
+        installer = IndexInstaller(pathlib.Path(directory, 'index').as_uri(), os.path.join(directory, 'site2'))
+        assert(asyncio.run(installer.install(['fake-dist', 'nothing'])).keys() == { 'nothing' })
+        assert(os.path.exists(os.path.join(directory, 'site2', 'fakemod.py')))
+        for path in (os.path.join(directory, 'site'), os.path.join(directory, 'site2')):
+            sys.path.remove(path)
+        for name in ('png_pbexec_test', 'fakemod'):
+            sys.modules.pop(name, None)
+
+if __name__ == '__main__':
+    test_import_resolver()
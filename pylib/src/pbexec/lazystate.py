@@ -0,0 +1,216 @@
+"""
+
+Lazy states that isolate values which cannot be copied.
+
+duplicate_state deep copies every value of a state, and one value that cannot be copied
+(a lock, a generator, an open file) makes it raise KeyError, so the whole checkpoint is
+lost. A LazyState is a CowState with two differences:
+
+    * a value that cannot be copied does not fail the duplicate. The state that needed
+      the copy gets a Tombstone instead, the state the value was shared from keeps the
+      original. Looking up a tombstone raises UncopyableValueError naming the key and
+      why it could not be copied, cells that do not use the name run as usual.
+    * copies made and time spent copying are counted (see stats), to check that copying
+      scales with what cells use rather than with the size of the state.
+
+Duplicating a LazyState copies nothing, values are copied when a cell in one of the
+states looks them up. Plain dict states can be turned into a LazyState with
+LazyState.from_state. Their values are copied right away (nothing stops later cells from
+changing the dict), but uncopyable values still become tombstones.
+
+"""
+
+import copy
+import time
+
+from .cowstate import CowState
+from .statecopy import INTERPRETER_KEYS, StateCopier
+
+class UncopyableValueError(copy.Error):
+    '''
+    Raised when a cell uses a name whose value could not be copied into its state.
+
+    '''
+
+class Tombstone:
+    '''
+    Placeholder for a value that could not be copied into a state.
+
+    '''
+    __slots__ = ('key', 'type_name', 'reason')
+    def __init__(self, key, value, err):
+        self.key = key
+        self.type_name = f'{type(value).__module__}.{type(value).__qualname__}'
+        self.reason = f'{type(err).__name__}: {err}'
+
+    def error(self):
+        return UncopyableValueError(f"Value of '{self.key}' ({self.type_name}) could not be copied into this state when it was duplicated ({self.reason}), assign a new value to use the name")
+
+    def __reduce__(self):
+        return (_tombstone, (self.key, self.type_name, self.reason))
+
+    def __repr__(self):
+        return f'<Tombstone {self.key!r} {self.type_name}>'
+
+def _tombstone(key, type_name, reason):
+    res = Tombstone.__new__(Tombstone)
+    res.key = key
+    res.type_name = type_name
+    res.reason = reason
+    return res
+
+class LazyState(CowState):
+    '''
+    Copy-on-write state where uncopyable values become tombstones.
+
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.copies = 0
+        self.copy_seconds = 0.0
+
+    @classmethod
+    def from_state(cls, state, report=None):
+        """
+        Return LazyState with the contents of state
+
+        LazyStates and CowStates are duplicated without copying. Other states are copied
+        with one memo, keys whose value cannot be copied get tombstones. If report is a
+        dict, it is filled in with the strategy and time used for each key copied now.
+
+        """
+        if isinstance(state, cls):
+            return state.duplicate()
+        if isinstance(state, CowState):
+            res = state.duplicate()
+            lazy = cls()
+            # Take over sharing, state was just duplicated so nothing is private yet
+            lazy._shared, res._shared = res._shared, {}
+            lazy._aliases, res._aliases = res._aliases, {}
+            dict.update(lazy, dict.items(res))
+            return lazy
+        res = cls()
+        copier = StateCopier()
+        start = time.perf_counter()
+        for key, value in dict.items(state):
+            if key in INTERPRETER_KEYS:
+                dict.__setitem__(res, key, value)
+                continue
+            try:
+                dict.__setitem__(res, key, copier.copy_key(key, value))
+            except Exception as err:
+                dict.__setitem__(res, key, Tombstone(key, value, err))
+                copier.report[key] = { 'strategy': 'tombstone', 'seconds': 0.0 }
+        res.copies = len(copier.report)
+        res.copy_seconds = time.perf_counter() - start
+        if report is not None:
+            report.update(copier.report)
+        return res
+
+    def _needs_copy(self, shared):
+        return shared.uncopyable or super()._needs_copy(shared)
+
+    def _copy_shared(self, key, shared):
+        value = shared.value
+        if shared.uncopyable and shared.owner != id(self):
+            return Tombstone(key, value, copy.Error('owner kept the only instance'))
+        start = time.perf_counter()
+        try:
+            value = self._copier.copy_key(key, value)
+            self.copies += 1
+        except Exception as err:
+            if shared.owner == id(self):
+                # Keep original here, other states holding it get tombstones
+                shared.uncopyable = True
+            else:
+                value = Tombstone(key, value, err)
+        self.copy_seconds += time.perf_counter() - start
+        return value
+
+    def _alias(self, key, value):
+        if type(value) is Tombstone:
+            return _tombstone(key, value.type_name, value.reason)
+        return value
+
+    def _materialize(self, key):
+        value = super()._materialize(key)
+        if type(value) is Tombstone:
+            raise value.error()
+        return value
+
+    def _materialize_all(self):
+        # Tombstones stay in place for values() and items(), they raise when looked up
+        for key in list(self._shared):
+            try:
+                self._materialize(key)
+            except UncopyableValueError:
+                pass
+
+    def __getitem__(self, key):
+        if key in self._shared:
+            return self._materialize(key)
+        value = dict.__getitem__(self, key)
+        if type(value) is Tombstone:
+            raise value.error()
+        return value
+
+    def tombstones(self):
+        ''' Return dict from key to reason for keys whose value could not be copied '''
+        return { key: value.reason for key, value in dict.items(self) if type(value) is Tombstone }
+
+    def stats(self):
+        ''' Return dictionary of counters '''
+        return {
+            'keys': len(self),
+            'shared': len(self.shared_keys()),
+            'copies': self.copies,
+            'copy_seconds': self.copy_seconds,
+            'tombstones': len(self.tombstones()),
+        }
+
+async def test_lazy_state():
+    ''' Only used values are copied, uncopyable ones fail only where used '''
+    import pickle
+    import threading
+    from .pbexec import duplicate_state, fresh_state, run_cell
+    from .lazystate import LazyState, UncopyableValueError
+    parent = fresh_state(lazy=True)
+    await run_cell('import threading\nlock = threading.Lock()\nbig = [list(range(100)) for i in range(100)]\nsmall = [1]\nalias = small', parent, func=None, write=False)
+    child = duplicate_state(parent)
+    await run_cell('small.append(2)', child, func=None, write=False)
+    # Names aliasing one value are copied once
+    assert(child['alias'] == [1, 2] and parent['small'] == [1] and child.stats()['copies'] == 1)
+    assert(child['big'] is not parent['big'] and child.stats()['copies'] == 2)
+    # Parent keeps the lock, child gets a tombstone raising only when used
+    with parent['lock']:
+        pass
+    await run_cell('n = len(small)', child, func=None, write=False)
+    assert(child['n'] == 2)
+    try:
+        await run_cell('with lock:\n    pass', child, func=None, write=False, print_exception=False, propagate_exception=True)
+        assert(False)
+    except UncopyableValueError as err:
+        assert("'lock'" in str(err) and '_thread.lock' in str(err))
+    assert(list(child.tombstones()) == ['lock'])
+    await run_cell('lock = threading.Lock()\nwith lock:\n    pass', child, func=None, write=False)
+    assert(child.tombstones() == {} and len(child.items()) == len(child))
+    # Tombstones survive pickling, so states holding them can still be spilled
+    grandchild = duplicate_state(child)
+    grandchild['lock'] = None
+    plain = { 'lock': threading.Lock(), 'items': [1, 2], 'same': None }
+    plain['same'] = plain['items']
+    report = {}
+    lazy = LazyState.from_state(plain, report)
+    assert(report['lock']['strategy'] == 'tombstone' and lazy['same'] is lazy['items'] is not plain['items'])
+    restored = pickle.loads(pickle.dumps(lazy))
+    assert(isinstance(restored, LazyState) and list(restored.tombstones()) == ['lock'])
+    try:
+        duplicate_state(plain)
+        assert(False)
+    except KeyError:
+        pass
+    assert(list(duplicate_state(plain, lazy=True).tombstones()) == ['lock'])
+
+if __name__ == '__main__':
+    import asyncio
+    asyncio.run(test_lazy_state())
@@ -0,0 +1,256 @@
+"""
+
+Line and branch coverage of cells, for grading submissions.
+
+run_cell(..., coverage={}) fills the dict with which lines and branches of the cell ran.
+Only the code objects compiled from the cell (its top level code and the functions,
+classes and comprehensions defined in it) are watched, library code runs at full speed.
+
+With sys.monitoring (PEP 669, Python 3.12 and later) LINE and BRANCH events are enabled
+locally on the cell's code objects only, and every callback returns DISABLE, so each
+line or branch costs one callback the first time it runs and nothing afterwards.
+
+Older Pythons (CPython 3.11, Pyodide) fall back to sys.settrace. The global trace
+function only returns a local one for frames of the cell's code, and stops tracing new
+frames of a code object once all its lines and branches were seen. This is slower but
+gives the same map. It cannot be combined with another trace function (a debugger), in
+that case RuntimeError is raised.
+
+The map has:
+
+    * lines - sorted list of line numbers that ran
+    * missed - sorted list of lines with code that did not run
+    * branches - sorted list of [from_line, to_line] pairs of conditional jumps taken
+      (jumps within one line are not counted)
+    * backend - 'monitoring' or 'settrace'
+
+Functions of the cell called after the cell finished (from later cells) are not counted.
+
+"""
+
+import bisect
+import dis
+import sys
+import types
+
+def _code_objects(code):
+    # Code and all code objects nested in its constants
+    result = [code]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            result.extend(_code_objects(const))
+    return result
+
+class _LineMap:
+    '''
+    Line number of each instruction offset of a code object.
+
+    '''
+    def __init__(self, code):
+        self.starts = []
+        self.lines = []
+        for start, end, line in code.co_lines():
+            self.starts.append(start)
+            self.lines.append(line)
+
+    def line(self, offset):
+        index = bisect.bisect_right(self.starts, offset) - 1
+        return self.lines[index] if index >= 0 else None
+
+    def executable(self):
+        return { line for line in self.lines if line is not None and line > 0 }
+
+def _is_branch(instruction):
+    name = instruction.opname
+    return instruction.opcode in dis.hasjrel + dis.hasjabs and ('IF' in name or name == 'FOR_ITER')
+
+def _branches(code, lines):
+    # Possible (from_line, to_line) pairs of conditional jumps in code
+    result = set()
+    instructions = list(dis.get_instructions(code))
+    for index, instruction in enumerate(instructions):
+        if not _is_branch(instruction):
+            continue
+        source = lines.line(instruction.offset)
+        targets = [instruction.argval]
+        if index + 1 < len(instructions):
+            targets.append(instructions[index + 1].offset)
+        for target in targets:
+            line = lines.line(target)
+            if source is not None and line is not None and line != source:
+                result.add((source, line))
+    return result
+
+class _Session:
+    '''
+    Lines and branches seen for one run of a cell.
+
+    '''
+    def __init__(self, code, backend):
+        self.codes = _code_objects(code)
+        self.backend = backend
+        self.line_maps = { code: _LineMap(code) for code in self.codes }
+        self.lines = set()
+        self.branches = set()
+
+    def result(self):
+        executable = set()
+        for line_map in self.line_maps.values():
+            executable |= line_map.executable()
+        return {
+            'lines': sorted(self.lines),
+            'missed': sorted(executable - self.lines),
+            'branches': [list(branch) for branch in sorted(self.branches)],
+            'backend': self.backend,
+        }
+
+# Sessions watching each code object, for monitoring callbacks
+_sessions = {}
+
+def _monitoring_events():
+    events = sys.monitoring.events
+    if hasattr(events, 'BRANCH_LEFT'):
+        return [events.BRANCH_LEFT, events.BRANCH_RIGHT]
+    return [events.BRANCH]
+
+def _on_line(code, line):
+    for session in _sessions.get(code, ()):
+        session.lines.add(line)
+    return sys.monitoring.DISABLE
+
+def _on_branch(code, offset, destination):
+    for session in _sessions.get(code, ()):
+        line_map = session.line_maps[code]
+        source, target = line_map.line(offset), line_map.line(destination)
+        if source is not None and target is not None and source != target:
+            session.branches.add((source, target))
+    return sys.monitoring.DISABLE
+
+def _start_monitoring(session):
+    monitoring = sys.monitoring
+    tool = monitoring.COVERAGE_ID
+    if not _sessions:
+        if monitoring.get_tool(tool) is not None:
+            raise RuntimeError(f'Coverage tool id is used by {monitoring.get_tool(tool)}')
+        monitoring.use_tool_id(tool, 'pbexec')
+        monitoring.register_callback(tool, monitoring.events.LINE, _on_line)
+        for event in _monitoring_events():
+            monitoring.register_callback(tool, event, _on_branch)
+        # Locations disabled by an earlier run of the same (cached) code count again
+        monitoring.restart_events()
+    mask = monitoring.events.LINE
+    for event in _monitoring_events():
+        mask |= event
+    for code in session.codes:
+        _sessions.setdefault(code, []).append(session)
+        monitoring.set_local_events(tool, code, mask)
+
+def _stop_monitoring(session):
+    monitoring = sys.monitoring
+    tool = monitoring.COVERAGE_ID
+    for code in session.codes:
+        watching = _sessions[code]
+        watching.remove(session)
+        if not watching:
+            del _sessions[code]
+            monitoring.set_local_events(tool, code, 0)
+    if not _sessions:
+        monitoring.register_callback(tool, monitoring.events.LINE, None)
+        for event in _monitoring_events():
+            monitoring.register_callback(tool, event, None)
+        monitoring.free_tool_id(tool)
+
+class _Tracer:
+    '''
+    sys.settrace fallback recording lines and branches of the session's code objects.
+
+    '''
+    def __init__(self, session):
+        self.session = session
+        self.codes = set(session.codes)
+        # Branches still to see and lines of each code object
+        self.todo = {}
+        for code in session.codes:
+            line_map = session.line_maps[code]
+            self.todo[code] = (line_map.executable(), _branches(code, line_map))
+
+    def _done(self, code):
+        lines, branches = self.todo[code]
+        return lines <= self.session.lines and branches <= self.session.branches
+
+    def global_trace(self, frame, event, arg):
+        code = frame.f_code
+        if code not in self.codes:
+            return None
+        if self._done(code):
+            # Everything in it seen, no need to trace it again
+            self.codes.discard(code)
+            return None
+        branches = self.todo[code][1]
+        previous = None
+        def local_trace(frame, event, arg):
+            nonlocal previous
+            if event == 'line':
+                line = frame.f_lineno
+                self.session.lines.add(line)
+                if (previous, line) in branches:
+                    self.session.branches.add((previous, line))
+                previous = line
+            return local_trace
+        return local_trace
+
+class CellCoverage:
+    '''
+    Context manager recording coverage of one cell's code while active.
+
+    '''
+    def __init__(self, code):
+        self.backend = 'monitoring' if hasattr(sys, 'monitoring') else 'settrace'
+        self.session = _Session(code, self.backend)
+        self._tracer = None
+        self._previous = None
+
+    def __enter__(self):
+        if self.backend == 'monitoring':
+            _start_monitoring(self.session)
+        else:
+            if sys.gettrace() is not None:
+                raise RuntimeError('Coverage without sys.monitoring cannot run under another trace function')
+            self._tracer = _Tracer(self.session)
+            sys.settrace(self._tracer.global_trace)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.backend == 'monitoring':
+            _stop_monitoring(self.session)
+        else:
+            sys.settrace(None)
+        return False
+
+    def result(self):
+        return self.session.result()
+
+def test_coverage():
+    ''' Lines and branches that ran are recorded, others are missed '''
+    import asyncio
+    from .pbexec import run_cell
+    script = 'import asyncio\ndef check(n):\n    if n > 0:\n        return "positive"\n    return "other"\n' + \
+        'def unused():\n    return 1\nresults = [check(n) for n in (1, 2)]\nawait asyncio.sleep(0)\ntotal = len(results)\n'
+    state = {}
+    coverage = {}
+    asyncio.run(run_cell(script, state, func=None, coverage=coverage))
+    assert(state['total'] == 2 and coverage['backend'] in ('monitoring', 'settrace'))
+    assert({ 1, 2, 3, 4, 6, 8, 9, 10 } <= set(coverage['lines']))
+    assert(5 in coverage['missed'] and 7 in coverage['missed'])
+    assert([3, 4] in coverage['branches'] and [3, 5] not in coverage['branches'])
+    # Running again covers the other branch, earlier runs do not leak in
+    coverage = {}
+    asyncio.run(run_cell('check(-1)', state, func=None, coverage=coverage))
+    assert(coverage['lines'] == [1] and coverage['missed'] == [])
+    coverage = {}
+    asyncio.run(run_cell(script.replace('(1, 2)', '(0, 1)'), state, func=None, coverage=coverage))
+    assert([3, 4] in coverage['branches'] and [3, 5] in coverage['branches'] and 5 in coverage['lines'])
+    assert(sys.gettrace() is None)
+
+if __name__ == '__main__':
+    test_coverage()
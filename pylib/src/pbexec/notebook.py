@@ -0,0 +1,950 @@
+"""
+
+Parse PyBook notebook files (.pbnb) in Python.
+
+Two flavors of the format exist, this module reads both:
+
+    * The tagged format from doc/FileSpec.md. Cells start with `#%` (Python) or `#%%`
+      / `#% md` (Markdown), may end with `#% end`, and pages are separated by `#% page`.
+      Tags may carry options such as `hidden` or `id=VALUE`.
+    * The prefix format from src/parser.js. Markdown lines start with `#m> `, other lines
+      are Python, cells are split with `#---#` and pages with `#---page---#`.
+
+A file is read as the tagged format if any line starts with `#%`.
+
+In the tagged format a cell may be followed by its outputs, each an `#% output` block
+ending with `#% end`:
+
+    #% output type=text/plain name=stdout
+    hello
+    #% end
+    #% output type=image/png encoding=base64
+    iVBORw0KGgo...
+    #% end
+    #% output type=audio/wav encoding=blob
+    5d41402abc4b2a76b9719d911017c592...
+    #% end
+
+Binary data is either inline (base64 wrapped over lines) or a reference to a blob kept
+outside the notebook by the sha256 of its bytes (encoding=blob), in a sidecar directory
+`NAME.pbnb.blobs` or zip archive `NAME.pbnb.blobs.zip`. externalize and internalize
+convert between the two, save_file and convert_files do it for whole files.
+
+The result is a list of pages, each page a list of cells. Each cell is a dict with
+`cell_type` ('python' or 'markdown') and `source`, plus one entry for each option
+given in the tag (boolean options map to True). Cells with outputs have an `outputs`
+list of output dicts as sent by the interface: `{ 'name': 'stdout', 'text/plain': text }`,
+`{ 'text/html': text }`, `{ 'image/png': base64, 'encoding': 'base64' }`, or
+`{ 'image/png': digest, 'encoding': 'blob' }` for an external blob.
+
+Large notebooks need not be read whole. index_file reads a binary file object line by
+line and returns a NotebookIndex with the byte range of every page and cell. With it one
+page can be loaded, or one cell read or rewritten, touching only that part of the file
+(rewriting a cell with text of another length moves the rest of the file after it).
+
+"""
+
+import base64
+import hashlib
+import io
+import os
+import re
+import zipfile
+
+# Boolean options allowed on each kind of tag
+PYTHON_FLAGS = ('hidden', 'auto', 'nooutput', 'readonly', 'test', 'submit', 'user', 'nocache')
+MARKDOWN_FLAGS = ('edit',)
+# Options taking a value with key=value syntax
+PYTHON_VALUES = ('id', 'language', 'use', 'save')
+MARKDOWN_VALUES = ('id',)
+OUTPUT_FLAGS = ('noeol',)
+OUTPUT_VALUES = ('type', 'name', 'encoding')
+
+# Characters per line of inline base64 data
+BASE64_LINE = 76
+# Binary outputs at least this large are stored as blobs by externalize
+BLOB_MIN = 1024
+
+_TAG = re.compile(r'#%(%|\s|$)')
+_TAG_BYTES = re.compile(rb'#%(%|\s|$)')
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+_LEADING_BLANK_LINES = re.compile(r'^(?:[ \t]*\n)+')
+
+class ParseError(ValueError):
+    ''' Error in notebook file, message includes filename and line number '''
+
+def is_tagged(text):
+    ''' Return True if text uses the tagged format from FileSpec.md '''
+    return any(_TAG.match(line) for line in text.split('\n'))
+
+def parse(text, filename='<notebook>'):
+    """
+    Parse notebook text, return list of pages (each a list of cell dicts)
+
+    """
+    if is_tagged(text):
+        return parse_tagged(text, filename)
+    return parse_prefixed(text, filename)
+
+def parse_file(path):
+    ''' Parse notebook file at path '''
+    with open(path, encoding='utf-8') as f:
+        return parse(f.read(), filename=path)
+
+def _clean_source(lines):
+    # Remove blank lines at start and whitespace at end of cell
+    return _LEADING_BLANK_LINES.sub('', '\n'.join(lines)).rstrip()
+
+def parse_tag(line):
+    """
+    Parse a `#%` tag line
+
+    Returns tuple (kind, options) where kind is one of 'python', 'markdown', 'output',
+    'end', 'page'. Raises ValueError for unknown or repeated options.
+
+    """
+    if line.startswith('#%%'):
+        kind = 'markdown'
+        words = line[3:].split()
+    else:
+        words = line[2:].split()
+        if words == ['end']:
+            return 'end', {}
+        if words == ['page']:
+            return 'page', {}
+        kind = 'python'
+        if words[:1] == ['md']:
+            kind = 'markdown'
+            words = words[1:]
+        elif words[:1] == ['output']:
+            kind = 'output'
+            words = words[1:]
+    flags, values = {
+        'python': (PYTHON_FLAGS, PYTHON_VALUES),
+        'markdown': (MARKDOWN_FLAGS, MARKDOWN_VALUES),
+        'output': (OUTPUT_FLAGS, OUTPUT_VALUES),
+    }[kind]
+    options = {}
+    for word in words:
+        name, eq, value = word.partition('=')
+        if name in options:
+            raise ValueError(f'Repeated option {name}')
+        if eq and name in values:
+            options[name] = value
+        elif not eq and name in flags:
+            options[name] = True
+        else:
+            raise ValueError(f'Unknown option {word}')
+    if kind == 'output' and 'type' not in options:
+        raise ValueError('Output needs type=CONTENT_TYPE')
+    return kind, options
+
+def _output(options, lines):
+    # Output dict from options and body lines of an output block
+    encoding = options.get('encoding')
+    if encoding in ('base64', 'blob'):
+        output = { options['type']: ''.join(line.strip() for line in lines), 'encoding': encoding }
+        if encoding == 'blob':
+            _check_digest(output[options['type']])
+    elif encoding == 'base64-text':
+        output = { options['type']: base64.b64decode(''.join(lines)).decode('utf-8', errors='surrogateescape') }
+    else:
+        text = '\n'.join(lines)
+        output = { options['type']: text if options.get('noeol') else text + '\n' }
+    if 'name' in options:
+        output['name'] = options['name']
+    return output
+
+def parse_tagged(text, filename='<notebook>'):
+    """
+    Parse notebook in tagged format, return list of pages
+
+    Adjacent `user` and `submit` cells are merged into one submit cell whose `source`
+    is the submit code and whose `user` entry is the default user text.
+
+    """
+    pages = []
+    page = []
+    cell = None
+    output = None
+    lines = []
+    def finish_cell():
+        nonlocal cell, output, lines
+        if output is not None:
+            # Outputs outside of cells are ignored like other text
+            if page:
+                page[-1].setdefault('outputs', []).append(_output(output, lines))
+        if cell is not None:
+            cell['source'] = _clean_source(lines)
+            if cell.get('submit') and page and page[-1].get('user') is True:
+                # Merge user part into this submit cell
+                user = page.pop()
+                cell['user'] = user['source']
+                if 'language' in user:
+                    cell.setdefault('language', user['language'])
+                if 'id' in user:
+                    cell.setdefault('id', user['id'])
+            page.append(cell)
+        cell = None
+        output = None
+        lines = []
+    def finish_page():
+        nonlocal page
+        finish_cell()
+        if page:
+            pages.append(page)
+        page = []
+    for linenum, line in enumerate(text.split('\n')):
+        if not _TAG.match(line):
+            if cell is not None or output is not None:
+                lines.append(line)
+            # Text outside of cells is ignored
+            continue
+        try:
+            kind, options = parse_tag(line)
+        except ValueError as err:
+            raise ParseError(f'{filename}:{linenum + 1} Error parsing line {linenum + 1}\n{err}')
+        if kind == 'page':
+            finish_page()
+        elif kind == 'end':
+            finish_cell()
+        elif kind == 'output':
+            finish_cell()
+            output = options
+        else:
+            finish_cell()
+            cell = { 'cell_type': kind }
+            cell.update(options)
+    finish_page()
+    return pages
+
+def parse_prefixed(text, filename='<notebook>'):
+    """
+    Parse notebook in prefix format of src/parser.js, return list of pages
+
+    """
+    pages = []
+    page = []
+    item = []
+    current = ''
+    def finish_item():
+        nonlocal item, current
+        if current != '':
+            page.append({ 'cell_type': current, 'source': '\n'.join(item).strip() })
+        item = []
+        current = ''
+    def finish_page():
+        nonlocal page
+        finish_item()
+        if page:
+            pages.append(page)
+        page = []
+    if text.endswith('\n'):
+        text = text[:-1]
+    for line in text.split('\n'):
+        if line == '#---#':
+            finish_item()
+        elif line == '#---page---#':
+            finish_page()
+        else:
+            if line == '#m>':
+                prefix, rest = 'markdown', ''
+            elif line.startswith('#m> '):
+                prefix, rest = 'markdown', line[4:]
+            else:
+                prefix, rest = 'python', line
+            # Blank lines belong to the current cell
+            if rest == '':
+                prefix = current
+            if prefix != current:
+                if current != '':
+                    finish_item()
+                current = prefix
+            item.append(rest)
+    finish_page()
+    return pages
+
+def _tag_line(cell):
+    # Build tag line for cell, options in a fixed order
+    if cell['cell_type'] == 'markdown':
+        words = ['#%%'] + [name for name in MARKDOWN_FLAGS if cell.get(name)]
+        words += [f'{name}={cell[name]}' for name in MARKDOWN_VALUES if name in cell]
+    else:
+        words = ['#%'] + [name for name in PYTHON_FLAGS if cell.get(name) is True]
+        words += [f'{name}={cell[name]}' for name in PYTHON_VALUES if name in cell]
+    return ' '.join(words)
+
+def _tagged_cell_text(cell):
+    # Text of one cell in the tagged format, submit cells with user text are two blocks
+    chunks = []
+    if cell.get('submit') and isinstance(cell.get('user'), str):
+        user = { 'cell_type': 'python', 'user': True, 'source': cell['user'] }
+        if 'language' in cell:
+            user['language'] = cell['language']
+        if 'id' in cell:
+            user['id'] = cell['id']
+        submit = { key: value for key, value in cell.items() if key not in ('user', 'language', 'id') }
+        chunks.append(_tag_line(user) + '\n' + user['source'] + '\n\n')
+        cell = submit
+    chunks.append(_tag_line(cell) + '\n' + cell['source'] + '\n\n')
+    outputs = cell.get('outputs')
+    if outputs:
+        for output in outputs:
+            chunks.append(_output_text(output))
+        chunks.append('\n')
+    return ''.join(chunks)
+
+def _output_type(output):
+    for key in output:
+        if key not in ('name', 'encoding'):
+            return key
+    raise ValueError(f'Output without content {output!r}')
+
+def _output_text(output):
+    # Output block in the tagged format
+    content_type = _output_type(output)
+    data = output[content_type]
+    words = ['#% output', f'type={content_type}']
+    if 'name' in output:
+        words.append(f"name={output['name']}")
+    encoding = output.get('encoding')
+    if encoding in ('base64', 'blob'):
+        body = ''.join(data[index:index + BASE64_LINE] + '\n' for index in range(0, len(data), BASE64_LINE))
+    elif any(_TAG.match(line) for line in data.split('\n')):
+        # Lines looking like tags would end the block, keep text encoded
+        encoding = 'base64-text'
+        encoded = base64.b64encode(data.encode('utf-8', errors='surrogateescape')).decode('ascii')
+        body = ''.join(encoded[index:index + BASE64_LINE] + '\n' for index in range(0, len(encoded), BASE64_LINE))
+    elif data.endswith('\n'):
+        body = data
+    else:
+        words.append('noeol')
+        body = data + '\n'
+    if encoding is not None:
+        words.append(f'encoding={encoding}')
+    return ' '.join(words) + '\n' + body + '#% end\n'
+
+def unparse(pages):
+    """
+    Convert list of pages back to text in the tagged format
+
+    """
+    chunks = []
+    for index, page in enumerate(pages):
+        if index > 0:
+            chunks.append('#% page\n\n')
+        for cell in page:
+            chunks.append(_tagged_cell_text(cell))
+    return ''.join(chunks)
+
+def _prefixed_cell_text(cell):
+    if cell['cell_type'] == 'markdown':
+        return '\n'.join('#m> ' + line for line in cell['source'].split('\n')) + '\n'
+    if cell['cell_type'] == 'python':
+        return cell['source'] + '\n'
+    raise ValueError(f"Unknown cell type {cell['cell_type']}")
+
+def _unparse_prefixed_page(cells):
+    chunks = []
+    previous = None
+    for cell in cells:
+        if cell['cell_type'] == previous:
+            chunks.append('#---#\n')
+        previous = cell['cell_type']
+        chunks.append(_prefixed_cell_text(cell))
+    return ''.join(chunks)
+
+def unparse_prefixed(pages):
+    """
+    Convert list of pages back to text in the prefix format, like unparse in src/parser.js
+
+    """
+    return '#---page---#\n'.join(_unparse_prefixed_page(page) for page in pages)
+
+class _TaggedIndexer:
+    '''
+    Byte ranges of pages and cells of the tagged format, fed one line at a time.
+
+    '''
+    def __init__(self, filename, start=0, linenum=0):
+        self.filename = filename
+        self.pages = []
+        self.page = { 'start': start, 'cells': [] }
+        self.cell = None
+        # Last cell of page is a user cell a following submit cell merges with
+        self.user = False
+        self.linenum = linenum
+        self.saw_tag = False
+        # In an output block of the last cell
+        self.output = False
+
+    def line(self, pos, line):
+        self.linenum += 1
+        if not _TAG_BYTES.match(line):
+            return
+        self.saw_tag = True
+        text = line.decode('utf-8', errors='surrogateescape').rstrip('\n')
+        try:
+            kind, options = parse_tag(text)
+        except ValueError as err:
+            raise ParseError(f'{self.filename}:{self.linenum} Error parsing line {self.linenum}\n{err}')
+        if self.output:
+            # Outputs belong to the range of their cell, with the end tag closing them
+            self.page['cells'][-1]['end'] = pos + len(line) if kind == 'end' else pos
+            self.output = False
+        if kind == 'page':
+            self.finish_page(pos, pos + len(line))
+        elif kind == 'end':
+            self.finish_cell(pos)
+        elif kind == 'output':
+            self.finish_cell(pos)
+            self.output = bool(self.page['cells'])
+        else:
+            self.finish_cell(pos)
+            self.cell = { 'start': pos, 'end': None, 'cell_type': kind, 'user': options.get('user') is True, 'submit': bool(options.get('submit')) }
+
+    def finish_cell(self, pos):
+        cell = self.cell
+        if cell is None:
+            return
+        self.cell = None
+        cells = self.page['cells']
+        cell['end'] = pos
+        user = cell.pop('user')
+        if cell.pop('submit') and self.user:
+            # Merged into the user cell before it, like parse_tagged
+            cells[-1]['end'] = pos
+            self.user = False
+            return
+        cells.append(cell)
+        self.user = user
+
+    def finish_page(self, pos, next_start):
+        if self.output:
+            self.page['cells'][-1]['end'] = pos
+            self.output = False
+        self.finish_cell(pos)
+        self.page['end'] = pos
+        if self.page['cells']:
+            self.pages.append(self.page)
+        self.page = { 'start': next_start, 'cells': [] }
+        self.user = False
+
+class _PrefixedIndexer:
+    '''
+    Byte ranges of pages and cells of the prefix format, fed one line at a time.
+
+    '''
+    def __init__(self, filename, start=0, linenum=0):
+        self.filename = filename
+        self.pages = []
+        self.page = { 'start': start, 'cells': [] }
+        self.current = ''
+        self.item_start = start
+
+    def line(self, pos, line):
+        text = line.rstrip(b'\n')
+        if text == b'#---#':
+            self.finish_item(pos, pos + len(line))
+            return
+        if text == b'#---page---#':
+            self.finish_page(pos, pos + len(line))
+            return
+        if text == b'#m>' or text.startswith(b'#m> '):
+            prefix, blank = 'markdown', text in (b'#m>', b'#m> ')
+        else:
+            prefix, blank = 'python', text == b''
+        if blank:
+            prefix = self.current
+        if prefix != self.current:
+            if self.current != '':
+                self.finish_item(pos, pos)
+            self.current = prefix
+
+    def finish_item(self, pos, next_start):
+        if self.current != '':
+            self.page['cells'].append({ 'start': self.item_start, 'end': pos, 'cell_type': self.current })
+        self.current = ''
+        self.item_start = next_start
+
+    def finish_page(self, pos, next_start):
+        self.finish_item(pos, next_start)
+        self.page['end'] = pos
+        if self.page['cells']:
+            self.pages.append(self.page)
+        self.page = { 'start': next_start, 'cells': [] }
+
+def _feed(f, indexers, start=0, end=None):
+    # Feed lines of binary file f between offsets start and end to indexers
+    f.seek(start)
+    pos = start
+    while end is None or pos < end:
+        line = f.readline() if end is None else f.readline(end - pos)
+        if not line:
+            break
+        for indexer in indexers:
+            indexer.line(pos, line)
+        pos += len(line)
+    return pos
+
+class NotebookIndex:
+    '''
+    Byte ranges of the pages and cells of a notebook file.
+
+    pages is a list of dicts with 'start' and 'end' offsets and 'cells', a list of dicts
+    with 'start', 'end' and 'cell_type'. Cell ranges include their tag line (tagged
+    format) or leading blank lines (prefix format). Offsets stay valid as long as the
+    file is changed only through this index.
+
+    '''
+    def __init__(self, tagged, pages, size, filename='<notebook>'):
+        self.tagged = tagged
+        self.pages = pages
+        self.size = size
+        self.filename = filename
+
+    def _read(self, f, start, end):
+        f.seek(start)
+        return f.read(end - start).decode('utf-8', errors='surrogateescape')
+
+    def _parse(self, text):
+        if self.tagged:
+            return parse_tagged(text, self.filename)
+        return parse_prefixed(text, self.filename)
+
+    def load_page(self, f, number):
+        ''' Parse only page number of file f, return its list of cells '''
+        page = self.pages[number]
+        cells = self._parse(self._read(f, page['start'], page['end']))
+        return cells[0] if cells else []
+
+    def read_cell(self, f, page, number):
+        ''' Parse only cell number of page, return cell dict '''
+        cell = self.pages[page]['cells'][number]
+        return self._parse(self._read(f, cell['start'], cell['end']))[0][0]
+
+    def _cell_text(self, cell):
+        sources = [cell['source']] + ([cell['user']] if isinstance(cell.get('user'), str) else [])
+        for source in sources:
+            for line in source.split('\n'):
+                if (self.tagged and _TAG.match(line)) or (not self.tagged and line in ('#---#', '#---page---#')):
+                    raise ValueError(f'Cell source cannot contain line {line!r} in this format')
+        if self.tagged:
+            return _tagged_cell_text(cell)
+        return _prefixed_cell_text(cell)
+
+    def rewrite_cell(self, f, page, number, cell):
+        """
+        Replace cell number of page in file f (opened 'r+b') with cell dict
+
+        Only the cell is written and the part of the file after it moved. In the prefix
+        format a cell changing between Python and Markdown can change the separators
+        around it, so its whole page is written instead.
+
+        """
+        entry = self.pages[page]
+        old = entry['cells'][number]
+        if self.tagged or old['cell_type'] == cell['cell_type']:
+            start, end = old['start'], old['end']
+            data = self._cell_text(cell)
+        else:
+            cells = self.load_page(f, page)
+            cells[number] = cell
+            for item in cells:
+                self._cell_text(item)
+            start, end = entry['start'], entry['end']
+            data = _unparse_prefixed_page(cells)
+        data = data.encode('utf-8', errors='surrogateescape')
+        delta = _replace(f, start, end, data, self.size)
+        self.size += delta
+        for later in self.pages[page + 1:]:
+            later['start'] += delta
+            later['end'] += delta
+            for item in later['cells']:
+                item['start'] += delta
+                item['end'] += delta
+        # Index the changed page again, only its part of the file is read
+        indexer = (_TaggedIndexer if self.tagged else _PrefixedIndexer)(self.filename, entry['start'])
+        indexer.finish_page(_feed(f, [indexer], entry['start'], entry['end'] + delta), 0)
+        if len(indexer.pages) != 1:
+            raise ParseError(f'{self.filename}: page {page} changed structure after rewriting cell')
+        entry['end'] += delta
+        entry['cells'] = indexer.pages[0]['cells']
+
+    def iter_pages(self, f):
+        ''' Yield list of cells of each page, parsing one page at a time '''
+        for number in range(len(self.pages)):
+            yield self.load_page(f, number)
+
+# Bytes moved at once when rewriting part of a file
+_CHUNK = 1024 * 1024
+
+def _replace(f, start, end, data, size):
+    # Replace bytes start to end of f with data, move the rest, return change in size
+    delta = len(data) - (end - start)
+    if delta > 0:
+        # Move rest of file back to front so nothing is overwritten before it is read
+        pos = size
+        while pos > end:
+            count = min(_CHUNK, pos - end)
+            pos -= count
+            f.seek(pos)
+            block = f.read(count)
+            f.seek(pos + delta)
+            f.write(block)
+    elif delta < 0:
+        pos = end
+        while pos < size:
+            count = min(_CHUNK, size - pos)
+            f.seek(pos)
+            block = f.read(count)
+            f.seek(pos + delta)
+            f.write(block)
+            pos += count
+        f.truncate(size + delta)
+    f.seek(start)
+    f.write(data)
+    f.flush()
+    return delta
+
+def index_file(f, filename='<notebook>'):
+    """
+    Read binary file object f line by line, return NotebookIndex of it
+
+    Tags are checked like parse does, a ParseError has the line number.
+
+    """
+    tagged = _TaggedIndexer(filename)
+    prefixed = _PrefixedIndexer(filename)
+    size = _feed(f, [tagged, prefixed])
+    for indexer in (tagged, prefixed):
+        indexer.finish_page(size, size)
+    # Tagged if any line started with a tag, like is_tagged
+    if tagged.saw_tag:
+        return NotebookIndex(True, tagged.pages, size, filename)
+    return NotebookIndex(False, prefixed.pages, size, filename)
+
+def index_path(path):
+    ''' Return NotebookIndex of notebook file at path '''
+    with open(path, 'rb') as f:
+        return index_file(f, path)
+
+def _check_digest(digest):
+    # Digests name files in the sidecar, anything else could point outside of it
+    if not isinstance(digest, str) or not _DIGEST.fullmatch(digest):
+        raise ValueError(f'Bad blob digest {digest!r}')
+
+def _verified(digest, data):
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f'Blob {digest} does not match its contents')
+    return data
+
+class BlobDirectory:
+    '''
+    Sidecar directory of blobs, one file per blob named by its sha256 digest.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def __contains__(self, digest):
+        _check_digest(digest)
+        return os.path.exists(os.path.join(self.path, digest))
+
+    def read(self, digest):
+        _check_digest(digest)
+        with open(os.path.join(self.path, digest), 'rb') as f:
+            return _verified(digest, f.read())
+
+    def write(self, digest, data):
+        _check_digest(digest)
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, digest)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def digests(self):
+        if not os.path.isdir(self.path):
+            return set()
+        return { name for name in os.listdir(self.path) if not name.endswith('.tmp') }
+
+class BlobArchive:
+    '''
+    Sidecar zip archive of blobs, one member per blob named by its sha256 digest.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._names = None
+
+    def _members(self):
+        if self._names is None:
+            self._names = set()
+            if os.path.exists(self.path):
+                with zipfile.ZipFile(self.path) as archive:
+                    self._names = set(archive.namelist())
+        return self._names
+
+    def __contains__(self, digest):
+        _check_digest(digest)
+        return digest in self._members()
+
+    def read(self, digest):
+        _check_digest(digest)
+        with zipfile.ZipFile(self.path) as archive:
+            return _verified(digest, archive.read(digest))
+
+    def write(self, digest, data):
+        _check_digest(digest)
+        # Appends, members already in the archive are never written again
+        members = self._members()
+        with zipfile.ZipFile(self.path, 'a') as archive:
+            archive.writestr(digest, data)
+        members.add(digest)
+
+    def digests(self):
+        return set(self._members())
+
+def sidecar(path, archive=None):
+    """
+    Return blob store next to notebook file at path
+
+    archive True is the zip archive, False the directory. None picks whichever exists,
+    the directory if neither does.
+
+    """
+    if archive is None:
+        archive = os.path.exists(path + '.blobs.zip') and not os.path.exists(path + '.blobs')
+    if archive:
+        return BlobArchive(path + '.blobs.zip')
+    return BlobDirectory(path + '.blobs')
+
+def _map_outputs(pages, function):
+    # New pages with function applied to every output, cells without outputs shared
+    result = []
+    for page in pages:
+        cells = []
+        for cell in page:
+            if cell.get('outputs'):
+                cell = dict(cell, outputs=[function(output) for output in cell['outputs']])
+            cells.append(cell)
+        result.append(cells)
+    return result
+
+def externalize(pages, blobs, min_bytes=BLOB_MIN, report=None):
+    """
+    Return pages with base64 outputs of at least min_bytes bytes moved into blobs
+
+    Blobs already in the store are not written again. If report is a dict, it is filled
+    in with the number of blobs 'written' and 'skipped' and 'bytes_written'.
+
+    """
+    counts = { 'written': 0, 'skipped': 0, 'bytes_written': 0 }
+    def move(output):
+        if output.get('encoding') != 'base64':
+            return output
+        content_type = _output_type(output)
+        data = base64.b64decode(output[content_type])
+        if len(data) < min_bytes:
+            return output
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in blobs:
+            counts['skipped'] += 1
+        else:
+            blobs.write(digest, data)
+            counts['written'] += 1
+            counts['bytes_written'] += len(data)
+        return dict(output, **{ content_type: digest, 'encoding': 'blob' })
+    result = _map_outputs(pages, move)
+    if report is not None:
+        report.update(counts)
+    return result
+
+def internalize(pages, blobs):
+    """
+    Return pages with blob outputs replaced by inline base64 data
+
+    Raises KeyError with the digest of a blob missing from blobs, ValueError for a
+    digest that is not a sha256 hex digest or a blob whose contents do not match it.
+
+    """
+    def inline(output):
+        if output.get('encoding') != 'blob':
+            return output
+        content_type = _output_type(output)
+        digest = output[content_type]
+        if digest not in blobs:
+            raise KeyError(digest)
+        data = blobs.read(digest)
+        return dict(output, **{ content_type: base64.b64encode(data).decode('ascii'), 'encoding': 'base64' })
+    return _map_outputs(pages, inline)
+
+def save_file(path, pages, external=False, archive=None, min_bytes=BLOB_MIN):
+    """
+    Write pages to notebook file at path in the tagged format, return report
+
+    With external True, binary outputs go to the sidecar blob store (see sidecar) and
+    the notebook only refers to them. Otherwise they are written inline, blob references
+    are inlined from the sidecar. Report is like the one of externalize.
+
+    """
+    report = { 'written': 0, 'skipped': 0, 'bytes_written': 0 }
+    blobs = sidecar(path, archive)
+    if external:
+        pages = externalize(pages, blobs, min_bytes, report)
+    else:
+        pages = internalize(pages, blobs)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(unparse(pages))
+    os.replace(path + '.tmp', path)
+    return report
+
+def load_file(path, inline=False):
+    ''' Parse notebook file at path, with blob outputs inlined from its sidecar if inline '''
+    pages = parse_file(path)
+    if inline:
+        pages = internalize(pages, sidecar(path))
+    return pages
+
+def convert_files(paths, external=True, archive=None, min_bytes=BLOB_MIN):
+    """
+    Convert notebook files between inline and external outputs, return dict of reports
+
+    Files in the prefix format are left unchanged.
+
+    """
+    reports = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        if is_tagged(text):
+            reports[path] = save_file(path, parse_tagged(text, path), external, archive, min_bytes)
+        else:
+            # Prefix format has no outputs, leave file as it is
+            reports[path] = { 'written': 0, 'skipped': 0, 'bytes_written': 0 }
+    return reports
+
+def test_parse():
+    ''' Both formats parse, tagged format round trips '''
+    text = '#% test id=setup\nimport pybook\n\n#%%\n# Title\n\n#% hidden\nx = 1\n#% end\nignored\n' + \
+        '#% page\n#% user language=text id=s1\nDefault\n\n#% submit\nprint(__input)\n'
+    pages = parse(text)
+    assert(pages == [
+        [
+            { 'cell_type': 'python', 'test': True, 'id': 'setup', 'source': 'import pybook' },
+            { 'cell_type': 'markdown', 'source': '# Title' },
+            { 'cell_type': 'python', 'hidden': True, 'source': 'x = 1' },
+        ],
+        [
+            { 'cell_type': 'python', 'submit': True, 'user': 'Default', 'language': 'text', 'id': 's1', 'source': 'print(__input)' },
+        ],
+    ])
+    assert(parse(unparse(pages)) == pages)
+    assert(parse('#m> # Title\n#m> more\n\nx = 5\n#---#\ny = 1\n#---page---#\nz = 2\n') == [
+        [
+            { 'cell_type': 'markdown', 'source': '# Title\nmore' },
+            { 'cell_type': 'python', 'source': 'x = 5' },
+            { 'cell_type': 'python', 'source': 'y = 1' },
+        ],
+        [ { 'cell_type': 'python', 'source': 'z = 2' } ],
+    ])
+    try:
+        parse('#% hidden hidden\n', 'nb.pbnb')
+        raise Exception('Did not get parse error as expected')
+    except ParseError as err:
+        assert(str(err).startswith('nb.pbnb:1 '))
+
+def test_index():
+    ''' Pages load alone, rewritten cells match a full parse and a fresh index '''
+    tagged = '# Header\n#% test id=setup\nimport pybook\n\n#%%\n# Title\n\n#% hidden\nx = 1\n#% end\nignored\n' + \
+        '#% page\n#% user language=text id=s1\nDefault\n\n#% submit\nprint(__input)\n#% output type=text/plain name=stdout\nhi\n#% end\n' + \
+        '#% page\n#% page\n#%\nlast = 1\n'
+    prefixed = '\n#m> # Title\n#m> more\n\nx = 5\n#---#\ny = 1\n#---page---#\nz = 2\n#m> after\n'
+    for text in (tagged, prefixed):
+        f = io.BytesIO(text.encode('utf-8'))
+        index = index_file(f)
+        pages = parse(text)
+        assert(index.tagged == is_tagged(text) and list(index.iter_pages(f)) == pages)
+        assert([len(page['cells']) for page in index.pages] == [len(page) for page in pages])
+        assert(index.load_page(f, 1) == pages[1] and index.read_cell(f, 0, 1) == pages[0][1])
+        for page, number, cell in (
+            (0, 1, { 'cell_type': 'markdown', 'source': '# A much longer title\n\nwith text' }),
+            (0, 0, { 'cell_type': 'python', 'source': 'y=2' }),
+            (1, 0, dict(pages[1][0], source='print("changed")')),
+            (0, 2, { 'cell_type': 'markdown', 'source': 'Now text' }),
+        ):
+            index.rewrite_cell(f, page, number, cell)
+            pages[page][number] = cell
+            assert(parse(f.getvalue().decode('utf-8')) == pages)
+            fresh = index_file(io.BytesIO(f.getvalue()))
+            assert(fresh.pages == index.pages and fresh.size == index.size == len(f.getvalue()))
+    try:
+        index.rewrite_cell(f, 0, 0, { 'cell_type': 'python', 'source': 'a\n#---page---#\nb' })
+        raise Exception('Did not get error for separator in source')
+    except ValueError:
+        pass
+    assert(parse(unparse_prefixed(pages)) == pages)
+
+def test_outputs():
+    ''' Outputs round trip inline and as blobs in a directory or archive '''
+    import shutil
+    import tempfile
+    png = bytes(range(256)) * 20
+    outputs = [
+        { 'name': 'stdout', 'text/plain': 'line\n\nno newline' },
+        { 'name': 'stderr', 'text/plain': '#% page\n' },
+        { 'text/html': '<b>x</b>\n' },
+        { 'image/png': base64.b64encode(png).decode('ascii'), 'encoding': 'base64' },
+        { 'image/png': base64.b64encode(b'tiny').decode('ascii'), 'encoding': 'base64' },
+    ]
+    pages = [[{ 'cell_type': 'python', 'source': 'x = 1', 'outputs': outputs }, { 'cell_type': 'markdown', 'source': 'Text' }]]
+    text = unparse(pages)
+    assert(parse(text) == pages and '#% output type=image/png encoding=base64\n' in text)
+    f = io.BytesIO(text.encode('utf-8'))
+    index = index_file(f)
+    assert(index.read_cell(f, 0, 0) == pages[0][0] and index.pages[0]['cells'][1]['start'] == text.index('#%%'))
+    directory = tempfile.mkdtemp()
+    try:
+        for archive in (False, True):
+            path = os.path.join(directory, f'nb{archive}.pbnb')
+            report = save_file(path, pages, external=True, archive=archive)
+            assert(report == { 'written': 1, 'skipped': 0, 'bytes_written': len(png) })
+            external = parse_file(path)
+            assert(external[0][0]['outputs'][3] == { 'image/png': hashlib.sha256(png).hexdigest(), 'encoding': 'blob' })
+            assert(external[0][0]['outputs'][4] == outputs[4] and os.path.getsize(path) < len(png))
+            # Saving again skips blob already stored
+            assert(save_file(path, load_file(path, inline=True), external=True)['skipped'] == 1)
+            assert(load_file(path, inline=True) == pages)
+            assert(convert_files([path], external=False)[path]['written'] == 0 and parse_file(path) == pages)
+        assert(os.path.exists(os.path.join(directory, 'nbFalse.pbnb.blobs')) and os.path.exists(os.path.join(directory, 'nbTrue.pbnb.blobs.zip')))
+        try:
+            internalize(external, BlobDirectory(os.path.join(directory, 'missing')))
+            raise Exception('Did not get error for missing blob')
+        except KeyError:
+            pass
+        # Digests cannot name files outside the sidecar, contents must match
+        with open(os.path.join(directory, 'secret.txt'), 'w') as f:
+            f.write('secret')
+        path = os.path.join(directory, 'nbFalse.pbnb')
+        for digest in ('../secret.txt', '0' * 64):
+            bad = [[{ 'cell_type': 'python', 'source': '', 'outputs': [{ 'image/png': digest, 'encoding': 'blob' }] }]]
+            with open(os.path.join(directory, 'nbFalse.pbnb.blobs', '0' * 64), 'wb') as f:
+                f.write(b'secret')
+            try:
+                internalize(bad, sidecar(path))
+                raise Exception('Did not get error for bad blob')
+            except ValueError:
+                pass
+        try:
+            parse('#%\nx\n#% output type=image/png encoding=blob\n../secret.txt\n#% end\n')
+            raise Exception('Did not get error for bad digest')
+        except ValueError as err:
+            assert('Bad blob digest' in str(err))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    test_parse()
+    test_index()
+    test_outputs()
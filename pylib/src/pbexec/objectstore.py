@@ -0,0 +1,260 @@
+"""
+
+Content-addressed store for the big buffers of checkpoint states.
+
+Checkpoints of a notebook are mostly the same: a big array loaded by the first cell is
+in every one of them, each time as its own copy. An ObjectStore keeps big buffers by
+content instead. save_state pickles the values of a state like snapshot.save_state does:
+one pickler for all keys (names sharing objects, at any depth, still share them after
+loading), protocol 5 with big buffers out-of-band (NumPy arrays, array.array values,
+bytes and bytearray values bound directly to a name), cell functions by value.
+
+Out-of-band buffers of at least min_bytes become blobs named by the sha256 digest of
+their contents: a blob is kept once however many states (or names) hold the same
+content, with a count of references to it. The pickle stream and smaller buffers are
+kept in the Checkpoint returned by save_state. Other values, however big, are part of
+the stream of each checkpoint.
+
+release(checkpoint) drops the references of a checkpoint, blobs no other checkpoint
+refers to are freed. load_state turns a checkpoint back into a state.
+
+Blobs are kept in memory (directory None) or as one file per blob in a directory. Files
+are mapped into memory when loaded, like snapshots.
+
+A checkpoint holds one reference to each blob it uses. Buffers with equal content are
+loaded as separate objects unless they were one object when saved.
+
+Only states saved here share their buffers. States still in memory (see StateStore) each
+keep their own copy until they are spilled, so deduplication only helps once a memory
+budget makes the StateStore spill.
+
+"""
+
+import hashlib
+import io
+import mmap
+import os
+
+from .snapshot import ALIGN, _StatePickler, _StateUnpickler, _wrap
+from .statecopy import INTERPRETER_KEYS
+
+# Blob files start with MAGIC padded to ALIGN bytes, then the raw buffer
+MAGIC = b'PBBLOB\x00\x02'
+# Out-of-band buffers of at least this many bytes are stored as shared blobs
+OBJECT_MIN = 64 * 1024
+
+class Checkpoint:
+    '''
+    State saved in an ObjectStore: pickle stream, digests of big buffers, small ones inline.
+
+    '''
+    __slots__ = ('stream', 'entries', 'buffers', 'released')
+    def __init__(self):
+        self.stream = b''
+        # List of (key, offset of its pickle in stream), in state order
+        self.entries = []
+        # Out-of-band buffers in pickle order, ('blob', digest, readonly) or
+        # ('inline', data, readonly)
+        self.buffers = []
+        self.released = False
+
+    def digests(self):
+        return list({ ref: None for kind, ref, readonly in self.buffers if kind == 'blob' })
+
+class ObjectStore:
+    '''
+    Blobs of raw buffers, one per distinct content, reference counted.
+
+    '''
+    def __init__(self, directory=None, min_bytes=OBJECT_MIN):
+        self.directory = directory
+        self.min_bytes = min_bytes
+        # Map from digest to contents for blobs in memory
+        self._blobs = {}
+        self._refs = {}
+        self._sizes = {}
+        self.puts = 0
+        self.hits = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.blob')
+
+    def _put(self, digest, raw):
+        # Add one reference to blob with this content, storing it if new
+        self.puts += 1
+        if digest in self._refs:
+            self._refs[digest] += 1
+            self.hits += 1
+            return
+        if self.directory is None:
+            self._blobs[digest] = bytes(raw)
+        else:
+            path = self._path(digest)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(MAGIC.ljust(ALIGN, b'\0'))
+                f.write(raw)
+            os.replace(path + '.tmp', path)
+        self._refs[digest] = 1
+        self._sizes[digest] = raw.nbytes
+
+    def _get(self, digest, readonly):
+        if self.directory is None:
+            data = self._blobs[digest]
+            # Writable buffers get their own copy, the blob may be loaded again
+            return data if readonly else bytearray(data)
+        with open(self._path(digest), 'rb') as f:
+            # Private mapping, writes to loaded arrays never reach the file
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        view = memoryview(mm)
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{self._path(digest)} is not a blob')
+        view = view[ALIGN:]
+        return view.toreadonly() if readonly else view
+
+    def _release(self, digest):
+        self._refs[digest] -= 1
+        if self._refs[digest] == 0:
+            del self._refs[digest]
+            del self._sizes[digest]
+            if self.directory is None:
+                del self._blobs[digest]
+            else:
+                os.unlink(self._path(digest))
+
+    def save_state(self, state, keys=None):
+        """
+        Add values of state (or only those of keys) to the store, return Checkpoint
+
+        Raises KeyError for the first key whose value cannot be pickled, the store is
+        left as it was.
+
+        """
+        checkpoint = Checkpoint()
+        raws = []
+        def add_buffer(buffer):
+            raws.append(buffer.raw())
+        stream = io.BytesIO()
+        pickler = _StatePickler(stream, state, add_buffer)
+        for key, value in dict.items(state):
+            if key in INTERPRETER_KEYS or (keys is not None and key not in keys):
+                continue
+            offset = stream.tell()
+            try:
+                pickler.dump(_wrap(value))
+            except Exception as err:
+                raise KeyError(key) from err
+            checkpoint.entries.append((key, offset))
+        checkpoint.stream = stream.getvalue()
+        # Everything pickled, only now add references
+        digests = set()
+        for raw in raws:
+            if raw.nbytes < self.min_bytes:
+                checkpoint.buffers.append(('inline', bytes(raw), raw.readonly))
+                continue
+            digest = hashlib.sha256(raw).hexdigest()
+            if digest not in digests:
+                self._put(digest, raw)
+                digests.add(digest)
+            checkpoint.buffers.append(('blob', digest, raw.readonly))
+        return checkpoint
+
+    def load_state(self, checkpoint, state=None):
+        """
+        Load values of checkpoint into state (a new dict if None), return it
+
+        """
+        if checkpoint.released:
+            raise ValueError('Checkpoint was released')
+        if state is None:
+            state = {}
+        buffers = []
+        for kind, ref, readonly in checkpoint.buffers:
+            if kind == 'blob':
+                buffers.append(self._get(ref, readonly))
+            else:
+                buffers.append(ref if readonly else bytearray(ref))
+        stream = io.BytesIO(checkpoint.stream)
+        unpickler = _StateUnpickler(stream, state, buffers)
+        for key, offset in checkpoint.entries:
+            stream.seek(offset)
+            dict.__setitem__(state, key, unpickler.load())
+        return state
+
+    def release(self, checkpoint):
+        ''' Drop references of checkpoint, freeing blobs no other checkpoint uses '''
+        if checkpoint.released:
+            return
+        for digest in checkpoint.digests():
+            self._release(digest)
+        checkpoint.released = True
+
+    def stats(self):
+        """
+        Return dictionary of sizes and counters
+
+        logical_bytes is what the blobs would take with one copy per reference,
+        physical_bytes what they take, dedup_ratio the first divided by the second.
+
+        """
+        logical = sum(self._sizes[digest] * refs for digest, refs in self._refs.items())
+        physical = sum(self._sizes.values())
+        return {
+            'blobs': len(self._refs),
+            'references': sum(self._refs.values()),
+            'logical_bytes': logical,
+            'physical_bytes': physical,
+            'dedup_ratio': logical / physical if physical else 1.0,
+            'puts': self.puts,
+            'hits': self.hits,
+        }
+
+def test_object_store():
+    ''' Same content is stored once, freed when the last checkpoint goes '''
+    import array
+    import tempfile
+    table = array.array('d', range(20000))
+    for directory in (None, tempfile.mkdtemp()):
+        store = ObjectStore(directory)
+        first = { 'table': table, 'same': table, 'blob': b'x' * 100000, 'n': 1, 'f': None }
+        exec('def f(v):\n    return v * n', first)
+        one = store.save_state(first)
+        # Equal content in another state, copied rather than shared
+        second = { 'table': array.array('d', table), 'other': b'y' * 100000, 'n': 2 }
+        two = store.save_state(second)
+        stats = store.stats()
+        assert(stats['blobs'] == 3 and stats['references'] == 4 and stats['hits'] == 1)
+        assert(1.4 < stats['dedup_ratio'] < 1.5)
+        loaded = store.load_state(one)
+        assert(loaded['table'] == table and loaded['same'] is loaded['table'] and loaded['table'] is not table)
+        assert(loaded['f'](3) == 3 and loaded['f'].__globals__ is loaded)
+        loaded['table'][0] = -1.0
+        assert(store.load_state(one)['table'][0] == 0.0)
+        store.release(one)
+        assert(store.stats()['blobs'] == 2 and store.load_state(two)['table'] == table)
+        store.release(two)
+        assert(store.stats()['blobs'] == 0 and store.stats()['dedup_ratio'] == 1.0)
+        if directory is not None:
+            assert(os.listdir(directory) == [])
+            os.rmdir(directory)
+    store = ObjectStore()
+    equal = store.save_state({ 'a': array.array('d', table), 'b': array.array('d', table) })
+    loaded = store.load_state(equal)
+    assert(loaded['a'] == loaded['b'] and loaded['a'] is not loaded['b'] and store.stats()['references'] == 1)
+    store.release(equal)
+    # Objects shared between names stay shared, whatever their size
+    row = [table, list(range(1000))]
+    aliased = store.save_state({ 'row': row, 'table': [row] * 10 })
+    loaded = store.load_state(aliased)
+    assert(loaded['table'][0] is loaded['row'] and loaded['table'][9] is loaded['row'] and loaded['row'][0] == table)
+    assert(store.stats()['blobs'] == 1)
+    store.release(aliased)
+    try:
+        store.save_state({ 'table': table, 'lock': __import__('threading').Lock() })
+        assert(False)
+    except KeyError as err:
+        assert(err.args == ('lock',) and store.stats()['blobs'] == 0)
+
+if __name__ == '__main__':
+    test_object_store()
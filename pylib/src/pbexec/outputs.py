@@ -0,0 +1,336 @@
+"""
+
+Bounded accumulator for the outputs of a cell.
+
+A runaway print loop produces output without end. Appending every write to the last
+output with `+=` copies the whole text each time and keeps all of it. OutputAccumulator
+keeps text as a list of chunks that are joined only when the outputs are read, and
+retains at most max_bytes characters per cell:
+
+    * the first head_bytes characters (the head) and the last tail_bytes characters
+      (the tail) are kept, everything between them is replaced by one elision marker,
+    * lines repeated more than max_repeats times in a row are counted instead of kept
+      and replaced by one marker line,
+    * after stop_bytes characters have been written the accumulator stops taking
+      output. add() returns False from then on, so the writer can stop formatting
+      output that would be dropped anyway (see WriteCustom in pbexec).
+
+Outputs are dicts like those sent to the notebook interface. Text outputs have 'name'
+('stdout' or 'stderr') and 'text/plain', consecutive text on the same channel is merged.
+Other outputs (HTML, images, ...) are kept whole or dropped whole, their size is the
+total length of their string values.
+
+The accumulator behaves like the list of outputs for reading and comparing.
+
+"""
+
+import collections
+
+# Default characters kept per cell
+MAX_BYTES = 1024 * 1024
+
+# Default identical lines in a row shown before the rest are counted
+MAX_REPEATS = 10
+
+# Incomplete lines longer than this are retained without checking for repeats
+MAX_LINE = 8192
+
+class _Item:
+    '''
+    Text of one channel (list of chunks) or one other output.
+
+    '''
+    __slots__ = ('channel', 'chunks', 'size', 'output')
+    def __init__(self, channel=None, output=None, size=0):
+        self.channel = channel
+        self.chunks = collections.deque()
+        self.size = size
+        self.output = output
+
+def _is_text(data):
+    return 'name' in data and 'text/plain' in data
+
+def _size(data):
+    return sum(len(value) for value in data.values() if isinstance(value, (str, bytes)))
+
+class OutputAccumulator:
+    '''
+    Outputs of a cell with retained size bounded by a head and a tail window.
+
+    '''
+    def __init__(self, max_bytes=MAX_BYTES, head_bytes=None, max_repeats=MAX_REPEATS, stop_bytes=None):
+        self.max_bytes = max_bytes
+        self.head_bytes = max_bytes // 2 if head_bytes is None else head_bytes
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.max_repeats = max_repeats
+        self.stop_bytes = 16 * max_bytes if stop_bytes is None else stop_bytes
+        self.clear()
+
+    def clear(self):
+        ''' Forget all outputs, start a new cell '''
+        self._head = []
+        self._head_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._spilled = False
+        # Characters and outputs dropped between head and tail
+        self.elided = 0
+        self.elided_outputs = 0
+        # Characters written in total, including dropped ones
+        self.written = 0
+        self.stopped = False
+        # Current line: channel, chunks of incomplete line, last complete line
+        self._channel = None
+        self._partial = []
+        self._partial_size = 0
+        self._last_line = None
+        self._repeats = 0
+        self.suppressed_lines = 0
+        self._suppressed = 0
+
+    def add(self, data):
+        """
+        Add output dict, return False if it was dropped because output stopped
+
+        """
+        if self.stopped:
+            return False
+        size = len(data['text/plain']) if _is_text(data) else _size(data)
+        self.written += size
+        if self.written > self.stop_bytes:
+            self.stopped = True
+            return False
+        if _is_text(data):
+            self._add_text(data['name'], data['text/plain'])
+        else:
+            self._end_line()
+            self._retain(_Item(output=data, size=size))
+        return True
+
+    def _add_text(self, channel, text):
+        if channel != self._channel:
+            self._end_line()
+            self._channel = channel
+        start = 0
+        while True:
+            end = text.find('\n', start)
+            if end < 0:
+                break
+            if self._partial:
+                self._partial.append(text[start:end + 1])
+                line = ''.join(self._partial)
+                self._partial = []
+                self._partial_size = 0
+            else:
+                line = text[start:end + 1]
+            self._add_line(line)
+            start = end + 1
+        if start < len(text):
+            self._partial.append(text[start:])
+            self._partial_size += len(text) - start
+            if self._partial_size > MAX_LINE:
+                # No newline coming, don't hold on to it
+                self._end_line()
+
+    def _add_line(self, line):
+        if line == self._last_line:
+            self._repeats += 1
+            if self._repeats >= self.max_repeats:
+                self._suppressed += 1
+                self.suppressed_lines += 1
+                return
+        else:
+            self._end_repeats()
+            self._last_line = line
+            self._repeats = 0
+        self._retain_text(self._channel, line)
+
+    def _repeat_marker(self):
+        return f'[previous line repeated {self._suppressed} more times]\n'
+
+    def _end_repeats(self):
+        if self._suppressed:
+            self._retain_text(self._channel, self._repeat_marker())
+            self._suppressed = 0
+
+    def _end_line(self):
+        # Output on another channel or other output, incomplete line is done
+        self._end_repeats()
+        if self._partial:
+            self._retain_text(self._channel, ''.join(self._partial))
+            self._partial = []
+            self._partial_size = 0
+        self._last_line = None
+        self._repeats = 0
+
+    def _retain_text(self, channel, text):
+        if not self._spilled:
+            room = self.head_bytes - self._head_size
+            if len(text) <= room:
+                self._append(self._head, channel, text)
+                self._head_size += len(text)
+                return
+            if room > 0:
+                self._append(self._head, channel, text[:room])
+                self._head_size += room
+                text = text[room:]
+            self._spilled = True
+        self._append(self._tail, channel, text)
+        self._tail_size += len(text)
+        self._trim()
+
+    def _append(self, items, channel, text):
+        if items and items[-1].channel == channel and items[-1].output is None:
+            item = items[-1]
+        else:
+            item = _Item(channel)
+            items.append(item)
+        item.chunks.append(text)
+        item.size += len(text)
+
+    def _retain(self, item):
+        if not self._spilled and self._head_size + item.size <= self.head_bytes:
+            self._head.append(item)
+            self._head_size += item.size
+            return
+        self._spilled = True
+        self._tail.append(item)
+        self._tail_size += item.size
+        self._trim()
+
+    def _trim(self):
+        # Drop oldest tail chunks until tail fits, every chunk is dropped at most once
+        while self._tail_size > self.tail_bytes:
+            excess = self._tail_size - self.tail_bytes
+            item = self._tail[0]
+            if item.output is not None or item.size <= excess:
+                self._tail.popleft()
+                self._tail_size -= item.size
+                self.elided += item.size
+                if item.output is not None:
+                    self.elided_outputs += 1
+                continue
+            while excess > 0:
+                chunk = item.chunks[0]
+                if len(chunk) <= excess:
+                    item.chunks.popleft()
+                    cut = len(chunk)
+                else:
+                    item.chunks[0] = chunk[excess:]
+                    cut = excess
+                item.size -= cut
+                self._tail_size -= cut
+                self.elided += cut
+                excess -= cut
+
+    def outputs(self):
+        ''' Return list of output dicts retained so far '''
+        result = []
+        def text(channel, chunks):
+            if result and _is_text(result[-1]) and result[-1]['name'] == channel:
+                result[-1]['text/plain'] += ''.join(chunks)
+            else:
+                result.append({ 'name': channel, 'text/plain': ''.join(chunks) })
+        def items(source):
+            for item in source:
+                if item.output is None:
+                    text(item.channel, item.chunks)
+                else:
+                    result.append(item.output)
+        items(self._head)
+        if self.elided:
+            channel = self._tail[0].channel if self._tail and self._tail[0].output is None else 'stdout'
+            newline = '' if not result or not _is_text(result[-1]) or result[-1]['text/plain'].endswith('\n') else '\n'
+            what = f'{self.elided} characters'
+            if self.elided_outputs:
+                what += f' and {self.elided_outputs} outputs'
+            text(channel, [f'{newline}[... {what} elided ...]\n'])
+        items(self._tail)
+        if self._suppressed:
+            text(self._channel, [self._repeat_marker()])
+        if self._partial:
+            text(self._channel, self._partial)
+        if self.stopped:
+            text(self._channel or 'stdout', [f'\n[output stopped after {self.stop_bytes} characters]\n'])
+        return result
+
+    def stats(self):
+        ''' Return dictionary of sizes and counters '''
+        return {
+            'written': self.written,
+            'retained': self._head_size + self._tail_size,
+            'elided': self.elided,
+            'elided_outputs': self.elided_outputs,
+            'suppressed_lines': self.suppressed_lines,
+            'stopped': self.stopped,
+        }
+
+    # Read like the list of outputs
+    def __iter__(self):
+        return iter(self.outputs())
+
+    def __len__(self):
+        return len(self.outputs())
+
+    def __getitem__(self, index):
+        return self.outputs()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, OutputAccumulator):
+            other = other.outputs()
+        return self.outputs() == other
+
+    def __repr__(self):
+        return repr(self.outputs())
+
+def test_output_accumulator():
+    ''' Head and tail kept, repeats collapsed, output stops at limit '''
+    acc = OutputAccumulator(max_bytes=100, head_bytes=40, max_repeats=3, stop_bytes=10000)
+    acc.add({ 'name': 'stdout', 'text/plain': 'Name: ' })
+    acc.add({ 'name': 'stdout', 'text/plain': 'Bob\n' })
+    acc.add({ 'text/html': '<b>x</b>' })
+    assert(acc == [{ 'name': 'stdout', 'text/plain': 'Name: Bob\n' }, { 'text/html': '<b>x</b>' }])
+    acc.clear()
+    for index in range(1000):
+        acc.add({ 'name': 'stdout', 'text/plain': f'line {index:03}\n' })
+    text = acc[0]['text/plain']
+    assert(len(acc) == 1 and text.startswith('line 000\nline 001\n') and text.endswith('line 998\nline 999\n'))
+    assert('[... 8900 characters elided ...]\n' in text and acc.stats()['retained'] == 100)
+    acc.clear()
+    for index in range(100):
+        acc.add({ 'name': 'stdout', 'text/plain': 'same\n' })
+    acc.add({ 'name': 'stderr', 'text/plain': 'done\n' })
+    assert(acc == [
+        { 'name': 'stdout', 'text/plain': 'same\n' * 3 + '[previous line repeated 97 more times]\n' },
+        { 'name': 'stderr', 'text/plain': 'done\n' },
+    ])
+    acc.clear()
+    results = [acc.add({ 'name': 'stdout', 'text/plain': 'x' * 99 + '\n' }) for index in range(200)]
+    assert(results.index(False) == 100 and acc.stopped)
+    assert(acc[-1]['text/plain'].endswith('[output stopped after 10000 characters]\n'))
+    acc = OutputAccumulator(max_bytes=100 * MAX_LINE)
+    for index in range(10 * MAX_LINE):
+        acc.add({ 'name': 'stdout', 'text/plain': 'ab' })
+    assert(acc[0]['text/plain'] == 'ab' * (10 * MAX_LINE) and len(acc._partial) < MAX_LINE)
+
+def test_backpressure():
+    ''' Cell printing without end stops formatting once output stopped '''
+    import asyncio
+    from . import headless
+    headless.install()
+    from .pbexec import wrapped_run_cell
+    original = headless.outputs
+    headless.outputs = OutputAccumulator(max_bytes=1000, stop_bytes=5000)
+    try:
+        state = {}
+        script = 'import sys\nn = 0\nwhile not sys.stdout.dropping:\n    n += 1\n    print("line", n)\nn'
+        asyncio.run(wrapped_run_cell(script, state, print_exception=False, propagate_exception=True))
+        outputs = headless.get_outputs()
+        assert(500 < state['n'] < 1000 and len(outputs) == 1)
+        assert(outputs[0]['text/plain'].endswith('[output stopped after 5000 characters]\n'))
+    finally:
+        headless.outputs = original
+
+if __name__ == '__main__':
+    test_output_accumulator()
+    test_backpressure()
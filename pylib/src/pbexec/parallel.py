@@ -0,0 +1,265 @@
+"""
+
+Run notebook pages in parallel on a pool of worker processes.
+
+Each page of a notebook starts from a fresh state, so pages are independent units of
+work unless they are linked by checkpoints: a page that uses a checkpoint must run in
+the same process after the page that saved it. Pages are grouped into units accordingly
+(plan_units) and units are spread over worker processes.
+
+Like with the sequential runner, all pages of a notebook run in one working directory.
+Pages with side effects (files, ...) as found by dataflow.analyze may depend on each
+other through it, they are kept in one unit in page order.
+
+Workers are long-lived, so interpreter startup and imports are paid once per worker, not
+once per notebook. A worker that crashes or takes longer than the timeout on a unit is
+killed and replaced, and the pages of that unit are reported as failed. Results come
+back in the same order as the sequential runner regardless of completion order.
+
+"""
+
+import asyncio
+import collections
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import tempfile
+import time
+
+from . import dataflow
+from . import headless
+from . import notebook
+from . import resultcache
+from . import runner
+
+def plan_units(pages):
+    """
+    Group page indices into units that can run independently
+
+    Pages that save and use the same checkpoint name end up in the same unit, so do all
+    pages with side effects. They may depend on each other through files, the working
+    directory or other state outside the interpreter that the analysis cannot see, so
+    they run one after another in page order and only pages without side effects run in
+    parallel. Returns list of lists of page indices, each in page order, units ordered
+    by first page.
+
+    """
+    parent = list(range(len(pages)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    savers = collections.defaultdict(list)
+    for index, page in enumerate(pages):
+        for cell in page:
+            if 'save' in cell:
+                savers[cell['save']].append(index)
+    for index, page in enumerate(pages):
+        for cell in page:
+            for saver in savers.get(cell.get('use'), []):
+                parent[find(index)] = find(saver)
+    effectful = [index for index, page in enumerate(pages) if dataflow.has_side_effects(cell['source'] for cell in page if runner.is_code(cell))]
+    for index in effectful[1:]:
+        parent[find(index)] = find(effectful[0])
+    units = collections.defaultdict(list)
+    for index in range(len(pages)):
+        units[find(index)].append(index)
+    return sorted(units.values())
+
+def _worker_main(conn):
+    # Loop in worker process: receive task, run it, send back result
+    headless.install()
+    from . import pbexec
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        conn.send(asyncio.run(_run_task(task, pbexec)))
+
+async def _run_task(task, pbexec):
+    func = pbexec.default_func if task['arrows'] else pbexec.show_value_noarrow
+    start = time.perf_counter()
+    if task['test']:
+        result = await runner.run_test_pages(task['pages'], task['workdir'])
+    else:
+        result_cache = None
+        if task['result_cache'] is not None:
+            result_cache = resultcache.ResultCache(task['result_cache'])
+        result = await runner.run_pages(task['pages'], func, task['workdir'], result_cache=result_cache)
+    return { 'result': result, 'seconds': time.perf_counter() - start }
+
+class _Worker:
+    '''
+    One worker process and the task it is currently running.
+
+    '''
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.task = None
+        self.started = None
+    def assign(self, task):
+        self.task = task
+        self.started = time.monotonic()
+        self.conn.send(task['payload'])
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        self.kill()
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+def _failure(task, kind, message, seconds):
+    # Result for unit whose worker crashed or hung, one failed entry per page
+    error = { 'id': None, 'index': None, 'outputs': [], 'seconds': seconds, 'exception': { 'type': kind, 'message': message } }
+    if task['payload']['test']:
+        return { 'result': [dict(error, passed=False, stdout='')], 'seconds': seconds }
+    return { 'result': [[error] for page in task['payload']['pages']], 'seconds': seconds }
+
+def run_parallel(paths, jobs=None, timeout=None, test=False, arrows=True, result_cache=None):
+    """
+    Run notebooks at paths on jobs worker processes, return list of results
+
+    Results have the same layout as runner.run_notebooks. Units taking longer than timeout
+    seconds are killed and reported with exception type 'Timeout', units whose worker
+    dies are reported with 'WorkerCrashed'. If result_cache is a directory, workers share
+    a resultcache.ResultCache in it. Each notebook gets one temporary working directory
+    shared by its units.
+
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    # Working directories are removed when all units are done
+    with contextlib.ExitStack() as workdirs:
+        return _run_units(workdirs, paths, jobs, timeout, test, arrows, result_cache)
+
+def _run_units(workdirs, paths, jobs, timeout, test, arrows, result_cache):
+    results = []
+    tasks = []
+    for path in paths:
+        result = { 'path': path, 'error': None, 'seconds': 0.0 }
+        results.append(result)
+        try:
+            pages = notebook.parse_file(path)
+        except (OSError, ValueError) as err:
+            result['error'] = runner.exception_info(err)
+            continue
+        if test:
+            # Test cells share one state across the whole notebook
+            result['tests'] = []
+            units = [list(range(len(pages)))]
+        else:
+            result['pages'] = [None] * len(pages)
+            units = plan_units(pages)
+        workdir = workdirs.enter_context(tempfile.TemporaryDirectory(prefix='pbnb_'))
+        for unit in units:
+            tasks.append({
+                'notebook': result,
+                'indices': unit,
+                'payload': { 'pages': [pages[i] for i in unit], 'test': test, 'arrows': arrows, 'result_cache': result_cache, 'workdir': workdir },
+            })
+    def finish(task, outcome):
+        result = task['notebook']
+        result['seconds'] += outcome['seconds']
+        if task['payload']['test']:
+            result['tests'] = outcome['result']
+        else:
+            for index, page in zip(task['indices'], outcome['result']):
+                result['pages'][index] = page
+    context = multiprocessing.get_context()
+    pending = collections.deque(tasks)
+    workers = [_Worker(context) for i in range(min(jobs, len(tasks)))]
+    try:
+        while pending or any(worker.task is not None for worker in workers):
+            for worker in workers:
+                if worker.task is None and pending:
+                    worker.assign(pending.popleft())
+            busy = [worker for worker in workers if worker.task is not None]
+            wait = None
+            if timeout is not None:
+                now = time.monotonic()
+                wait = max(0.0, min(worker.started + timeout - now for worker in busy))
+            multiprocessing.connection.wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy], wait)
+            for worker in busy:
+                elapsed = time.monotonic() - worker.started
+                failed = True
+                if worker.conn.poll():
+                    try:
+                        outcome = worker.conn.recv()
+                        failed = False
+                    except (EOFError, OSError):
+                        outcome = _failure(worker.task, 'WorkerCrashed', 'Worker process exited', elapsed)
+                elif not worker.process.is_alive():
+                    outcome = _failure(worker.task, 'WorkerCrashed', f'Worker process exited with code {worker.process.exitcode}', elapsed)
+                elif timeout is not None and elapsed >= timeout:
+                    outcome = _failure(worker.task, 'Timeout', f'Did not finish within {timeout} seconds', elapsed)
+                else:
+                    continue
+                finish(worker.task, outcome)
+                worker.task = None
+                if failed:
+                    # Replace dead or hung worker
+                    workers[workers.index(worker)] = _Worker(context)
+                    worker.kill()
+    finally:
+        for worker in workers:
+            worker.stop()
+    return results
+
+def test_plan_units():
+    ''' Pages linked by checkpoints stay together '''
+    pages = [
+        [{ 'cell_type': 'python', 'source': '', 'save': 'a' }],
+        [{ 'cell_type': 'python', 'source': '' }],
+        [{ 'cell_type': 'python', 'source': '', 'use': 'a', 'save': 'b' }],
+        [{ 'cell_type': 'python', 'source': '', 'use': 'b' }],
+        [{ 'cell_type': 'python', 'source': '' }],
+    ]
+    assert(plan_units(pages) == [[0, 2, 3], [1], [4]])
+    # Pages working with files stay together
+    pages[1][0]['source'] = 'with open("data.txt", "w") as f:\n    f.write("x")'
+    pages.append([
+        { 'cell_type': 'python', 'source': 'import pathlib\ndef load():\n    return pathlib.Path("data.txt").read_text()' },
+        { 'cell_type': 'python', 'source': 'text = load()' },
+    ])
+    assert(plan_units(pages) == [[0, 2, 3], [1, 5], [4]])
+
+def test_run_parallel():
+    ''' Crashing and hung pages do not affect the others '''
+    import tempfile
+    text = '#% save=s\nx = 1\n#% page\n#%\nimport os\nos._exit(3)\n#% page\n#%\nwhile True: pass\n' + \
+        '#% page\n#% use=s\nx + 1\n#% page\n#%\nprint("ok")\n'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'nb.pbnb')
+        with open(path, 'w') as f:
+            f.write(text)
+        # Later page reads file written by earlier page
+        files = os.path.join(directory, 'files.pbnb')
+        with open(files, 'w') as f:
+            f.write('#%\nwith open("f.txt", "w") as f:\n    f.write("hi")\n#% page\n#%\nx = 1\n#% page\n#%\nprint(open("f.txt").read())\n')
+        results = run_parallel([path, path, files], jobs=3, timeout=2)
+    assert(results.pop()['pages'][2][0]['outputs'] == [{ 'name': 'stdout', 'text/plain': 'hi\n' }])
+    for result in results:
+        pages = result['pages']
+        assert(pages[0][0]['exception'] is None)
+        assert(pages[1][0]['exception']['type'] == 'WorkerCrashed')
+        assert(pages[2][0]['exception']['type'] == 'Timeout')
+        assert(pages[3][0]['outputs'] == [{ 'name': 'stdout', 'text/plain': '→ 2\n' }])
+        assert(pages[4][0]['outputs'] == [{ 'name': 'stdout', 'text/plain': 'ok\n' }])
+
+if __name__ == '__main__':
+    test_plan_units()
+    test_run_parallel()
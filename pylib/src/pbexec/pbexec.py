@@ -8,24 +8,75 @@ Overwrites some system modules with notebook functionality.
 """
 
 import ast
+import asyncio
+import codecs
 import copy
 import contextlib
 import io
 import sys
-import tempfile
+import time
 import traceback
 
-def fresh_state():
+if not __package__:
+    # Run as a script (python pbexec.py), import the rest of the package relative to it
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'pbexec'
+
+from . import dataflow
+from .codecache import CodeCache, with_filename
+from .display import display
+from .history import EMPTY, History, get_history
+from .imports import resolver as import_resolver
+from .cowstate import CowState
+from .lazystate import LazyState
+from .sources import SourceRegistry
+from .snapshot import load_state, save_state
+from .scheduler import Scheduler
+from .objectstore import ObjectStore
+from .statestore import StateStore
+from .statecopy import copy_state
+from .templates import Template, templates
+from . import linecoverage as _linecoverage
+from . import timing as _timing
+
+def fresh_state(copy_on_write=False, template=None, lazy=False):
     """
     Generate fresh dictionary to be used for globals
 
+    If copy_on_write is True, the state is a CowState. Duplicating it shares values
+    with the duplicate instead of deep copying them, values are only copied when a
+    cell in one of the states looks them up.
+
+    If lazy is True, the state is a LazyState: copy-on-write, and values that cannot be
+    copied when a duplicate uses them become tombstones instead of errors.
+
+    If template is a templates.Template or the name of one defined with
+    templates.define, the state starts with a copy of what its setup script made
+    (modules are shared, mutable data is copied).
+
     """
+    if template is not None:
+        state = templates.resolve(template).fresh(copy_on_write or lazy)
+        return LazyState.from_state(state) if lazy else state
+    if lazy:
+        return LazyState()
+    if copy_on_write:
+        return CowState()
     return {}
 
-def duplicate_state(state):
+def duplicate_state(state, report=None, lazy=False):
     """
     Duplicate state so we can have divergence between states
-    
+
+    Copy-on-write states (see fresh_state) are duplicated in time proportional to the
+    number of keys. Any copying errors for them are raised when a cell uses the value.
+    Lazy states turn copying errors into tombstones, only using the name raises.
+
+    Other states are deep copied with one memo for the whole state, so names that refer
+    to the same object still refer to the same (copied) object in the duplicate. If report
+    is a dict, it is filled in with the copy strategy and time used for each key.
+
     Note that this requires all values in the state to be copyable by copy.deepcopy.
     If a class needs special handling to handle deep copying, then it needs to implement the
     __deepcopy__ method as specified in copy.deepcopy.
@@ -33,46 +84,69 @@ def duplicate_state(state):
     If the state contains values that are not pickleable then the deep copy will fail.
     This could be things like open files, locks, and other values that are designed
     to not be copyable. In this case duplicate_state will raise a KeyError for the
-    key in the state that produced the exception.
+    key in the state that produced the exception. With lazy True the duplicate is a
+    LazyState with tombstones for those keys instead.
 
     """
-    res = {}
-    for key, value in state.items():
-        try:
-            res[key] = copy.deepcopy(state[key])
-        except Exception as err:
-            raise KeyError(key)
-    return res
+    if lazy:
+        return LazyState.from_state(state, report)
+    if isinstance(state, CowState):
+        return state.duplicate()
+    return copy_state(state, report)
 
 def default_func(value):
     """
     Default function to call on evaluated values
 
-    Default behavior is to totally ignore None values, and to print arrow then repr of other values.
-    Could be improved to detect when values have IPython style rich repr
+    Default behavior is to totally ignore None values. Values with IPython style rich
+    repr (_repr_html_, _repr_png_, ...) are sent with pybook.output_content, see the
+    display module. Otherwise print arrow then repr of value.
 
     """
     if value is not None:
-        sys.stdout.write(f'→ {repr(value)}\n')
+        display.show(value, _show_arrow)
+
+def _show_arrow(value):
+    sys.stdout.write(f'→ {repr(value)}\n')
+
+def _show_repr(value):
+    sys.stdout.write(f'{repr(value)}\n')
 
 def show_value_noarrow(value):
     """
     Function to call on evaluated values to mimic Python REPL
 
-    Ignore None values, print repr of other values.
+    Ignore None values, show rich repr like default_func or print repr of other values.
 
     """
     if value is not None:
-        sys.stdout.write(f'{repr(value)}\n')
+        display.show(value, _show_repr)
+
+
+def _show_exception(exc_type, exc_value, exc_tb):
+    # The built-in excepthook reads source lines from disk, use traceback module
+    # instead so lines of cells registered in linecache are shown
+    if sys.excepthook is sys.__excepthook__:
+        traceback.print_exception(exc_type, exc_value, exc_tb)
+    else:
+        sys.excepthook(exc_type, exc_value, exc_tb)
 
+# Sources of cells kept in linecache for tracebacks and pdb
+cell_sources = SourceRegistry()
 
-async def run_cell(script, globals_=None, locals_=None, func=default_func, history=True, write=True, print_exception=True, propagate_exception=False, strip=1):
+# Compiled code objects for cells, shared by all states
+# Set cell_cache.directory to also keep them on disk across restarts
+cell_cache = CodeCache()
+
+async def run_cell(script, globals_=None, locals_=None, func=default_func, history=True, write=True, print_exception=True, propagate_exception=False, strip=1, cache=True, result_cache=None, cell_id=None, timing=None, profile=False, coverage=None):
     """
     Run script with given globals and locals environment
     
     Call func on each expression to do something with value (otherwise return values ignored).
-    If history is True, append script to __history in global state.
-    If write is True, write script to temporary file to help with debugging with pdb.
+    If history is True, append script (with cell_id if given) to the History in
+    __history of global state (see history.History).
+    If write is True, register script in cell_sources under a synthetic filename so
+    tracebacks, inspect and pdb can show the source (nothing is written to disk).
 
     This function is marked async because cells may include top-level asynchronous behavior.
     This function waits for user code with `await`.
@@ -86,7 +160,27 @@ async def run_cell(script, globals_=None, locals_=None, func=default_func, histo
 
     Strip is number of backtrace levels to strip off top to simplify backtraces.
 
+    If cache is True, compiled code is looked up in and stored to cell_cache so running
+    the same source again skips parsing and compiling.
+
+    If result_cache is a resultcache.ResultCache, a cell that already ran with the same
+    source and the same values of the globals it reads is not run again. The names it
+    bound are restored from the cache and its outputs are replayed.
+
+    If timing is a dict, it is filled in with the time spent in each phase of running
+    the cell and a table of time per top level statement (see timing module). If profile
+    is also True, the cell runs under cProfile and timing['profile'] lists the functions
+    taking the most time.
+
+    If coverage is a dict, it is filled in with the lines and branches of the cell that
+    ran (see linecoverage module). The result cache is not used then, the cell always
+    runs.
+
     """
+    start = time.perf_counter()
+    if timing is not None:
+        for name, value in _timing.new_timing().items():
+            timing.setdefault(name, value)
     if globals_ is None:
         globals_ = globals()
     if locals_ is None:
@@ -95,57 +189,199 @@ async def run_cell(script, globals_=None, locals_=None, func=default_func, histo
     if func is not None:
         globals_['__expr_callback'] = func
     # Append actual text passed to history (even if parsing etc. fails it is part of history)
-    globals_.setdefault('__history', []).append(script)
-    # Write file if specified
+    if history:
+        globals_['__history'] = get_history(globals_).append(script, cell_id)
+    # Register source if specified
     filename = '<eval>'
     if write:
-        tmpfile = tempfile.NamedTemporaryFile(mode='w+t', encoding='utf-8', prefix='cell_', delete=True)
-        tmpfile.write(script)
-        filename = tmpfile.name
-        tmpfile.flush()
-    try:
-        node = ast.parse(script, filename=filename, mode='exec')
-    except SyntaxError as err:
-        if print_exception:
-            exc_type, exc_value, exc_tb = sys.exc_info()
-            # Skip a few levels to simplify backtrace
-            for i in range(strip + 1):
-                exc_tb = exc_tb.tb_next
-            sys.excepthook(exc_type, exc_value.with_traceback(exc_tb), exc_tb)
-        if propagate_exception:
-            raise err
-        return
-    if func is not None:
-        # Replace all expressions with calls to __expr_callback to process values
-        statements = node.body
-        for index in range(len(statements)):
-            if isinstance(statements[index], ast.Expr):
-                value = node.body[index].value
-                node.body[index] = ast.Expr(ast.Call(ast.Name('__expr_callback', ast.Load()), args=[value], keywords=[]))
-        # Fill in line/col numbers for programmatically modified nodes
-        ast.fix_missing_locations(node)
+        filename = cell_sources.register(script)
+    result_key = None
+    if result_cache is not None and coverage is None:
+        result_key = result_cache.key(script, globals_, func)
+        if result_key is not None and result_cache.restore(result_key, globals_):
+            if timing is not None:
+                timing['total'] += time.perf_counter() - start
+            return
+    code = None
+    if cache:
+        key = cell_cache.key(script, func is not None, write, timing is not None)
+        code = cell_cache.get(key)
+    if code is None:
+        parse_start = time.perf_counter()
+        try:
+            node = ast.parse(script, filename=filename, mode='exec')
+        except SyntaxError as err:
+            if print_exception:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                # Skip a few levels to simplify backtrace
+                for i in range(strip + 1):
+                    exc_tb = exc_tb.tb_next
+                _show_exception(exc_type, exc_value.with_traceback(exc_tb), exc_tb)
+            if propagate_exception:
+                raise err
+            return
+        if func is not None:
+            # Replace all expressions with calls to __expr_callback to process values
+            statements = node.body
+            for index in range(len(statements)):
+                if isinstance(statements[index], ast.Expr):
+                    value = node.body[index].value
+                    node.body[index] = ast.Expr(ast.Call(ast.Name('__expr_callback', ast.Load()), args=[value], keywords=[]))
+            # Fill in line/col numbers for programmatically modified nodes
+            ast.fix_missing_locations(node)
+        if timing is not None:
+            _timing.instrument(node)
+            timing['parse'] += time.perf_counter() - parse_start
+    else:
+        # Cached code may have been compiled with a different filename
+        code = with_filename(code, filename)
     # Compile wrapped script, run wrapper definition
+    profiler = None
+    timer = None
+    cell_coverage = None
     try:
-        code = compile(node, filename=filename, mode='exec', flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
-        coro = eval(code, globals_, locals_)
-        if coro is not None:
-            await coro
+        if code is None:
+            compile_start = time.perf_counter()
+            code = compile(node, filename=filename, mode='exec', flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+            if cache:
+                cell_cache.put(key, code)
+            if timing is not None:
+                timing['compile'] += time.perf_counter() - compile_start
+        with contextlib.ExitStack() as stack:
+            if timing is not None:
+                timer = globals_[_timing.TIMER_NAME] = _timing.StatementTimer()
+                # Time in imports, output and input is not part of execute
+                waiting = timing['imports'] + timing['output'] + timing['input']
+                stack.enter_context(_timing.time_imports(timing))
+                if profile:
+                    profiler = _timing.new_profiler()
+                    stack.callback(profiler.disable)
+                    profiler.enable()
+                execute_start = time.perf_counter()
+            if coverage is not None:
+                cell_coverage = stack.enter_context(_linecoverage.CellCoverage(code))
+            if result_key is None:
+                coro = eval(code, globals_, locals_)
+                if coro is not None:
+                    await coro
+                display.flush()
+            else:
+                with result_cache.capture() as outputs:
+                    coro = eval(code, globals_, locals_)
+                    if coro is not None:
+                        await coro
+                    display.flush()
+                result_cache.store(result_key, script, globals_, outputs)
     except BaseException as err:
         if print_exception:
             exc_type, exc_value, exc_tb = sys.exc_info()
             for i in range(strip):
                 exc_tb = exc_tb.tb_next
-            sys.excepthook(exc_type, exc_value.with_traceback(exc_tb), exc_tb)
+            _show_exception(exc_type, exc_value.with_traceback(exc_tb), exc_tb)
         if propagate_exception:
             raise err
     finally:
+        # Values shown before an exception
+        display.flush()
+        if timer is not None:
+            end = time.perf_counter()
+            globals_.pop(_timing.TIMER_NAME, None)
+            waited = timing['imports'] + timing['output'] + timing['input'] - waiting
+            timing['execute'] += end - execute_start - waited
+            timing['statements'] = timer.table(end)
         sys.stdout.flush()
         sys.stderr.flush()
-        # Delete temporary named file if applicable
-        if write:
-            tmpfile.close()
+        if profiler is not None:
+            timing['profile'] = _timing.profile_stats(profiler)
+        if cell_coverage is not None:
+            coverage.update(cell_coverage.result())
+        if timing is not None:
+            timing['total'] += time.perf_counter() - start
     return
 
+async def rerun_cells(cells, globals_, func=default_func, checkpoint=None, print_exception=True, propagate_exception=False):
+    """
+    Bring state globals_ up to date with list of cell sources cells
+
+    Compares cells with __history of the state and only runs the cells whose inputs
+    changed (see dataflow.plan). If the analysis cannot be trusted, the state is rebuilt
+    instead: from a duplicate of checkpoint if its __history is a prefix of cells, or
+    else from a fresh state.
+
+    Returns report dict with 'mode' ('incremental' or 'restart'), 'reason', 'ran' (indices
+    of cells run), 'deleted' (names removed), 'error' (index of cell that raised or None)
+    and 'state', the state holding the result. 'state' is globals_ itself unless the
+    state was rebuilt.
+
+    After success __history of the state is cells, as if they had been run in order.
+    If a cell raises, the remaining cells are not run and __history records what was
+    actually run, so the next call will not trust the state for the changed cells.
+
+    """
+    history = get_history(globals_)
+    plan = dataflow.plan(history.sources(), cells)
+    # History the state has when done, prefixes of it are compared by digest
+    target = EMPTY.extend(cells)
+    state = globals_
+    start = 0
+    if plan['mode'] == 'restart':
+        checkpoint_history = None if checkpoint is None else get_history(checkpoint)
+        if checkpoint_history is not None and len(checkpoint_history) <= len(cells) and checkpoint_history.matches(target.prefix(len(checkpoint_history))):
+            state = duplicate_state(checkpoint)
+            start = len(checkpoint_history)
+        else:
+            state = fresh_state(copy_on_write=isinstance(globals_, CowState))
+        plan['run'] = list(range(start, len(cells)))
+    for name in plan['delete']:
+        state.pop(name, None)
+    report = { 'mode': plan['mode'], 'reason': plan['reason'], 'ran': [], 'deleted': plan['delete'], 'error': None, 'state': state }
+    for index in plan['run']:
+        report['ran'].append(index)
+        try:
+            await run_cell(cells[index], state, None, func, history=False, print_exception=print_exception, propagate_exception=True)
+        except BaseException as err:
+            report['error'] = index
+            if plan['mode'] == 'restart':
+                state['__history'] = target.prefix(index + 1)
+            else:
+                state['__history'] = get_history(state).extend(cells[i] for i in report['ran'])
+            if propagate_exception:
+                raise err
+            return report
+    state['__history'] = target
+    return report
+
+async def test_rerun_cells():
+    ''' Only cells depending on edited cell run again '''
+    state = fresh_state()
+    cells = ['a = 1', 'b = [2]', 'c = a * 10', 'b.append(3)\nd = len(b)']
+    report = await rerun_cells(cells, state, func=None)
+    assert(report['ran'] == [0, 1, 2, 3] and state['d'] == 2 and state['__history'] == cells)
+    cells[0] = 'a = 2'
+    report = await rerun_cells(cells, state, func=None)
+    assert(report['mode'] == 'incremental' and report['ran'] == [0, 2] and state['c'] == 20 and state['d'] == 2)
+    cells[1] = 'b = [4, 5]'
+    report = await rerun_cells(cells, state, func=None)
+    assert(report['ran'] == [1, 3] and state['b'] == [4, 5, 3] and state['d'] == 3)
+    # Cell updating a name in place cannot run again in the same state
+    cells[3] = 'b.append(6)\nd = len(b)'
+    checkpoint = fresh_state()
+    await rerun_cells(cells[:2], checkpoint, func=None)
+    report = await rerun_cells(cells, state, func=None, checkpoint=checkpoint)
+    assert(report['mode'] == 'restart' and report['ran'] == [2, 3] and report['state'] is not state)
+    assert(report['state']['b'] == [4, 5, 6] and checkpoint['b'] == [4, 5])
+    state = report['state']
+    cells.append('1 / 0')
+    report = await rerun_cells(cells, state, func=None, print_exception=False)
+    assert(report['error'] == 4 and state['__history'][-1] == '1 / 0')
+    # Argument changed in place by a called function
+    state = fresh_state()
+    cells = ['x = []', 'def add(l, v):\n    l.append(v)', 'add(x, 1)']
+    await rerun_cells(cells, state, func=None)
+    cells[2] = 'add(x, 2)'
+    report = await rerun_cells(cells, state, func=None)
+    assert(report['mode'] == 'restart' and report['state']['x'] == [2])
+
 async def test_run_cell():
     ''' Simple test cases for run_cell '''
     test='''x = 5; 12; x; x+=1; x'''
@@ -184,45 +420,251 @@ async def test_run_cell_assert():
     except AssertionError as e:
         pass
 
+async def test_run_cell_cache():
+    ''' Same source is only compiled once '''
+    state = fresh_state()
+    hits = cell_cache.hits
+    for i in range(3):
+        await run_cell('def f(): return 7\nz = f()', state, func=None)
+    assert(cell_cache.hits == hits + 2)
+    assert(state['z'] == 7)
+
 ##################
 # Things specific to pybook
 ##################
 
+class OutputBuffer:
+    '''
+    Coalesce writes going to several handlers, keeping order between handlers.
+
+    Pending text is sent to its handler when it reaches max_bytes characters or
+    max_lines newlines, when a write arrives more than max_delay seconds after the
+    last flush, when a write goes to a different handler, or on explicit flush().
+
+    Writes made while an event loop runs also start a timer on the loop that flushes
+    max_delay seconds later, for cells that print and then await. The timer cannot fire
+    while the cell computes without awaiting, time.sleep (see redefine_builtins) and
+    reading input flush first instead.
+
+    '''
+    def __init__(self, max_bytes=8192, max_lines=100, max_delay=0.05):
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.handler = None
+        self.pending = []
+        self.size = 0
+        self.lines = 0
+        self.last_flush = time.monotonic()
+        self._timer = None
+    def write(self, handler, data):
+        if handler is not self.handler:
+            # Keep interleaving between stdout and stderr
+            self.flush()
+            self.handler = handler
+        self.pending.append(data)
+        self.size += len(data)
+        self.lines += data.count('\n')
+        if self.size >= self.max_bytes or self.lines >= self.max_lines or time.monotonic() - self.last_flush >= self.max_delay:
+            return self.flush()
+        if self._timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return None
+            self._timer = loop.call_later(self.max_delay, self._timed_flush)
+    def _timed_flush(self):
+        self._timer = None
+        self.flush()
+    def flush(self):
+        ''' Send pending text, return result of handler (None if nothing was pending) '''
+        self.last_flush = time.monotonic()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return None
+        data = ''.join(self.pending)
+        # Reset before calling handler in case it raises (e.g. KeyboardInterrupt)
+        self.pending = []
+        self.size = 0
+        self.lines = 0
+        return self.handler(data)
+
 class WriteCustom:
     '''
     Helper class to line-buffer writes redirected from user cells.
 
+    If buffer is an OutputBuffer, writes are coalesced there before calling handler.
+
+    A handler returning False means output is no longer kept (see pbexec.outputs), then
+    dropping is set and later writes are ignored. Code producing expensive output can
+    check sys.stdout.dropping and skip it.
+
     '''
-    def __init__(self, handler):
+    def __init__(self, handler, buffer=None):
         self.handler = handler
+        self.buffer = buffer
+        self.dropping = False
     def write(self, data):
-        self.handler(data)
+        if self.dropping:
+            return len(data)
+        if self.buffer is None:
+            result = self.handler(data)
+        else:
+            result = self.buffer.write(self.handler, data)
+        if result is False:
+            self.dropping = True
+        return len(data)
     def isatty(self):
         return True
     def flush(self):
-        pass
+        if self.buffer is not None:
+            self.buffer.flush()
 
 class ReadCustom:
     '''
-    Helper class to line-buffer reads redirected from user cells.
+    Helper class to buffer reads redirected from user cells.
+
+    The handler returns None when no more input is available right now (end of what the
+    user entered), otherwise either a single byte value or a whole block of bytes. If
+    chunked is True the handler is called with the maximum number of bytes wanted and
+    may return a block (bytes, bytearray, memoryview, str, or a JS typed array).
+
+    A None from the handler with nothing buffered since the last None means EOF. The
+    frontend ends every submission with a None, the one right after a line that used up
+    everything buffered only ends that submission.
+
+    If output is given, it is flushed before waiting for input so prompts are shown.
 
     '''
-    def __init__(self, handler):
+    def __init__(self, handler, output=None, chunked=False, chunk_size=65536):
         self.handler = handler
-    def read(self):
-        s = bytearray()
-        c = self.handler()
-        if c is None:
-            return None
-        s.append(c)
-        return s.decode(encoding='utf-8')
-    def readline(self):
-        s = bytearray()
+        self.output = output
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        # Undecoded bytes from handler, and decoded text, returned up to _pos
+        self._raw = bytearray()
+        self._text = ''
+        self._pos = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # readline returned a whole line with nothing left over, the None ending its
+        # submission has not been read yet
+        self._line_done = False
+    def _next(self):
+        if self.output is not None:
+            self.output.flush()
+        if self.chunked:
+            return self.handler(self.chunk_size)
+        return self.handler()
+    def _fill(self):
+        # Get more input from handler, return False if handler had nothing
+        data = self._next()
+        if data is None and self._line_done:
+            # End of the submission the last line came from, wait for the next one
+            self._line_done = False
+            data = self._next()
+        self._line_done = False
+        if data is None:
+            return False
+        if isinstance(data, int):
+            self._raw.append(data)
+        elif isinstance(data, str):
+            self._decode()
+            self._text += data
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            self._raw += data
+        else:
+            # JsProxy of typed array
+            self._raw += data.to_bytes()
+        return True
+    def _decode(self, final=False):
+        # Move raw bytes to text, decoder keeps partial UTF-8 sequences for later
+        if self._raw or final:
+            self._text += self._decoder.decode(bytes(self._raw), final)
+            self._raw.clear()
+    def _available(self):
+        return len(self._text) - self._pos
+    def _take(self, n):
+        result = self._text[self._pos:self._pos + n]
+        self._pos += len(result)
+        # Drop returned text only once it is most of the buffer, keeps reads linear
+        if self._pos > len(self._text) // 2:
+            self._text = self._text[self._pos:]
+            self._pos = 0
+        return result
+    def read(self, n=-1):
+        """
+        Read up to n characters, or everything until EOF if n is negative
+
+        """
+        if n is None or n < 0:
+            # Keep reading until a None arrives with nothing new since the previous one
+            while True:
+                got = False
+                while self._fill():
+                    got = True
+                if not got:
+                    break
+            self._decode(final=True)
+            return self._take(self._available())
         while True:
-            c = self.handler()
-            if c is None:
-                return s.decode(encoding='utf-8')
-            s.append(c)
+            self._decode()
+            if self._available() >= n or not self._fill():
+                break
+        self._decode()
+        return self._take(n)
+    def readline(self, size=-1):
+        """
+        Read one line including newline, or what is available when input ends
+
+        If size is not negative, at most size characters are returned.
+
+        """
+        if size is None or size < 0:
+            size = None
+        # Text before start was already searched for a newline
+        start = self._pos
+        while True:
+            idx = self._text.find('\n', start)
+            if idx >= 0 and (size is None or idx < self._pos + size):
+                line = self._take(idx + 1 - self._pos)
+                self._line_done = not self._available() and not self._raw
+                return line
+            if size is not None and self._available() >= size:
+                return self._take(size)
+            start = len(self._text)
+            # Newline byte never appears inside a multibyte UTF-8 sequence, safe to search raw
+            if self._raw and (size is not None or b'\n' in self._raw):
+                self._decode()
+                if len(self._text) > start:
+                    continue
+            if not self._fill():
+                self._decode()
+                return self._take(self._available() if size is None else size)
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if hint is not None and 0 < hint <= total:
+                break
+        return lines
+    def __iter__(self):
+        return self
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+    def readable(self):
+        return True
+    def isatty(self):
+        return True
     def flush(self):
         pass
 
@@ -230,28 +672,118 @@ class redirect_stdin(contextlib._RedirectStream):
     ''' Redirect stdin '''
     _stream = "stdin"
 
-async def wrapped_run_cell(*args, **kwargs):
+def _flush_display_first(handler):
+    def wrapper(data):
+        display.flush()
+        return handler(data)
+    return wrapper
+
+async def wrapped_run_cell(*args, output_buffer=None, **kwargs):
     """
     Same interface as run_cell but wrap stdout, stdin, and stderr with pybook interface.
 
     Writing lines to stdout will call pybook.output_stdout, writing lines to stderr
     will call pybook.output_stderr.
+
+    If output_buffer is True or an OutputBuffer, writes are coalesced instead of calling
+    the pybook functions once per write. Everything pending is flushed before reading
+    input and when the cell finishes.
+
+    If a timing dict is passed, time spent in the pybook output and input functions is
+    counted as 'output' and 'input' instead of 'execute'.
     
     """
     import pybook
-    out = WriteCustom(pybook.output_stdout)
-    err = WriteCustom(pybook.output_stderr)
-    inp = ReadCustom(pybook.input_stdin)
-    with contextlib.redirect_stdout(out):
-        with contextlib.redirect_stderr(err):
-            with redirect_stdin(inp):
-                await run_cell(*args, **kwargs)
+    if output_buffer is True:
+        output_buffer = OutputBuffer()
+    output_stdout, output_stderr = pybook.output_stdout, pybook.output_stderr
+    if hasattr(pybook, 'input_stdin_chunk'):
+        input_stdin, chunked = pybook.input_stdin_chunk, True
+    else:
+        input_stdin, chunked = pybook.input_stdin, False
+    # Rich outputs of earlier values go out before later text
+    output_stdout = _flush_display_first(output_stdout)
+    output_stderr = _flush_display_first(output_stderr)
+    timing = kwargs.get('timing')
+    if timing is not None:
+        output_stdout = _timing.timed(output_stdout, timing, 'output')
+        output_stderr = _timing.timed(output_stderr, timing, 'output')
+        input_stdin = _timing.timed(input_stdin, timing, 'input')
+    out = WriteCustom(output_stdout, output_buffer)
+    err = WriteCustom(output_stderr, output_buffer)
+    inp = ReadCustom(input_stdin, output_buffer, chunked=chunked)
+    try:
+        with contextlib.redirect_stdout(out):
+            with contextlib.redirect_stderr(err):
+                with redirect_stdin(inp):
+                    await run_cell(*args, **kwargs)
+    finally:
+        if output_buffer is not None:
+            output_buffer.flush()
+
+def test_output_buffer():
+    ''' Writes are coalesced without reordering stdout and stderr '''
+    calls = []
+    buffer = OutputBuffer(max_bytes=10, max_lines=100, max_delay=1000)
+    out = WriteCustom(lambda data: calls.append(('out', data)), buffer)
+    err = WriteCustom(lambda data: calls.append(('err', data)), buffer)
+    out.write('a')
+    out.write('b')
+    assert(calls == [])
+    err.write('c')
+    out.write('0123456789')
+    assert(calls == [('out', 'ab'), ('err', 'c'), ('out', '0123456789')])
+    out.write('d')
+    out.flush()
+    assert(calls[-1] == ('out', 'd'))
+    # Output followed by a long wait goes out without another write
+    async def wait():
+        buffer.max_delay = 0.01
+        out.write('e')
+        await asyncio.sleep(0.1)
+        assert(calls[-1] == ('out', 'e') and buffer._timer is None)
+    asyncio.run(wait())
+
+def test_read_custom():
+    ''' Chunked and byte-at-a-time input give the same lines '''
+    data = 'héllo\nwörld\nlast'.encode('utf-8')
+    # Split block in the middle of a multibyte character
+    blocks = [data[:2], data[2:9], data[9:], None, None]
+    inp = ReadCustom(lambda n: blocks.pop(0), chunked=True)
+    assert(list(inp) == ['héllo\n', 'wörld\n', 'last'])
+    values = list(data) + [None, None]
+    inp = ReadCustom(lambda: values.pop(0))
+    assert(inp.readline() == 'héllo\n')
+    assert(inp.read(3) == 'wör')
+    assert(inp.read() == 'ld\nlast')
+    blocks = ['a\nb', None, 'c', None, None]
+    inp = ReadCustom(lambda n: blocks.pop(0), chunked=True)
+    assert(inp.read() == 'a\nbc')
+    # Submissions as sent by the frontend, an empty one is just a newline
+    values = [10, None, 120, None, 121, 10, None, None]
+    inp = ReadCustom(lambda: values.pop(0))
+    assert(inp.readline() == '\n' and inp.readline() == 'x' and inp.readline() == 'y\n' and inp.readline() == '')
+    # Size limits readline
+    blocks = ['abcdef\ngh', 'é\n'.encode('utf-8'), None, None]
+    inp = ReadCustom(lambda n: blocks.pop(0), chunked=True)
+    assert(inp.readline(4) == 'abcd' and inp.readline(10) == 'ef\n' and inp.readline(0) == '')
+    assert(inp.readline(3) == 'ghé' and inp.readline(5) == '\n' and inp.readline(2) == '')
+    # Many lines from one block take time linear in size
+    blocks = ['line\n' * 200000, None, None]
+    inp = ReadCustom(lambda n: blocks.pop(0), chunked=True)
+    start = time.perf_counter()
+    assert(sum(1 for line in inp) == 200000 and time.perf_counter() - start < 5)
 
 def redefine_builtins():
     import pybook
     # Wrap built-in module functions
     import time
-    time.sleep = pybook.sleep
+    def sleep(sec):
+        # Show pending output before blocking
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pybook.sleep(sec)
+    time.sleep = sleep
 
 def register_pickle():
     '''
@@ -365,6 +897,10 @@ if __name__ == '__main__':
     import asyncio
     asyncio.run(test_run_cell())
     asyncio.run(test_run_cell_assert())
+    asyncio.run(test_run_cell_cache())
+    asyncio.run(test_rerun_cells())
+    test_output_buffer()
+    test_read_custom()
     register_pickle()
     test_deepcopy()
 else:
@@ -0,0 +1,375 @@
+"""
+
+Persistent cache of cell results.
+
+Cells that load and preprocess data are run again and again with the same source and
+the same inputs, across sessions and grading runs. A ResultCache remembers what such a
+cell did: the values of the names it bound and the outputs it produced (stdout, stderr
+and rich content sent through pybook). Running the cell again with the same inputs
+restores the names and replays the outputs instead of executing the cell.
+
+The key of a cell is its source, the function used for expression values and a
+fingerprint of the values of the globals it reads (see dataflow.analyze). Functions read
+by the cell add the globals they refer to, so changing a helper's inputs changes the
+key. Bindings are stored as snapshots (see snapshot.save_state), together with the
+globals those functions mutate (a cell calling `add(1)` where add appends to `x` stores
+`x`) and the names the cell passes to calls (`add(h, 6)` or `heapq.heappush(h, 6)`
+stores `h`).
+
+Cells are not cached if:
+
+    * dataflow.analyze finds side effects or cannot analyze the cell,
+    * it uses a function of the state whose source cannot be found or analyzed,
+    * it passes names to a callee that is not in the state, not bound by the cell and
+      not a builtin,
+    * the cell opts out by containing a line `# pbexec: nocache`,
+    * a value it reads or binds cannot be pickled,
+    * the cell raises an exception.
+
+Entries live in a directory and the least recently used ones are removed when the total
+size goes over max_bytes.
+
+"""
+
+import contextlib
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import textwrap
+import types
+
+from . import dataflow
+from . import snapshot
+
+# Line in cell source that disables caching of the cell
+NOCACHE_PRAGMA = '# pbexec: nocache'
+
+class _Tee:
+    '''
+    Stream that records everything written to it and passes it on.
+
+    '''
+    def __init__(self, stream, name, outputs):
+        self.stream = stream
+        self.name = name
+        self.outputs = outputs
+    def write(self, data):
+        if self.outputs and self.outputs[-1][0] == self.name:
+            self.outputs[-1] = (self.name, self.outputs[-1][1] + data)
+        else:
+            self.outputs.append((self.name, data))
+        return self.stream.write(data)
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def _code_names(code):
+    # Global names used by code object and code objects nested in it
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+def _function_mutates(function):
+    # Global names function mutates, None if its source cannot be analyzed
+    try:
+        source = textwrap.dedent(inspect.getsource(function))
+    except (OSError, TypeError):
+        return None
+    info = dataflow.analyze(source)
+    if info.uncertain is not None:
+        return None
+    return set(info.mutates).union(*info.function_mutates.values())
+
+def _state_functions(value, state):
+    # Functions defined in state that calling value (or its methods) may run
+    if isinstance(value, types.MethodType):
+        value = value.__func__
+    if isinstance(value, types.FunctionType):
+        return [value] if value.__globals__ is state else []
+    functions = []
+    for cls in (value if isinstance(value, type) else type(value)).__mro__:
+        for attr in vars(cls).values():
+            if isinstance(attr, (staticmethod, classmethod)):
+                attr = attr.__func__
+            parts = [attr.fget, attr.fset, attr.fdel] if isinstance(attr, property) else [attr]
+            functions.extend(part for part in parts if isinstance(part, types.FunctionType) and part.__globals__ is state)
+    return functions
+
+def _closure(names, state):
+    # Add globals used by functions of state reachable from names to names, return set
+    # of globals those functions mutate, or None if the cell must not be cached
+    mutated = set()
+    todo = list(names)
+    while todo:
+        # Plain dict lookup, don't make copy-on-write states copy anything
+        value = dict.get(state, todo.pop())
+        if isinstance(value, types.ModuleType):
+            if value.__name__.split('.')[0] in dataflow.SIDE_EFFECT_MODULES:
+                return None
+            continue
+        for function in _state_functions(value, state):
+            function_mutates = _function_mutates(function)
+            if function_mutates is None:
+                return None
+            mutated |= function_mutates
+            for name in (_code_names(function.__code__) | function_mutates) - names:
+                names.add(name)
+                todo.append(name)
+    return mutated
+
+def _callees_known(info, state):
+    # True if every callee getting names as arguments is a builtin, code of the state
+    # that _closure analyzes, or code from outside the state. Code from outside can only
+    # reach the state through its arguments, and those are stored with the result.
+    for callee in info.call_arguments:
+        if callee not in state and callee not in info.binds:
+            return False
+    return True
+
+class ResultCache:
+    '''
+    Directory of cell results keyed by source and input values.
+
+    '''
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.evictions = 0
+
+    def inputs(self, script, state):
+        """
+        Return set of names whose values decide the result of script, or None if the
+        cell must not be cached
+
+        """
+        if any(line.strip() == NOCACHE_PRAGMA for line in script.split('\n')):
+            return None
+        info = dataflow.analyze(script)
+        if info.uncertain is not None or info.side_effects:
+            return None
+        if not _callees_known(info, state):
+            return None
+        names = set(info.reads | info.deferred | info.mutates | info.arguments)
+        # Follow functions defined in the state to the globals they use
+        if _closure(names, state) is None:
+            return None
+        if names & dataflow.SIDE_EFFECT_CALLS:
+            return None
+        return names
+
+    def key(self, script, state, func=None):
+        """
+        Return key for running script in state with func, or None if not cacheable
+
+        """
+        names = self.inputs(script, state)
+        if names is None:
+            self.uncacheable += 1
+            return None
+        try:
+            values = snapshot.fingerprint(state, names - dataflow.IGNORED_NAMES)
+        except KeyError:
+            self.uncacheable += 1
+            return None
+        func_name = None if func is None else f'{func.__module__}.{func.__qualname__}'
+        h = hashlib.sha256()
+        for part in (script, func_name, values):
+            h.update(repr(part).encode('utf-8', errors='surrogatepass'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + '.snap'), os.path.join(self.directory, key + '.out')
+
+    def restore(self, key, state):
+        """
+        If key is in cache, load bindings into state, replay outputs and return True
+
+        """
+        snap_path, out_path = self._paths(key)
+        try:
+            with open(out_path, 'rb') as f:
+                entry = pickle.load(f)
+            snapshot.load_state(snap_path, state)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            self.misses += 1
+            return False
+        for name in entry['deleted']:
+            state.pop(name, None)
+        # Mark entry as recently used
+        for path in (snap_path, out_path):
+            with contextlib.suppress(OSError):
+                os.utime(path)
+        self.hits += 1
+        _replay(entry['outputs'])
+        return True
+
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Context manager recording outputs while a cell runs, yields list of outputs
+
+        """
+        outputs = []
+        pybook = sys.modules.get('pybook')
+        patched = {}
+        def record(name, original):
+            def wrapper(*args):
+                outputs.append((name,) + args)
+                return original(*args)
+            return wrapper
+        if pybook is not None:
+            for name in ('output_content', 'output_text_content'):
+                if hasattr(pybook, name):
+                    patched[name] = getattr(pybook, name)
+                    setattr(pybook, name, record(name, patched[name]))
+            if hasattr(pybook, 'output_file'):
+                original = patched['output_file'] = pybook.output_file
+                def output_file(content_type, filename):
+                    # File might be gone when the result is replayed, keep its contents
+                    with open(filename, 'rb') as f:
+                        outputs.append(('output_content', content_type, f.read()))
+                    return original(content_type, filename)
+                pybook.output_file = output_file
+        with contextlib.redirect_stdout(_Tee(sys.stdout, 'stdout', outputs)), contextlib.redirect_stderr(_Tee(sys.stderr, 'stderr', outputs)):
+            try:
+                yield outputs
+            finally:
+                for name, original in patched.items():
+                    setattr(pybook, name, original)
+
+    def store(self, key, script, state, outputs):
+        """
+        Store bindings made by script in state and captured outputs under key
+
+        """
+        info = dataflow.analyze(script)
+        # Globals changed in place by functions the cell used and names passed to calls
+        # count as bound
+        mutated = _closure(set(info.reads | info.deferred | info.mutates | info.arguments | info.binds), state)
+        if mutated is None or not _callees_known(info, state):
+            self.uncacheable += 1
+            return False
+        names = (info.binds | info.mutates | info.arguments | mutated) - dataflow.IGNORED_NAMES
+        names = set(name for name in names if not isinstance(state.get(name), types.ModuleType))
+        snap_path, out_path = self._paths(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            snapshot.save_state(state, snap_path, keys=names)
+            entry = { 'outputs': outputs, 'deleted': sorted(name for name in names if name not in state) }
+            with open(out_path + '.tmp', 'wb') as f:
+                pickle.dump(entry, f, protocol=5)
+            os.replace(out_path + '.tmp', out_path)
+        except (OSError, KeyError, pickle.PicklingError, TypeError):
+            # Some value cannot be saved, just don't cache
+            self.uncacheable += 1
+            for path in (snap_path, out_path):
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+            return False
+        self._evict()
+        return True
+
+    def _evict(self):
+        # Remove least recently used entries until total size fits
+        entries = {}
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext in ('.snap', '.out'):
+                stat = os.stat(os.path.join(self.directory, name))
+                size, used = entries.get(key, (0, 0))
+                entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+        total = sum(size for size, used in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key][1]):
+            if total <= self.max_bytes:
+                break
+            for path in self._paths(key):
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+            total -= entries[key][0]
+            self.evictions += 1
+
+    def stats(self):
+        ''' Return dictionary of counters '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'uncacheable': self.uncacheable,
+            'evictions': self.evictions,
+        }
+
+def _replay(outputs):
+    # Send recorded outputs again in the same order
+    pybook = sys.modules.get('pybook')
+    for output in outputs:
+        name, args = output[0], output[1:]
+        if name == 'stdout':
+            sys.stdout.write(*args)
+        elif name == 'stderr':
+            sys.stderr.write(*args)
+        elif pybook is not None:
+            getattr(pybook, name)(*args)
+
+def test_result_cache():
+    ''' Second run with same inputs restores names and outputs without executing '''
+    import asyncio
+    import io
+    import tempfile
+    from .pbexec import run_cell
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory)
+        script = 'calls.append(1)\ntable = [v * scale(v) for v in data]\ndef total():\n    return sum(table)\nprint("built", len(table))\ndel tmp\n'
+        def run(state):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                asyncio.run(run_cell(script, state, func=None, result_cache=cache, propagate_exception=True))
+            return out.getvalue()
+        setup = 'calls = []\ndata = list(range(5))\nk = 2\ndef scale(v):\n    return k\ntmp = 1\n'
+        first = {}
+        asyncio.run(run_cell(setup, first, func=None))
+        assert(run(first) == 'built 5\n' and cache.misses == 1)
+        second = {}
+        asyncio.run(run_cell(setup, second, func=None))
+        second['calls'] = []
+        assert(run(second) == 'built 5\n' and cache.hits == 1)
+        # Not executed, values restored, functions rebound to new state
+        assert(second['table'] == first['table'] and second['calls'] == [1] and 'tmp' not in second)
+        assert(second['total']() == 20 and second['total'].__globals__ is second)
+        # Input read through a function changes the key
+        second['k'] = 3
+        second['tmp'] = 1
+        assert(run(second) == 'built 5\n' and second['table'][-1] == 12 and cache.hits == 1)
+        assert(cache.key('import os\nos.remove("x")', second) is None)
+        # Side effects hidden in a function
+        asyncio.run(run_cell('import os\ndef f():\n    os.remove("x")\n', second, func=None))
+        assert(cache.key('f()', second) is None)
+        assert(cache.key('x = 1  # pbexec: nocache', second) is not None)
+        assert(cache.key('x = 1\n# pbexec: nocache', second) is None)
+        # Globals changed by a called function are restored too
+        for state in (first, second):
+            asyncio.run(run_cell('x = []\ndef add(v):\n    x.append(v)\n', state, func=None))
+            asyncio.run(run_cell('add(1)', state, func=None, result_cache=cache))
+        assert(second['x'] == [1] and cache.hits == 2)
+        # Arguments changed in place are restored
+        for state in (first, second):
+            asyncio.run(run_cell('import heapq\nh = [5]\ndef push(l, v):\n    l.append(v)\n    x.append(v)\n', state, func=None))
+            asyncio.run(run_cell('push(h, 6)', state, func=None, result_cache=cache))
+            asyncio.run(run_cell('heapq.heappush(h, 7)', state, func=None, result_cache=cache))
+        assert(second['h'] == [5, 6, 7] and second['x'] == [1, 6] and cache.hits == 4)
+        assert(cache.key('unknown(h)', second) is None)
+        exec('def g():\n    pass', second)
+        assert(cache.key('g()', second) is None)
+        cache.max_bytes = 0
+        cache._evict()
+        assert(os.listdir(directory) == [])
+
+if __name__ == '__main__':
+    from .pbexec import register_pickle
+    register_pickle()
+    test_result_cache()
@@ -0,0 +1,280 @@
+"""
+
+Run PyBook notebooks from the command line without a browser.
+
+Every code cell of every page is evaluated with pbexec.wrapped_run_cell in CPython, with
+the headless stand-in installed as the `pybook` module. Each page starts from a fresh
+state, as in the notebook interface, unless it uses a checkpoint (see run_page). Results are written as JSON with the outputs,
+exception and wall time of each cell.
+
+With --test, the `test` cells are run instead. They share one state in which `__source`
+maps cell ids to cell sources and `__cell` maps cell ids to the parsed cells, like the
+testing mode of src/pybook_test.py.
+
+All notebooks are run in one interpreter, so hundreds of notebooks only pay for
+interpreter startup and imports once. With --jobs, pages are spread over a pool of
+worker processes instead (see pbexec.parallel).
+
+Usage:
+
+    python -m pbexec.runner notebooks/*.pbnb -o results.json
+
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+from . import headless
+from . import notebook
+from . import resultcache
+
+def exception_info(err):
+    ''' Return JSON friendly description of exception '''
+    return { 'type': type(err).__name__, 'message': str(err) }
+
+def is_code(cell):
+    ''' Return True if cell is a Python cell the runner executes (not a test or user cell) '''
+    return cell['cell_type'] == 'python' and not cell.get('test') and cell.get('user') is not True
+
+async def run_code_cell(cell, state, func, result_cache=None):
+    """
+    Run one code cell in state, return result dict
+
+    Cells tagged `nocache` never use result_cache.
+
+    """
+    from . import pbexec
+    headless.reset_outputs()
+    if cell.get('submit'):
+        state['__input'] = cell.get('user', '')
+    exception = None
+    start = time.perf_counter()
+    try:
+        # Print exception so traceback shows up in outputs like in the browser, but also
+        # propagate it so we can record it
+        if cell.get('nocache'):
+            result_cache = None
+        await pbexec.wrapped_run_cell(cell['source'], state, None, func, print_exception=True, propagate_exception=True, result_cache=result_cache)
+    except KeyboardInterrupt:
+        raise
+    except BaseException as err:
+        exception = exception_info(err)
+    seconds = time.perf_counter() - start
+    return {
+        'id': cell.get('id'),
+        'outputs': headless.get_outputs(),
+        'exception': exception,
+        'seconds': seconds,
+    }
+
+async def run_page(page, func, checkpoints=None, result_cache=None):
+    """
+    Run code cells of one page, return list of cell results
+
+    The page starts from a fresh state. A cell with `use=NAME` runs in a duplicate of
+    checkpoint NAME instead of the current state, a cell with `save=NAME` stores a duplicate
+    of the state after it runs as checkpoint NAME. Checkpoints are kept in the dict
+    checkpoints so later pages can use them.
+
+    """
+    from . import pbexec
+    if checkpoints is None:
+        checkpoints = {}
+    state = pbexec.fresh_state()
+    results = []
+    for index, cell in enumerate(page):
+        if not is_code(cell):
+            continue
+        if 'use' in cell:
+            if cell['use'] not in checkpoints:
+                results.append({
+                    'id': cell.get('id'), 'index': index, 'outputs': [], 'seconds': 0.0,
+                    'exception': { 'type': 'KeyError', 'message': f"No saved checkpoint named '{cell['use']}'" },
+                })
+                continue
+            state = pbexec.duplicate_state(checkpoints[cell['use']])
+        result = await run_code_cell(cell, state, func, result_cache)
+        result['index'] = index
+        results.append(result)
+        if 'save' in cell:
+            checkpoints[cell['save']] = pbexec.duplicate_state(state)
+    return results
+
+async def run_pages(pages, func, workdir=None, result_cache=None):
+    """
+    Run pages in order sharing checkpoints, return list of page results
+
+    Cells run with workdir as current directory (a fresh temporary directory if None).
+
+    """
+    checkpoints = {}
+    olddir = os.getcwd()
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix='pbnb_'))
+        os.chdir(workdir)
+        try:
+            return [await run_page(page, func, checkpoints, result_cache) for page in pages]
+        finally:
+            os.chdir(olddir)
+
+async def run_tests(pages):
+    """
+    Run test cells of notebook in one shared state, return list of test results
+
+    """
+    from . import pbexec
+    cells = {}
+    for page in pages:
+        for cell in page:
+            if is_code(cell) and 'id' in cell:
+                cells[cell['id']] = cell
+    state = pbexec.fresh_state()
+    state['__source'] = { key: cell['source'] for key, cell in cells.items() }
+    state['__cell'] = cells
+    results = []
+    for page in pages:
+        for cell in page:
+            if cell['cell_type'] != 'python' or not cell.get('test'):
+                continue
+            out = io.StringIO()
+            exception = None
+            start = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                    await pbexec.run_cell(cell['source'], state, None, None, print_exception=False, propagate_exception=True)
+            except KeyboardInterrupt:
+                raise
+            except BaseException as err:
+                exception = exception_info(err)
+            results.append({
+                'id': cell.get('id'),
+                'passed': exception is None,
+                'exception': exception,
+                'stdout': out.getvalue(),
+                'seconds': time.perf_counter() - start,
+            })
+    return results
+
+async def run_test_pages(pages, workdir=None):
+    ''' Same as run_tests but in workdir (a fresh temporary directory if None) '''
+    olddir = os.getcwd()
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix='pbnb_'))
+        os.chdir(workdir)
+        try:
+            return await run_tests(pages)
+        finally:
+            os.chdir(olddir)
+
+async def run_notebook(path, test=False, func=None, workdir=None, result_cache=None):
+    """
+    Parse and run one notebook file, return result dict
+
+    Cells run with workdir as current directory (a fresh temporary directory if None).
+
+    """
+    result = { 'path': path, 'error': None }
+    start = time.perf_counter()
+    try:
+        pages = notebook.parse_file(path)
+    except (OSError, ValueError) as err:
+        result['error'] = exception_info(err)
+        result['seconds'] = time.perf_counter() - start
+        return result
+    if test:
+        result['tests'] = await run_test_pages(pages, workdir)
+    else:
+        result['pages'] = await run_pages(pages, func, workdir, result_cache)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def summarize(results):
+    ''' Return summary counts for list of notebook results '''
+    summary = { 'notebooks': len(results), 'cells': 0, 'errors': 0, 'seconds': 0.0 }
+    for result in results:
+        summary['seconds'] += result['seconds']
+        if result['error'] is not None:
+            summary['errors'] += 1
+        for cell in [cell for page in result.get('pages', []) for cell in page] + result.get('tests', []):
+            summary['cells'] += 1
+            if cell['exception'] is not None:
+                summary['errors'] += 1
+    return summary
+
+def find_notebooks(paths):
+    ''' Expand directories in paths to the .pbnb files they contain '''
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend(os.path.join(root, name) for name in sorted(files) if name.endswith('.pbnb'))
+        else:
+            found.append(path)
+    return found
+
+async def run_notebooks(paths, test=False, arrows=True, workdir=None, result_cache=None):
+    ''' Run all notebooks in order, return list of results '''
+    headless.install()
+    from . import pbexec
+    func = pbexec.default_func if arrows else pbexec.show_value_noarrow
+    return [await run_notebook(path, test=test, func=func, workdir=workdir, result_cache=result_cache) for path in paths]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pbexec-run', description='Run PyBook notebooks without a browser')
+    parser.add_argument('notebooks', nargs='+', help='.pbnb files or directories containing them')
+    parser.add_argument('-o', '--output', default='-', help='results JSON file (default stdout)')
+    parser.add_argument('--test', action='store_true', help='run test cells instead of code cells')
+    parser.add_argument('--no-arrows', action='store_true', help='show values like the Python REPL')
+    parser.add_argument('--workdir', default=None, help='directory to run cells in (default fresh temporary directory per notebook)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes, 0 for one per core (default 1, run in this process)')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds before a page is killed (needs --jobs other than 1)')
+    parser.add_argument('--result-cache', default=None, metavar='DIR', help='reuse results of cells that ran before with the same inputs, kept in DIR')
+    args = parser.parse_args(argv)
+    paths = find_notebooks(args.notebooks)
+    if args.jobs == 1:
+        result_cache = None
+        if args.result_cache is not None:
+            result_cache = resultcache.ResultCache(args.result_cache)
+        results = asyncio.run(run_notebooks(paths, test=args.test, arrows=not args.no_arrows, workdir=args.workdir, result_cache=result_cache))
+    else:
+        from . import parallel
+        results = parallel.run_parallel(paths, jobs=args.jobs or None, timeout=args.timeout, test=args.test, arrows=not args.no_arrows, result_cache=args.result_cache)
+    report = { 'notebooks': results, 'summary': summarize(results) }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+    return 1 if report['summary']['errors'] else 0
+
+def test_runner():
+    ''' Run small notebook in both modes '''
+    text = '#% id=a\nx = 40\nprint("hi")\nx + 2\n\n#% test\n' + \
+        'import pybook\nstate = pybook.fresh_state()\npybook.sync_exec(__source["a"], state=state)\n' + \
+        'pybook.assertEqual(pybook.get_outputs(), [{"name": "stdout", "text/plain": "hi\\n→ 42\\n"}])\n' + \
+        '#% page\n1 / 0\n'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'nb.pbnb')
+        with open(path, 'w') as f:
+            f.write(text.replace('#% page\n1 / 0', '#% page\n#%\n1 / 0'))
+        results = asyncio.run(run_notebooks([path]))
+        pages = results[0]['pages']
+        assert(pages[0][0]['outputs'] == [{ 'name': 'stdout', 'text/plain': 'hi\n→ 42\n' }])
+        assert(pages[1][0]['exception']['type'] == 'ZeroDivisionError')
+        assert(summarize(results)['errors'] == 1)
+        results = asyncio.run(run_notebooks([path], test=True))
+        assert([test['passed'] for test in results[0]['tests']] == [True])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""
+
+Run cells of several states concurrently on one event loop.
+
+run_cell is async, so a cell that awaits (asyncio.sleep, network, input) lets other
+code run meanwhile. A Scheduler takes cells for any number of states and runs them
+concurrently: cells of different states interleave whenever user code awaits, cells of
+the same state run one after the other in the order they were submitted.
+
+Each submitted cell gets a CellHandle to wait for it, cancel it or read its outputs.
+Cells may have a timeout, after which they are cancelled. Lanes (one per state) yield
+to each other between cells and a limit on running cells is granted first come first
+served, so a state with many queued cells does not starve the others.
+
+stdout and stderr are captured per cell. contextlib.redirect_stdout replaces the one
+process wide sys.stdout, so output of concurrently running cells would mix. Instead,
+while cells run, sys.stdout and sys.stderr are streams that look up the cell being run
+in a context variable. Every asyncio task has its own copy of the context, so writes
+land in the handle of the cell that made them. Writes from outside any cell go to the
+original streams.
+
+"""
+
+import asyncio
+import collections
+import contextvars
+import os
+import sys
+import time
+import traceback
+
+# Handle of the cell running in the current context
+_current_cell = contextvars.ContextVar('pbexec_current_cell', default=None)
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class _ContextStream:
+    '''
+    Stream writing to the cell of the current context, or to the original stream.
+
+    '''
+    def __init__(self, name, original):
+        self.name = name
+        self.original = original
+    def write(self, data):
+        cell = _current_cell.get()
+        if cell is None:
+            return self.original.write(data)
+        cell._write(self.name, data)
+        return len(data)
+    def flush(self):
+        if _current_cell.get() is None:
+            self.original.flush()
+    def isatty(self):
+        return False
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+class CellHandle:
+    '''
+    One submitted cell: its status, captured outputs and result.
+
+    Status is 'pending', 'running', 'done', 'error' (exception in exception
+    attribute), 'cancelled' or 'timeout'.
+
+    '''
+    def __init__(self, scheduler, script, state, key, timeout, kwargs):
+        self.scheduler = scheduler
+        self.script = script
+        self.state = state
+        self.key = key
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.status = 'pending'
+        self.exception = None
+        self.seconds = 0.0
+        self._chunks = { 'stdout': [], 'stderr': [] }
+        self._task = None
+        self._cancel_requested = False
+        self._finished = asyncio.get_running_loop().create_future()
+
+    def _write(self, name, data):
+        self._chunks[name].append(data)
+        if self.scheduler.on_output is not None:
+            self.scheduler.on_output(self, name, data)
+
+    @property
+    def stdout(self):
+        return ''.join(self._chunks['stdout'])
+
+    @property
+    def stderr(self):
+        return ''.join(self._chunks['stderr'])
+
+    def done(self):
+        return self._finished.done()
+
+    def cancel(self):
+        """
+        Cancel cell, return False if it already finished
+
+        A pending cell is removed from its queue, a running cell gets CancelledError at
+        its current await.
+
+        """
+        if self.done():
+            return False
+        self._cancel_requested = True
+        if self._task is not None:
+            self._task.cancel()
+        else:
+            self.scheduler._queues[self.key].remove(self)
+            self._finish('cancelled')
+        return True
+
+    def _finish(self, status, exception=None):
+        self.status = status
+        self.exception = exception
+        if not self._finished.done():
+            self._finished.set_result(self)
+
+    def __await__(self):
+        return asyncio.shield(self._finished).__await__()
+
+    def __repr__(self):
+        return f'<CellHandle {self.status} {self.script[:20]!r}>'
+
+class Scheduler:
+    '''
+    Runs cells concurrently across states, in order within each state.
+
+    '''
+    def __init__(self, states=None, func=None, timeout=None, max_running=None, on_output=None):
+        from . import pbexec
+        self._pbexec = pbexec
+        # Named states, missing names get a fresh state
+        self.states = {} if states is None else states
+        self.func = pbexec.default_func if func is None else func
+        # Default timeout in seconds for each cell, None for no limit
+        self.timeout = timeout
+        self.on_output = on_output
+        self._running = None if max_running is None else asyncio.Semaphore(max_running)
+        self._queues = {}
+        self._lanes = {}
+        # Cell running in each lane
+        self._current = {}
+        self._streams = None
+
+    def _resolve(self, state):
+        # Return (state dict, lane key) for a state name or state dict
+        if isinstance(state, str):
+            if state not in self.states:
+                self.states[state] = self._pbexec.fresh_state()
+            return self.states[state], ('name', state)
+        return state, ('id', id(state))
+
+    def submit(self, script, state, timeout=None, **kwargs):
+        """
+        Queue script to run in state (name in states or a state dict), return CellHandle
+
+        Must be called from a coroutine running on the scheduler's event loop. kwargs are
+        passed to run_cell (e.g. cell_id). timeout overrides the scheduler's default.
+
+        """
+        state, key = self._resolve(state)
+        handle = CellHandle(self, script, state, key, self.timeout if timeout is None else timeout, kwargs)
+        self._queues.setdefault(key, collections.deque()).append(handle)
+        if key not in self._lanes:
+            self._lanes[key] = asyncio.get_running_loop().create_task(self._lane(key))
+        return handle
+
+    async def run(self, cells):
+        """
+        Submit (script, state) pairs and wait for all of them, return list of handles
+
+        """
+        handles = [self.submit(script, state) for script, state in cells]
+        for handle in handles:
+            await handle
+        return handles
+
+    async def join(self):
+        ''' Wait until all submitted cells have finished '''
+        while self._lanes:
+            await asyncio.gather(*self._lanes.values(), return_exceptions=True)
+
+    def cancel_all(self):
+        for queue in list(self._queues.values()):
+            for handle in list(queue):
+                handle.cancel()
+        for handle in list(self._current.values()):
+            handle.cancel()
+
+    def _install_streams(self):
+        if self._streams is None:
+            self._streams = (sys.stdout, sys.stderr)
+            sys.stdout = _ContextStream('stdout', sys.stdout)
+            sys.stderr = _ContextStream('stderr', sys.stderr)
+
+    def _restore_streams(self):
+        if self._streams is not None and not self._lanes:
+            sys.stdout, sys.stderr = self._streams
+            self._streams = None
+
+    async def _lane(self, key):
+        # Run cells of one state in order
+        queue = self._queues[key]
+        self._install_streams()
+        try:
+            while queue:
+                handle = queue.popleft()
+                if self._running is not None:
+                    await self._running.acquire()
+                try:
+                    self._current[key] = handle
+                    await self._run(handle)
+                finally:
+                    del self._current[key]
+                    if self._running is not None:
+                        self._running.release()
+                # Let other lanes start their next cell before this one does
+                await asyncio.sleep(0)
+        finally:
+            del self._lanes[key]
+            if not queue:
+                del self._queues[key]
+            self._restore_streams()
+
+    async def _execute(self, handle):
+        _current_cell.set(handle)
+        await self._pbexec.run_cell(handle.script, handle.state, func=self.func, print_exception=False, propagate_exception=True, **handle.kwargs)
+
+    async def _run(self, handle):
+        handle.status = 'running'
+        start = time.perf_counter()
+        # Cell runs in its own task (with its own copy of the context), so it can be
+        # cancelled alone
+        handle._task = asyncio.get_running_loop().create_task(self._execute(handle))
+        try:
+            await asyncio.wait_for(handle._task, handle.timeout)
+        except asyncio.TimeoutError:
+            handle._finish('timeout')
+        except asyncio.CancelledError:
+            if not handle._cancel_requested:
+                # Scheduler itself is being cancelled
+                handle._finish('cancelled')
+                raise
+            handle._finish('cancelled')
+        except Exception as err:
+            handle._chunks['stderr'].append(_format_exception(err))
+            handle._finish('error', err)
+        else:
+            handle._finish('done')
+        finally:
+            handle.seconds = time.perf_counter() - start
+
+def _format_exception(err):
+    # Traceback starting after the last frame of pbexec itself, like run_cell prints it
+    tb = start = err.__traceback__
+    while tb is not None:
+        if os.path.dirname(os.path.abspath(tb.tb_frame.f_code.co_filename)) == _PACKAGE_DIR:
+            start = tb.tb_next
+        tb = tb.tb_next
+    return ''.join(traceback.format_exception(type(err), err, start))
+
+def test_scheduler():
+    ''' Cells of different states interleave, same state keeps order '''
+    async def main():
+        events = []
+        scheduler = Scheduler(func=None, timeout=5)
+        scheduler.states['a'] = { 'events': events }
+        scheduler.states['b'] = { 'events': events }
+        first = scheduler.submit('import asyncio\nprint("a1")\nevents.append("a1")\nawait asyncio.sleep(0.05)\nevents.append("a2")\nx = 1', 'a')
+        second = scheduler.submit('x += 1\nprint("x is", x)', 'a')
+        other = scheduler.submit('import asyncio\nevents.append("b")\nprint("b")\nawait asyncio.sleep(0.01)', 'b')
+        slow = scheduler.submit('import asyncio\nprint("slow")\nawait asyncio.sleep(10)', 'c', timeout=0.05)
+        queued = scheduler.submit('print("never")', 'c')
+        broken = scheduler.submit('1 / 0', 'd')
+        stopped = scheduler.submit('import asyncio\nawait asyncio.sleep(10)', 'e', timeout=None)
+        assert(queued.cancel() and queued.status == 'cancelled')
+        await asyncio.sleep(0.02)
+        assert(stopped.status == 'running' and stopped.cancel())
+        await scheduler.join()
+        assert(events == ['a1', 'b', 'a2'])
+        assert(first.stdout == 'a1\n' and second.stdout == 'x is 2\n' and other.stdout == 'b\n')
+        assert(scheduler.states['a']['x'] == 2 and second.status == 'done')
+        assert(slow.status == 'timeout' and slow.stdout == 'slow\n' and 'x' not in scheduler.states['c'])
+        assert(broken.status == 'error' and isinstance(broken.exception, ZeroDivisionError))
+        assert(broken.stderr.startswith('Traceback') and 'scheduler.py' not in broken.stderr)
+        assert(stopped.status == 'cancelled' and (await stopped) is stopped)
+        assert(not isinstance(sys.stdout, _ContextStream))
+        handles = await scheduler.run([('y = 3', 'a'), ('print(y)', 'a')])
+        assert(handles[1].stdout == '3\n')
+    asyncio.run(main())
+
+if __name__ == '__main__':
+    test_scheduler()
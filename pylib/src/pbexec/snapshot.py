@@ -0,0 +1,333 @@
+"""
+
+Save states to disk and load them back.
+
+Checkpoint states normally live only in memory. save_state writes a state to a single
+file using pickle protocol 5 with out-of-band buffers: large buffers (NumPy arrays,
+array.array values, and bytes or bytearray values bound directly to a name) are written
+as raw contiguous segments next to the pickled data instead of being copied into the
+pickle stream. load_state maps the file into memory and hands those segments to pickle
+directly. NumPy arrays are restored as views of the mapping without reading or copying
+their data (pages are loaded lazily by the OS, writes go to private copy-on-write pages
+and never change the file), the builtin types are copied once straight from the mapping.
+
+The reducers installed by pbexec.register_pickle (modules, file objects) are used as
+usual. Functions defined by cells refer to the state as their globals, they are saved by
+value and reattached to the loaded state.
+
+File layout: magic, raw buffers (each aligned to ALIGN bytes), the pickle stream with one
+pickle per key, the pickled index, then the index offset and magic again.
+
+"""
+
+import array
+import hashlib
+import io
+import marshal
+import mmap
+import os
+import pickle
+import struct
+import time
+import types
+
+from .statecopy import INTERPRETER_KEYS
+
+MAGIC = b'PBSNAP\x00\x01'
+# Alignment of raw buffers in the file
+ALIGN = 64
+# bytes and array.array values at least this large are written out-of-band
+OUT_OF_BAND_MIN = 64 * 1024
+
+def _bytes_from_buffer(buffer):
+    return bytes(buffer)
+
+def _array_from_buffer(typecode, buffer):
+    result = array.array(typecode)
+    result.frombytes(buffer)
+    return result
+
+def _code_from_bytes(data):
+    return marshal.loads(data)
+
+def _make_cell(*contents):
+    return types.CellType(*contents)
+
+def _make_function(code, globals_, name, defaults, closure):
+    return types.FunctionType(code, globals_, name, defaults, closure)
+
+class _Raw:
+    ''' Marks a big bytes or bytearray value to be written out-of-band '''
+    def __init__(self, value):
+        self.value = value
+
+def _wrap(value):
+    # The C pickler writes bytes and bytearray itself without asking reducer_override,
+    # so big ones can only be sent out-of-band when they are the value of a key
+    if type(value) in (bytes, bytearray) and len(value) >= OUT_OF_BAND_MIN:
+        return _Raw(value)
+    return value
+
+class _StatePickler(pickle.Pickler):
+    '''
+    Pickler that writes big buffers out-of-band and saves cell functions by value.
+
+    '''
+    def __init__(self, file, state, buffer_callback):
+        super().__init__(file, protocol=5, buffer_callback=buffer_callback)
+        self.state = state
+
+    def persistent_id(self, obj):
+        if obj is self.state:
+            return 'state'
+        return None
+
+    def reducer_override(self, obj):
+        kind = type(obj)
+        if kind is _Raw:
+            if type(obj.value) is bytes:
+                return _bytes_from_buffer, (pickle.PickleBuffer(obj.value),)
+            return bytearray, (pickle.PickleBuffer(obj.value),)
+        if kind is array.array and len(obj) * obj.itemsize >= OUT_OF_BAND_MIN:
+            return _array_from_buffer, (obj.typecode, pickle.PickleBuffer(obj))
+        if kind is types.FunctionType and obj.__globals__ is self.state:
+            closure = None
+            if obj.__closure__ is not None:
+                closure = tuple(obj.__closure__)
+            attributes = {
+                '__qualname__': obj.__qualname__,
+                '__doc__': obj.__doc__,
+                '__kwdefaults__': obj.__kwdefaults__,
+                '__annotations__': obj.__annotations__,
+                '__module__': obj.__module__,
+            }
+            return _make_function, (obj.__code__, self.state, obj.__name__, obj.__defaults__, closure), (obj.__dict__ or None, attributes)
+        if kind is types.CodeType:
+            return _code_from_bytes, (marshal.dumps(obj),)
+        if kind is types.CellType:
+            try:
+                return _make_cell, (obj.cell_contents,)
+            except ValueError:
+                # Empty cell
+                return _make_cell, ()
+        return NotImplemented
+
+class _StateUnpickler(pickle.Unpickler):
+    def __init__(self, file, state, buffers):
+        super().__init__(file, buffers=buffers)
+        self.state = state
+
+    def persistent_load(self, pid):
+        if pid == 'state':
+            return self.state
+        raise pickle.UnpicklingError(f'Unknown persistent id {pid!r}')
+
+def _pad(f):
+    extra = (-f.tell()) % ALIGN
+    if extra:
+        f.write(b'\0' * extra)
+
+class _NullWriter:
+    def write(self, data):
+        pass
+
+def _discard(buffer):
+    pass
+
+def save_state(state, path, skip_errors=False, keys=None):
+    """
+    Write state to file at path, return report
+
+    Report is a dict with 'keys' mapping each key to its 'bytes', number of out-of-band
+    'buffers' and 'seconds', plus 'total_bytes', 'seconds' and 'skipped'.
+
+    All keys go through one pickler, so names referring to the same object still do
+    after loading.
+
+    Raises KeyError for the first key whose value cannot be pickled, unless skip_errors
+    is True in which case such keys are left out and listed in report['skipped']. With
+    skip_errors each value is first pickled to nowhere with a pickler of its own, a
+    failed dump would leave the shared memo out of step with the loader.
+
+    If keys is given, only those keys of state are saved.
+
+    """
+    start = time.perf_counter()
+    report = { 'keys': {}, 'skipped': [] }
+    entries = []
+    segments = []
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as f:
+        f.write(MAGIC)
+        def write_buffer(buffer):
+            # Raw buffers go straight to the file, returning None keeps them out-of-band
+            raw = buffer.raw()
+            _pad(f)
+            segments.append((f.tell(), raw.nbytes, raw.readonly))
+            f.write(raw)
+        stream = io.BytesIO()
+        pickler = _StatePickler(stream, state, write_buffer)
+        for key, value in dict.items(state):
+            if key in INTERPRETER_KEYS or (keys is not None and key not in keys):
+                continue
+            key_start = time.perf_counter()
+            stream_offset = stream.tell()
+            first_segment = len(segments)
+            if skip_errors:
+                try:
+                    _StatePickler(_NullWriter(), state, _discard).dump(_wrap(value))
+                except Exception:
+                    report['skipped'].append(key)
+                    continue
+            try:
+                pickler.dump(_wrap(value))
+            except Exception as err:
+                f.close()
+                os.unlink(tmppath)
+                raise KeyError(key) from err
+            entries.append((key, stream_offset, first_segment, len(segments) - first_segment))
+            report['keys'][key] = {
+                'bytes': stream.tell() - stream_offset + sum(segment[1] for segment in segments[first_segment:]),
+                'buffers': len(segments) - first_segment,
+                'seconds': time.perf_counter() - key_start,
+            }
+        stream_start = f.tell()
+        f.write(stream.getbuffer())
+        index_offset = f.tell()
+        pickle.dump((stream_start, segments, entries), f, protocol=5)
+        f.write(struct.pack('<Q', index_offset))
+        f.write(MAGIC)
+    os.replace(tmppath, path)
+    report['total_bytes'] = os.path.getsize(path)
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+def load_state(path, state=None, report=None):
+    """
+    Load state saved by save_state, return it
+
+    Values are loaded into state if given (e.g. a fresh CowState), otherwise into a new
+    dict. If report is a dict, it is filled in with per-key 'bytes' and 'seconds' and
+    the total 'seconds'.
+
+    """
+    start = time.perf_counter()
+    if state is None:
+        state = {}
+    with open(path, 'rb') as f:
+        # Private mapping, restored arrays are writable without touching the file
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mm)
+    footer = len(MAGIC) + 8
+    if len(view) < len(MAGIC) + footer or view[:len(MAGIC)] != MAGIC or view[-len(MAGIC):] != MAGIC:
+        raise ValueError(f'{path} is not a state snapshot')
+    index_offset, = struct.unpack('<Q', view[-footer:-len(MAGIC)])
+    stream_start, segments, entries = pickle.loads(view[index_offset:-footer])
+    buffers = []
+    for offset, length, readonly in segments:
+        buffer = view[offset:offset + length]
+        buffers.append(buffer.toreadonly() if readonly else buffer)
+    stream = io.BytesIO(view[stream_start:index_offset])
+    unpickler = _StateUnpickler(stream, state, buffers)
+    keys = {}
+    for key, stream_offset, first_segment, count in entries:
+        key_start = time.perf_counter()
+        stream.seek(stream_offset)
+        dict.__setitem__(state, key, unpickler.load())
+        keys[key] = {
+            'bytes': stream.tell() - stream_offset + sum(segment[1] for segment in segments[first_segment:first_segment + count]),
+            'seconds': time.perf_counter() - key_start,
+        }
+    if report is not None:
+        report['keys'] = keys
+        report['seconds'] = time.perf_counter() - start
+    return state
+
+class _HashWriter:
+    def __init__(self, h):
+        self.h = h
+    def write(self, data):
+        self.h.update(data)
+
+def fingerprint(state, keys):
+    """
+    Return sha256 hex digest of the values of keys in state
+
+    Values are hashed in their pickled form, big buffers are hashed without copying
+    them. Keys missing from state hash differently from any value. Raises KeyError for
+    the first key whose value cannot be pickled.
+
+    """
+    h = hashlib.sha256()
+    def hash_buffer(buffer):
+        h.update(buffer.raw())
+    writer = _HashWriter(h)
+    for key in sorted(keys):
+        h.update(repr(key).encode('utf-8'))
+        if key not in state:
+            h.update(b'\0missing')
+            continue
+        try:
+            # New pickler for each key so hash of a key does not depend on the others
+            _StatePickler(writer, state, hash_buffer).dump(_wrap(dict.__getitem__(state, key)))
+        except Exception as err:
+            raise KeyError(key) from err
+    return h.hexdigest()
+
+def test_snapshot():
+    ''' Round trip with out-of-band buffers and cell functions '''
+    import asyncio
+    import sys
+    import tempfile
+    from .pbexec import register_pickle, run_cell
+    register_pickle()
+    state = {}
+    asyncio.run(run_cell('''
+import array
+import sys
+samples = array.array('d', range(20000))
+big = bytes(range(256)) * 1024
+arr = bytearray(b'xyz') * 30000
+nums = [1, 2, [3]]
+alias = nums
+def scale(v, k=2):
+    return v * k * factor
+factor = 3
+def counter():
+    n = 0
+    def inc():
+        nonlocal n
+        n += 1
+        return n
+    return inc
+inc = counter()
+inc()
+''', state, func=None))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.snap')
+        report = save_state(state, path)
+        assert(report['keys']['big']['buffers'] == 1 and report['keys']['arr']['buffers'] == 1)
+        assert(report['keys']['samples']['buffers'] == 1)
+        load_report = {}
+        loaded = load_state(path, report=load_report)
+        assert(set(load_report['keys']) == set(report['keys']))
+        assert(loaded['big'] == state['big'] and loaded['arr'] == state['arr'] and loaded['sys'] is sys)
+        assert(loaded['samples'] == state['samples'])
+        assert(loaded['alias'] is loaded['nums'])
+        assert(loaded['scale'](2) == 12 and loaded['scale'].__globals__ is loaded)
+        loaded['factor'] = 10
+        assert(loaded['scale'](2) == 40 and state['scale'](2) == 12)
+        assert(loaded['inc']() == 2 and state['inc']() == 2)
+        loaded['arr'][0] = ord('a')
+        del loaded
+        assert(load_state(path)['arr'][0] == ord('x'))
+        # Skipped key in the middle, keys after it still load with the right values
+        inner = [5]
+        state = { 'a': ['first', inner], 'lock': __import__('threading').Lock(), 'b': [inner, inner, 'zzz'] }
+        report = save_state(state, path, skip_errors=True)
+        assert(report['skipped'] == ['lock'])
+        loaded = load_state(path)
+        assert(loaded['b'] == [[5], [5], 'zzz'] and loaded['b'][0] is loaded['a'][1] and 'lock' not in loaded)
+
+if __name__ == '__main__':
+    test_snapshot()
@@ -0,0 +1,89 @@
+"""
+
+In-memory registry of cell sources for tracebacks and debugging.
+
+Code objects compiled from cells need a filename whose lines can be looked up later by
+tracebacks, inspect.getsource and pdb. All of those go through linecache, so instead of
+writing each cell to a temporary file we put the source directly into linecache under a
+synthetic filename derived from a hash of the source. Running identical source again
+reuses the same entry.
+
+Entries are kept for the most recently registered cells, bounded by count and size.
+
+"""
+
+import collections
+import hashlib
+import linecache
+
+class SourceRegistry:
+    '''
+    Keep cell sources in linecache under stable synthetic filenames.
+
+    '''
+    def __init__(self, maxcount=1000, maxbytes=16 * 1024 * 1024):
+        self.maxcount = maxcount
+        self.maxbytes = maxbytes
+        # Map from filename to size of source, in order of last use
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def filename(self, script):
+        ''' Return synthetic filename for script (without registering it) '''
+        digest = hashlib.sha1(script.encode('utf-8', errors='surrogatepass')).hexdigest()
+        return f'<cell-{digest[:12]}>'
+
+    def register(self, script):
+        """
+        Make script source available to linecache, return its filename
+
+        """
+        filename = self.filename(script)
+        if filename in self._entries:
+            self._entries.move_to_end(filename)
+        else:
+            self._entries[filename] = len(script)
+            self._bytes += len(script)
+        # Always (re)install, linecache.clearcache() may have dropped it
+        lines = script.splitlines(keepends=True)
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        # An mtime of None tells linecache.checkcache not to look for the file on disk
+        linecache.cache[filename] = (len(script), None, lines, filename)
+        self._evict()
+        return filename
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        # Always keep the most recent entry, even if it is bigger than the limit
+        while len(self._entries) > 1 and (len(self._entries) > self.maxcount or self._bytes > self.maxbytes):
+            filename, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            linecache.cache.pop(filename, None)
+
+def test_source_registry():
+    ''' Sources are found by linecache, tracebacks and inspect '''
+    import inspect
+    import traceback
+    registry = SourceRegistry(maxcount=2)
+    script = 'def f():\n    return 1 / 0\n'
+    filename = registry.register(script)
+    assert(registry.register(script) == filename and len(registry) == 1)
+    namespace = {}
+    exec(compile(script, filename, 'exec'), namespace)
+    assert(inspect.getsource(namespace['f']) == script)
+    try:
+        namespace['f']()
+    except ZeroDivisionError:
+        assert('return 1 / 0' in traceback.format_exc())
+    registry.register('a = 1')
+    registry.register('b = 2')
+    assert(filename not in registry and filename not in linecache.cache)
+
+if __name__ == '__main__':
+    test_source_registry()
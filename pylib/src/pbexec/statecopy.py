@@ -0,0 +1,177 @@
+"""
+
+Deep copy entire states with a single memo.
+
+Copying each key of a state separately with copy.deepcopy throws away the memo between
+keys, so two names referring to the same list end up referring to two different lists in
+the copy. StateCopier keeps one memo for the whole state and picks a copy strategy per
+value:
+
+    * shared - immutable values (numbers, strings, tuples of immutables, modules,
+      cell histories, ...)
+    * buffer - bytearray and array.array, copied in bulk
+    * numpy - NumPy arrays with a plain dtype, copied with ndarray.copy
+    * deepcopy - copy.deepcopy with the shared memo
+
+Everything that is not shared or a flat buffer goes through deepcopy with the shared
+memo, so objects referred to from inside several values stay shared in the copy. A
+pickle round trip can be faster for big containers, but it copies outside the memo and
+splits such objects.
+
+"""
+
+import array
+import copy
+import sys
+import time
+import types
+
+from .history import History
+
+# Values of these types are never copied by copy.deepcopy, so states can always share them
+_ATOMIC_TYPES = (
+    type(None), type(Ellipsis), type(NotImplemented),
+    bool, int, float, complex, str, bytes, range,
+    type, types.ModuleType,
+    types.FunctionType, types.BuiltinFunctionType,
+    History,
+)
+
+# Keys managed by the interpreter itself, shared as-is between all states
+INTERPRETER_KEYS = ('__builtins__',)
+
+def is_shareable(value, depth=3):
+    """
+    Return True if value can be shared between states without ever copying it
+
+    Tuples and frozensets are shareable if everything inside them is shareable
+    (checked up to a small nesting depth to keep duplication cheap).
+
+    """
+    if isinstance(value, _ATOMIC_TYPES):
+        return True
+    if depth > 0 and type(value) in (tuple, frozenset):
+        return all(is_shareable(item, depth - 1) for item in value)
+    return False
+
+class StateCopier:
+    '''
+    Copy values of a state sharing one memo, remember strategy used for each key.
+
+    '''
+    def __init__(self):
+        self.memo = {}
+        # Map from key to dict with 'strategy' and 'seconds'
+        self.report = {}
+
+    def copy_state(self, state):
+        """
+        Return deep copy of state as a new dict
+
+        Raises KeyError with the key of the first value that cannot be copied.
+
+        """
+        res = {}
+        for key, value in state.items():
+            if key in INTERPRETER_KEYS:
+                res[key] = value
+                continue
+            try:
+                res[key] = self.copy_key(key, value)
+            except Exception as err:
+                raise KeyError(key) from err
+        return res
+
+    def copy_key(self, key, value):
+        ''' Copy value stored under key, record strategy in report '''
+        start = time.perf_counter()
+        result, strategy = self.copy_value(value)
+        self.report[key] = { 'strategy': strategy, 'seconds': time.perf_counter() - start }
+        return result
+
+    def copy_value(self, value):
+        """
+        Copy one value, return tuple of copy and name of strategy used
+
+        """
+        if is_shareable(value):
+            return value, 'shared'
+        found = self.memo.get(id(value))
+        if found is not None:
+            return found, 'memo'
+        result, strategy = self._copy_fresh(value)
+        self._remember(value, result)
+        return result, strategy
+
+    def _copy_fresh(self, value):
+        kind = type(value)
+        if kind is bytearray:
+            return bytearray(value), 'buffer'
+        if kind is array.array:
+            return copy.copy(value), 'buffer'
+        numpy = sys.modules.get('numpy')
+        if numpy is not None and kind is numpy.ndarray and not value.dtype.hasobject:
+            return value.copy(), 'numpy'
+        return copy.deepcopy(value, self.memo), 'deepcopy'
+
+    def _remember(self, value, result):
+        # Same memo layout as copy.deepcopy, keep originals alive so ids stay unique
+        if result is value:
+            return
+        self.memo[id(value)] = result
+        self.memo.setdefault(id(self.memo), []).append(value)
+
+def copy_state(state, report=None):
+    """
+    Deep copy whole state with one memo
+
+    If report is a dict, it is filled in with the strategy and time used for each key.
+
+    """
+    copier = StateCopier()
+    res = copier.copy_state(state)
+    if report is not None:
+        report.update(copier.report)
+    return res
+
+def test_copy_state():
+    ''' Aliasing between names survives copying, fast paths are used '''
+    shared = [1, 2, 3]
+    big = [[i] for i in range(100)]
+    state = {
+        'a': shared, 'b': shared, 'n': 5, 't': (1, 'x'), 'mod': sys,
+        'buf': bytearray(b'abc'), 'arr': array.array('d', [1.0, 2.0]),
+        'big': big, 'big2': big,
+    }
+    report = {}
+    res = copy_state(state, report)
+    assert(res['a'] is res['b'] and res['a'] is not shared and res['a'] == shared)
+    assert(res['big'] is res['big2'] and res['big'] == big and res['big'][0] is not big[0])
+    assert(res['t'] is state['t'] and res['mod'] is sys)
+    res['buf'][0] = ord('x')
+    assert(state['buf'] == bytearray(b'abc'))
+    assert(report['a']['strategy'] == 'deepcopy' and report['b']['strategy'] == 'memo')
+    assert(report['n']['strategy'] == 'shared' and report['mod']['strategy'] == 'shared')
+    assert(report['buf']['strategy'] == 'buffer' and report['arr']['strategy'] == 'buffer')
+    assert(report['big']['strategy'] == 'deepcopy')
+    # Objects inside several big values stay shared, however often states are copied
+    inner = [0]
+    state = { 'a': inner, 'big': [inner] + [float(i) for i in range(5000)] }
+    for i in range(2):
+        res = copy_state(state)
+        assert(res['big'][0] is res['a'] and res['a'] is not inner)
+    # Bound methods are copied together with the object they are bound to
+    class Box:
+        def __init__(self):
+            self.v = []
+        def add(self):
+            self.v.append(1)
+    box = Box()
+    state = { 'box': box, 'm': box.add }
+    assert(not is_shareable(box.add))
+    res = copy_state(state)
+    res['m']()
+    assert(box.v == [] and res['box'].v == [1] and res['m'].__self__ is res['box'])
+
+if __name__ == '__main__':
+    test_copy_state()
@@ -0,0 +1,305 @@
+"""
+
+Named states with a memory budget.
+
+The worker keeps every named state (the base state, checkpoints, the state of each page)
+until it is deleted explicitly. With many checkpoints of large data that runs the
+interpreter out of memory. A StateStore holds the named states instead. When the
+estimated size of the states in memory goes over the budget, the least recently used
+states are spilled to a directory with snapshot.save_state and dropped from memory.
+Getting a spilled state loads it back transparently.
+
+In Pyodide the spill directory lives in the Emscripten filesystem, whose file contents
+are kept outside of the WebAssembly heap, so spilling still frees room for Python.
+
+States whose values cannot be pickled are never spilled, they just stay in memory.
+
+With an ObjectStore (see objectstore), states are spilled into it instead of one file
+each. Spilled checkpoints holding the same big arrays or bytes then share one copy of
+them, in memory or on disk depending on the ObjectStore. States in memory are not
+deduplicated, without a budget nothing is spilled and nothing is shared.
+
+"""
+
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+from . import snapshot
+from .cowstate import CowState
+
+# Values owned by something other than the state, not counted in its size
+_NOT_OWNED = (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+def estimate_size(state):
+    """
+    Estimate number of bytes used by values reachable from state
+
+    Counts every object once with sys.getsizeof, following containers and instance
+    dictionaries. Modules, classes and functions are not counted.
+
+    """
+    seen = set()
+    stack = [value for key, value in dict.items(state) if key != '__builtins__']
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _NOT_OWNED):
+            continue
+        seen.add(id(obj))
+        try:
+            total += sys.getsizeof(obj)
+        except TypeError:
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+        else:
+            attributes = getattr(obj, '__dict__', None)
+            if isinstance(attributes, dict):
+                stack.append(attributes)
+    return total
+
+class _Entry:
+    '''
+    One named state, either in memory or spilled to a file.
+
+    '''
+    __slots__ = ('state', 'size', 'path', 'checkpoint', 'state_class', 'unspillable')
+    def __init__(self, state):
+        self.state = state
+        # Estimated size, None when it must be estimated again
+        self.size = None
+        self.path = None
+        # objectstore.Checkpoint when spilled to the object store
+        self.checkpoint = None
+        # CowState, LazyState or dict, to reload spilled state as the same kind
+        self.state_class = type(state) if isinstance(state, CowState) else dict
+        self.unspillable = False
+
+class StateStore:
+    '''
+    Dictionary of named states that spills least recently used ones to disk.
+
+    '''
+    def __init__(self, budget=None, directory=None, objects=None):
+        # Budget in bytes for states in memory, None for no limit
+        self.budget = budget
+        self.directory = directory
+        # ObjectStore to spill into, None for one snapshot file per state
+        self.objects = objects
+        self._entries = collections.OrderedDict()
+        self._counter = 0
+        self.hits = 0
+        self.spills = 0
+        self.reloads = 0
+        self.spill_failures = 0
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def names(self):
+        return list(self._entries)
+
+    def fresh(self, name, copy_on_write=False, template=None, lazy=False):
+        ''' Store new state under name and return it, empty or copied from template '''
+        from .pbexec import fresh_state
+        return self.set(name, fresh_state(copy_on_write, template, lazy))
+
+    def set(self, name, state):
+        ''' Store state under name and return it '''
+        self.delete(name)
+        self._entries[name] = _Entry(state)
+        self._enforce(name)
+        return state
+
+    def get(self, name):
+        """
+        Return state called name, loading it back if it was spilled
+
+        Looking up a state does not estimate its size again, call changed after running
+        a cell in it.
+
+        """
+        entry = self._entries[name]
+        self._entries.move_to_end(name)
+        if entry.state is None:
+            self._reload(entry)
+            self._enforce(name)
+        else:
+            self.hits += 1
+        return entry.state
+
+    def changed(self, name):
+        """
+        Note that state called name was modified (a cell ran in it)
+
+        Its size is estimated again and least recently used states are spilled if the
+        budget is exceeded.
+
+        """
+        entry = self._entries[name]
+        if entry.state is None:
+            return
+        entry.size = None
+        entry.unspillable = False
+        self._enforce(name)
+
+    def duplicate(self, old_name, new_name, lazy=False):
+        ''' Store duplicate of state old_name under new_name and return it '''
+        from .pbexec import duplicate_state
+        return self.set(new_name, duplicate_state(self.get(old_name), lazy=lazy))
+
+    def delete(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None and entry.path is not None:
+            self._remove_file(entry)
+        if entry is not None and entry.checkpoint is not None:
+            self.objects.release(entry.checkpoint)
+
+    def clear(self):
+        for name in list(self._entries):
+            self.delete(name)
+
+    def _spill_path(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='pbexec_states_')
+        os.makedirs(self.directory, exist_ok=True)
+        self._counter += 1
+        return os.path.join(self.directory, f'state{self._counter}.snap')
+
+    def _remove_file(self, entry):
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
+        entry.path = None
+
+    def _spill(self, entry):
+        try:
+            if self.objects is not None:
+                entry.checkpoint = self.objects.save_state(entry.state)
+            else:
+                path = self._spill_path()
+                snapshot.save_state(entry.state, path)
+                entry.path = path
+        except (OSError, KeyError):
+            self.spill_failures += 1
+            entry.unspillable = True
+            return False
+        entry.state = None
+        self.spills += 1
+        return True
+
+    def _reload(self, entry):
+        state = entry.state_class()
+        if entry.checkpoint is not None:
+            entry.state = self.objects.load_state(entry.checkpoint, state)
+            self.objects.release(entry.checkpoint)
+            entry.checkpoint = None
+        else:
+            entry.state = snapshot.load_state(entry.path, state)
+            self._remove_file(entry)
+        self.reloads += 1
+
+    def _memory_size(self):
+        total = 0
+        for entry in self._entries.values():
+            if entry.state is not None:
+                if entry.size is None:
+                    entry.size = estimate_size(entry.state)
+                total += entry.size
+        return total
+
+    def _enforce(self, keep):
+        # Spill least recently used states until the ones in memory fit the budget
+        if self.budget is None:
+            return
+        total = self._memory_size()
+        for name, entry in list(self._entries.items()):
+            if total <= self.budget:
+                break
+            if name == keep or entry.state is None or entry.unspillable:
+                continue
+            size = entry.size
+            if self._spill(entry):
+                total -= size
+
+    def stats(self):
+        ''' Return dictionary of counters and sizes '''
+        in_memory = [entry for entry in self._entries.values() if entry.state is not None]
+        spilled = [entry for entry in self._entries.values() if entry.state is None]
+        res = {
+            'states': len(self._entries),
+            'in_memory': len(in_memory),
+            'spilled': len(spilled),
+            'memory_bytes': self._memory_size(),
+            'disk_bytes': sum(os.path.getsize(entry.path) for entry in spilled if entry.path is not None),
+            'budget': self.budget,
+            'hits': self.hits,
+            'spills': self.spills,
+            'reloads': self.reloads,
+            'spill_failures': self.spill_failures,
+        }
+        if self.objects is not None:
+            res['objects'] = self.objects.stats()
+        return res
+
+def test_state_store():
+    ''' Old states spill to disk and come back on use '''
+    import threading
+    directory = tempfile.mkdtemp()
+    try:
+        store = StateStore(budget=150 * 1024, directory=directory)
+        store.set('a', { 'blob': b'a' * (100 * 1024), 'nums': [1, 2, 3] })
+        assert(estimate_size(store.get('a')) > 100 * 1024)
+        store.set('b', { 'blob': b'b' * (100 * 1024) })
+        assert(store.stats()['spills'] == 1 and store._entries['a'].state is None)
+        a = store.get('a')
+        assert(a['nums'] == [1, 2, 3] and a['blob'][:1] == b'a')
+        # Lookups use the size estimated when the state last changed
+        size = store._entries['a'].size
+        a['more'] = b'x' * 1024
+        store.get('a')
+        assert(store._entries['a'].size == size)
+        store.changed('a')
+        assert(store._entries['a'].size > size)
+        assert(store.stats()['reloads'] == 1 and store._entries['b'].state is None)
+        store.set('c', { 'lock': threading.Lock(), 'blob': b'c' * (100 * 1024) })
+        store.get('b')
+        # State with a lock cannot be spilled and stays in memory
+        stats = store.stats()
+        assert(stats['spill_failures'] == 1 and store._entries['c'].state is not None)
+        assert(stats['in_memory'] == 2 and stats['spilled'] == 1)
+        store.duplicate('b', 'd')
+        store.delete('a')
+        assert('a' not in store and set(store.names()) == {'b', 'c', 'd'})
+        store.clear()
+        assert(os.listdir(directory) == [])
+    finally:
+        shutil.rmtree(directory)
+
+def test_state_store_objects():
+    ''' Checkpoints spilled to an object store share their common values '''
+    from .objectstore import ObjectStore
+    table = bytes(range(256)) * 1024
+    store = StateStore(budget=400 * 1024, objects=ObjectStore())
+    for index in range(5):
+        store.set(f'checkpoint{index}', { 'table': bytes(table), 'index': [index] })
+    stats = store.stats()
+    assert(stats['spilled'] == 4 and stats['disk_bytes'] == 0)
+    assert(stats['objects']['blobs'] == 1 and stats['objects']['dedup_ratio'] == 4.0)
+    state = store.get('checkpoint0')
+    assert(state['table'] == table and state['index'] == [0])
+    for index in range(5):
+        store.delete(f'checkpoint{index}')
+    assert(store.stats()['objects']['blobs'] == 0)
+
+if __name__ == '__main__':
+    test_state_store()
+    test_state_store_objects()
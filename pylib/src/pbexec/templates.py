@@ -0,0 +1,324 @@
+"""
+
+Pre-warmed template states.
+
+Every page and grading session starts from a fresh state and runs the same setup again:
+importing numpy or hypothesis, defining helper classes and functions, loading data. A
+Template runs a setup script once into a template state. fresh_state(template=...) then
+hands out independent copies of it:
+
+    * modules, other classes and functions, and immutable values are shared with the
+      template,
+    * mutable data (lists, dicts, arrays, ...) is copied with one memo, like
+      duplicate_state, so each copy can change it freely,
+    * functions defined by the setup script are rebound to the copy, so they see the
+      globals of the copy and not those of the template.
+    * classes defined by the setup script (those with methods from it) are made again
+      for the copy with rebound methods and copied class attributes, instances in
+      copied data belong to the new class. Metaclass keywords are not passed again and
+      __init_subclass__ of their bases runs again.
+
+A template remembers the hash of the script it was built from. When the script given to
+define() changes, or the file it was read from changes, the template is built again the
+next time a copy is made.
+
+The setup script runs without an event loop. It may await things that finish without
+waiting (asyncio.sleep(0)), anything else raises RuntimeError.
+
+"""
+
+import hashlib
+import os
+import types
+
+from .cowstate import CowState
+from .statecopy import INTERPRETER_KEYS, StateCopier
+
+# Keys of the template that are not copied to fresh states
+_TEMPLATE_ONLY_KEYS = ('__history', '__expr_callback')
+# Templates kept by TemplateRegistry.for_script, least recently used go first
+MAX_SCRIPT_TEMPLATES = 8
+
+def _run_to_end(coro):
+    # Drive coroutine without an event loop
+    try:
+        while True:
+            if coro.send(None) is not None:
+                coro.close()
+                raise RuntimeError('Template setup script cannot wait for anything')
+    except StopIteration as stop:
+        return stop.value
+
+def _rebind(function, globals_, closure=None):
+    if closure is None:
+        closure = function.__closure__
+    res = types.FunctionType(function.__code__, globals_, function.__name__, function.__defaults__, closure)
+    res.__dict__.update(function.__dict__)
+    res.__kwdefaults__ = function.__kwdefaults__
+    res.__qualname__ = function.__qualname__
+    res.__doc__ = function.__doc__
+    res.__annotations__ = function.__annotations__
+    res.__module__ = function.__module__
+    return res
+
+def _rebind_closure(function, globals_, cells):
+    # Rebind method, giving it a new __class__ cell (zero argument super) if it has one
+    if '__class__' not in function.__code__.co_freevars:
+        return _rebind(function, globals_)
+    closure = list(function.__closure__)
+    index = function.__code__.co_freevars.index('__class__')
+    closure[index] = types.CellType()
+    cells.append(closure[index])
+    return _rebind(function, globals_, tuple(closure))
+
+def _class_functions(cls):
+    # Functions in namespace of cls, unwrapping static, class methods and properties
+    for value in vars(cls).values():
+        if isinstance(value, (staticmethod, classmethod)):
+            yield value.__func__
+        elif isinstance(value, property):
+            yield from (f for f in (value.fget, value.fset, value.fdel) if f is not None)
+        else:
+            yield value
+
+def _defined_in(cls, globals_):
+    return any(type(f) is types.FunctionType and f.__globals__ is globals_ for f in _class_functions(cls))
+
+def _rebind_class(cls, template, globals_, copier):
+    # Same class with methods seeing globals_ and its own copy of class attributes
+    cells = []
+    def rebind(value):
+        if type(value) is types.FunctionType and value.__globals__ is template:
+            return _rebind_closure(value, globals_, cells)
+        return value
+    namespace = { '__qualname__': cls.__qualname__ }
+    for name, value in vars(cls).items():
+        if name in ('__dict__', '__weakref__') or isinstance(value, (types.MemberDescriptorType, types.GetSetDescriptorType)):
+            continue
+        if isinstance(value, (staticmethod, classmethod)):
+            value = type(value)(rebind(value.__func__))
+        elif isinstance(value, property):
+            value = property(rebind(value.fget), rebind(value.fset), rebind(value.fdel), value.__doc__)
+        elif type(value) is types.FunctionType:
+            value = rebind(value)
+        else:
+            value = copier.copy_value(value)[0]
+        namespace[name] = value
+    bases = tuple(copier.memo.get(id(base), base) for base in cls.__bases__)
+    res = type(cls)(cls.__name__, bases, namespace)
+    for cell in cells:
+        cell.cell_contents = res
+    return res
+
+def _hash(script):
+    return hashlib.sha256(script.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+class Template:
+    '''
+    Setup script run once, copied into fresh states.
+
+    '''
+    def __init__(self, script=None, path=None):
+        if (script is None) == (path is None):
+            raise ValueError('Template needs exactly one of script or path')
+        self.script = script
+        self.path = path
+        self._file_stat = None
+        self._state = None
+        self._built_hash = None
+        self.builds = 0
+        self.copies = 0
+
+    def _source(self):
+        # Current setup script, reading file again only when it changed on disk
+        if self.path is not None:
+            stat = os.stat(self.path)
+            key = (stat.st_mtime_ns, stat.st_size)
+            if key != self._file_stat:
+                with open(self.path, encoding='utf-8') as f:
+                    self.script = f.read()
+                self._file_stat = key
+        return self.script
+
+    def set_script(self, script):
+        ''' Use new setup script, template is rebuilt on next use if it differs '''
+        self.script = script
+
+    def state(self):
+        """
+        Return template state, building it if not built yet or if the script changed
+
+        Exceptions raised by the setup script propagate.
+
+        """
+        script = self._source()
+        digest = _hash(script)
+        if self._state is None or digest != self._built_hash:
+            from .pbexec import run_cell
+            state = {}
+            _run_to_end(run_cell(script, state, func=None, history=False, print_exception=False, propagate_exception=True))
+            self._state = state
+            self._built_hash = digest
+            self.builds += 1
+        return self._state
+
+    def fresh(self, copy_on_write=False):
+        """
+        Return new state with the contents of the template state
+
+        Raises KeyError for the first value of the template that cannot be copied.
+
+        """
+        template = self.state()
+        res = CowState() if copy_on_write else {}
+        copier = StateCopier()
+        # Functions and classes of the setup script go to the copy, also where they are
+        # referenced from copied containers (memo is looked up before copying anything)
+        for key, value in dict.items(template):
+            if id(value) in copier.memo:
+                continue
+            if type(value) is types.FunctionType and value.__globals__ is template:
+                copier._remember(value, _rebind(value, res))
+            elif isinstance(value, type) and _defined_in(value, template):
+                try:
+                    copier._remember(value, _rebind_class(value, template, res, copier))
+                except Exception as err:
+                    raise KeyError(key) from err
+        for key, value in dict.items(template):
+            if key in _TEMPLATE_ONLY_KEYS:
+                continue
+            if key in INTERPRETER_KEYS:
+                dict.__setitem__(res, key, value)
+                continue
+            rebound = copier.memo.get(id(value)) if type(value) is types.FunctionType or isinstance(value, type) else None
+            if rebound is not None:
+                dict.__setitem__(res, key, rebound)
+                continue
+            try:
+                dict.__setitem__(res, key, copier.copy_key(key, value))
+            except Exception as err:
+                raise KeyError(key) from err
+        self.copies += 1
+        return res
+
+    def stats(self):
+        return { 'builds': self.builds, 'copies': self.copies, 'keys': 0 if self._state is None else len(self._state) }
+
+class TemplateRegistry:
+    '''
+    Named templates for fresh_state(template=name).
+
+    '''
+    def __init__(self):
+        self._templates = {}
+        # Names of templates made by for_script, in order of last use
+        self._scripts = []
+
+    def for_script(self, script):
+        """
+        Return template for setup script, named by the hash of the script
+
+        Pages with different setup scripts each keep their own built template, only the
+        MAX_SCRIPT_TEMPLATES used last are kept.
+
+        """
+        name = 'script-' + _hash(script)
+        if name in self._scripts:
+            self._scripts.remove(name)
+        self._scripts.append(name)
+        while len(self._scripts) > MAX_SCRIPT_TEMPLATES:
+            self.remove(self._scripts.pop(0))
+        return self.define(name, script)
+
+    def define(self, name, script=None, path=None):
+        """
+        Define or update template called name from setup script or file, return it
+
+        Defining a name again with the same script keeps the built template.
+
+        """
+        template = self._templates.get(name)
+        if template is not None and template.path == path:
+            if path is None:
+                template.set_script(script)
+            return template
+        template = Template(script, path)
+        self._templates[name] = template
+        return template
+
+    def get(self, name):
+        return self._templates[name]
+
+    def remove(self, name):
+        self._templates.pop(name, None)
+        if name in self._scripts:
+            self._scripts.remove(name)
+
+    def __contains__(self, name):
+        return name in self._templates
+
+    def resolve(self, template):
+        ''' Return Template for a Template or a defined name '''
+        if isinstance(template, Template):
+            return template
+        return self._templates[template]
+
+# Templates for fresh_state(template=name)
+templates = TemplateRegistry()
+
+def test_templates():
+    ''' Copies share modules, own their data, and see rebuilt setup '''
+    import json
+    import tempfile
+    from .pbexec import fresh_state, run_cell
+    # Registry fresh_state uses, also when this file runs as __main__
+    from .templates import templates
+    setup = 'import json\ncounter = [0]\nlimit = 3\ndef bump():\n    counter.append(limit)\n    return len(counter)\nhandlers = { "bump": bump }\n'
+    templates.define('test', setup)
+    first = fresh_state(template='test')
+    second = fresh_state(template='test', copy_on_write=True)
+    assert(first['json'] is json and first['counter'] is not second['counter'])
+    assert(first['bump']() == 2 and first['counter'] == [0, 3] and second['counter'] == [0])
+    assert(first['handlers']['bump'] is first['bump'] and first['bump'].__globals__ is first)
+    first['limit'] = 10
+    first['bump']()
+    assert(first['counter'][-1] == 10 and '__history' not in first)
+    _run_to_end(run_cell('total = bump()', second, func=None))
+    assert(second['total'] == 2 and templates.get('test').builds == 1)
+    # Same script keeps template, changed script rebuilds
+    templates.define('test', setup)
+    assert(fresh_state(template='test')['counter'] == [0] and templates.get('test').builds == 1)
+    templates.define('test', setup.replace('[0]', '[5]'))
+    assert(fresh_state(template='test')['counter'] == [5] and templates.get('test').builds == 2)
+    templates.remove('test')
+    # Switching between setup scripts keeps both built
+    for script in (setup, 'x = 1', setup, 'x = 1'):
+        fresh_state(template=templates.for_script(script))
+    assert(templates.for_script(setup).builds == 1 and templates.for_script('x = 1').builds == 1)
+    for script in (setup, 'x = 1'):
+        templates.remove('script-' + _hash(script))
+    # Classes of the setup script are made again for each copy
+    setup = 'class Base:\n    created = []\n    def __init__(self):\n        self.created.append(limit)\n' + \
+        'class Item(Base):\n    def __init__(self):\n        super().__init__()\n    @property\n    def limit(self):\n        return limit\n' + \
+        'limit = 1\nitems = [Item()]\n'
+    template = Template(setup)
+    first, second = template.fresh(), template.fresh()
+    first['limit'] = 5
+    item = first['Item']()
+    assert(item.limit == 5 and first['Base'].created == [1, 5] and second['Base'].created == [1])
+    assert(template.state()['Base'].created == [1] and first['Item'] is not second['Item'])
+    assert(type(first['items'][0]) is first['Item'] and issubclass(first['Item'], first['Base']))
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
+        f.write('x = [1]\n')
+    try:
+        template = Template(path=f.name)
+        assert(template.fresh()['x'] == [1])
+        with open(f.name, 'w') as out:
+            out.write('x = [1, 2]\n')
+        os.utime(f.name, ns=(0, 0))
+        assert(template.fresh()['x'] == [1, 2] and template.builds == 2)
+    finally:
+        os.unlink(f.name)
+
+if __name__ == '__main__':
+    test_templates()
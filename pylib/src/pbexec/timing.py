@@ -0,0 +1,221 @@
+"""
+
+Timing breakdown of cells.
+
+run_cell and wrapped_run_cell fill in a timing dict when one is passed to them. Times
+are in seconds:
+
+    * parse - parsing and rewriting the cell (0 when compiled code was cached)
+    * compile - compiling the rewritten AST
+    * imports - importing modules while the cell runs (packages loaded before the cell
+      by the worker are reported as packages if the worker measured them)
+    * output - waiting for output handlers (pybook.output_stdout, ...)
+    * input - waiting for input from the user
+    * execute - running user code, not counting imports, output and input
+    * total - all of run_cell
+    * statements - list with one dict per top level statement: 'index', 'line',
+      'end_line' and 'seconds' (including any imports and output in the statement).
+      A leading docstring and `from __future__` imports must stay first in the cell,
+      they are not timed.
+    * profile - with profile=True, list of dicts for the functions taking the most
+      cumulative time, see profile_stats
+
+"""
+
+import ast
+import builtins
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import time
+
+# Name of function called between top level statements of instrumented cells
+TIMER_NAME = '__statement_timer'
+
+# Number of functions kept in profile results
+PROFILE_LIMIT = 50
+
+def new_timing():
+    ''' Return timing dict with all phases at zero '''
+    return {
+        'parse': 0.0, 'compile': 0.0, 'imports': 0.0, 'output': 0.0, 'input': 0.0,
+        'execute': 0.0, 'total': 0.0, 'statements': [],
+    }
+
+def instrument(node):
+    """
+    Insert call to TIMER_NAME before each top level statement of module node and at end
+
+    The calls get the index and line numbers of the statement about to run, so timings
+    can be reported from cached code without the AST.
+
+    """
+    first = 0
+    if node.body and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Constant) and isinstance(node.body[0].value.value, str):
+        first = 1
+    while first < len(node.body) and isinstance(node.body[first], ast.ImportFrom) and node.body[first].module == '__future__':
+        first += 1
+    body = node.body[:first]
+    for index, statement in enumerate(node.body[first:], first):
+        body.append(_timer_call(statement, index, statement.lineno, statement.end_lineno))
+        body.append(statement)
+    body.append(_timer_call(node.body[-1] if node.body else None, len(node.body), None, None))
+    node.body = body
+    return node
+
+def _timer_call(statement, *args):
+    call = ast.Expr(ast.Call(ast.Name(TIMER_NAME, ast.Load()), args=[ast.Constant(arg) for arg in args], keywords=[]))
+    if statement is not None:
+        ast.copy_location(call, statement)
+    return ast.fix_missing_locations(call)
+
+class StatementTimer:
+    '''
+    Records time at each statement boundary of an instrumented cell.
+
+    '''
+    def __init__(self):
+        self.marks = []
+    def __call__(self, index, line, end_line):
+        self.marks.append((index, line, end_line, time.perf_counter()))
+    def table(self, end):
+        """
+        Return list of statement timings
+
+        Time for a statement runs from its mark to the next mark, or to end if it raised.
+
+        """
+        rows = []
+        for position, (index, line, end_line, start) in enumerate(self.marks):
+            if line is None:
+                break
+            stop = self.marks[position + 1][3] if position + 1 < len(self.marks) else end
+            rows.append({ 'index': index, 'line': line, 'end_line': end_line, 'seconds': stop - start })
+        return rows
+
+def timed(handler, timing, phase):
+    """
+    Return handler that adds the time spent in it to timing[phase]
+
+    """
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return handler(*args)
+        finally:
+            timing[phase] = timing.get(phase, 0.0) + time.perf_counter() - start
+    return wrapper
+
+# [timing, depth] of the cell timing imports in the current context (asyncio task)
+_import_timing = contextvars.ContextVar('import_timing', default=None)
+# Number of active time_imports and __import__ they replaced
+_import_users = 0
+_original_import = None
+
+def _timed_import(*args, **kwargs):
+    current = _import_timing.get()
+    if current is None or current[1] > 0:
+        return _original_import(*args, **kwargs)
+    current[1] += 1
+    start = time.perf_counter()
+    try:
+        return _original_import(*args, **kwargs)
+    finally:
+        current[1] -= 1
+        timing = current[0]
+        timing['imports'] = timing.get('imports', 0.0) + time.perf_counter() - start
+
+@contextlib.contextmanager
+def time_imports(timing):
+    """
+    Context manager adding time spent importing modules to timing['imports']
+
+    Nested imports are only counted once. builtins.__import__ is replaced while any
+    cell is timed, imports are charged to the timing of the context (asyncio task or
+    thread) doing them, so cells running concurrently (see scheduler) each get their own.
+
+    """
+    global _import_users, _original_import
+    token = _import_timing.set([timing, 0])
+    if _import_users == 0:
+        _original_import = builtins.__import__
+        builtins.__import__ = _timed_import
+    _import_users += 1
+    try:
+        yield
+    finally:
+        _import_users -= 1
+        if _import_users == 0:
+            builtins.__import__ = _original_import
+        _import_timing.reset(token)
+
+def profile_stats(profiler, limit=PROFILE_LIMIT):
+    """
+    Return list of dicts describing functions in profiler with most cumulative time
+
+    Each dict has 'function', 'file', 'line', 'calls', 'primitive_calls',
+    'total_seconds' (in the function itself) and 'cumulative_seconds'.
+
+    """
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, function), (primitive_calls, calls, total, cumulative, callers) in stats.stats.items():
+        rows.append({
+            'function': function,
+            'file': filename,
+            'line': line,
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'total_seconds': total,
+            'cumulative_seconds': cumulative,
+        })
+    rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+    return rows[:limit]
+
+def new_profiler():
+    return cProfile.Profile()
+
+def test_timing():
+    ''' Statement table and profile of a small cell '''
+    import asyncio
+    from .pbexec import run_cell
+    timing = {}
+    state = {}
+    script = 'import json\nx = sum(range(100000))\n\ndef f(n):\n    return n * 2\n[f(i) for i in range(1000)]\n'
+    asyncio.run(run_cell(script, state, func=None, timing=timing, profile=True))
+    assert([row['line'] for row in timing['statements']] == [1, 2, 4, 6])
+    assert(timing['statements'][3]['end_line'] == 6 and all(row['seconds'] >= 0 for row in timing['statements']))
+    assert(timing['total'] >= timing['execute'] > 0 and timing['parse'] > 0)
+    assert(any(row['function'] == 'f' and row['calls'] == 1000 for row in timing['profile']))
+    assert('__statement_timer' not in state)
+    # Second run uses cached code, statement table still there
+    timing = {}
+    asyncio.run(run_cell(script, state, func=None, timing=timing))
+    assert(timing['parse'] == 0 and len(timing['statements']) == 4 and 'profile' not in timing)
+    # Exception in second statement
+    timing = {}
+    asyncio.run(run_cell('x = 1\n1 / 0\ny = 2\n', state, func=None, timing=timing, print_exception=False))
+    assert([row['line'] for row in timing['statements']] == [1, 2])
+    # Docstring and future imports stay first
+    timing = {}
+    asyncio.run(run_cell('"Doc"\nfrom __future__ import annotations\ndef g(v: Undefined):\n    pass\n', state, func=None, timing=timing, propagate_exception=True))
+    assert([row['line'] for row in timing['statements']] == [3] and state['g'].__annotations__ == { 'v': 'Undefined' })
+    # Imports are charged to the task doing them, not to other cells timed meanwhile
+    import builtins
+    import sys
+    async def waiting(timing):
+        with time_imports(timing):
+            await asyncio.sleep(0.01)
+    async def both():
+        quiet = {}
+        task = asyncio.create_task(waiting(quiet))
+        await asyncio.sleep(0)
+        sys.modules.pop('colorsys', None)
+        __import__('colorsys')
+        await task
+        return quiet
+    assert('imports' not in asyncio.run(both()) and builtins.__import__ is not _timed_import)
+
+if __name__ == '__main__':
+    test_timing()
@@ -9,8 +9,15 @@ on a Python data structure representing the notebook cell outputs.
 
 import copy
 
-# This global variable represents the state of the cell
-outputs = []
+try:
+    from pbexec.outputs import OutputAccumulator
+except ImportError:
+    # pbexec not on the path, keep all output in a plain list
+    OutputAccumulator = None
+
+# This global variable represents the state of the cell, it reads like a list of
+# output dicts but keeps a bounded amount of text (see pbexec.outputs)
+outputs = [] if OutputAccumulator is None else OutputAccumulator()
 
 def fresh_state():
     return {}
@@ -28,10 +35,10 @@ def sleep(sec):
     pass
 
 def output_stdout(msg):
-    _add_output({ 'name': 'stdout', 'text/plain': msg })
+    return _add_output({ 'name': 'stdout', 'text/plain': msg })
 
 def output_stderr(msg):
-    _add_output({ 'name': 'stderr', 'text/plain': msg })
+    return _add_output({ 'name': 'stderr', 'text/plain': msg })
 
 def output_text_content(content_type, content_data):
     if content_type == 'text/html':
@@ -47,7 +54,9 @@ def input_stdin():
 ## Following are specific to testing environment
 
 def _add_output(data):
-    ''' Append text if data is same channel as last message in outputs, otherwise append new text '''
+    ''' Add output, text on same channel as last message is merged with it. Return False once output stopped '''
+    if OutputAccumulator is not None:
+        return outputs.add(data)
     if len(outputs) > 0 and 'name' in outputs[-1] and 'name' in data and 'text/plain' in outputs[-1] and 'text/plain' in data and outputs[-1]['name'] == data['name']:
         outputs[-1]['text/plain'] += data['text/plain']
         return
@@ -58,9 +67,8 @@ def reset_outputs():
 
 def get_outputs():
     ''' Return current outputs and clear them '''
-    global outputs
-    result = outputs[:]
-    outputs = []
+    result = outputs[:] if OutputAccumulator is None else outputs.outputs()
+    outputs.clear()
     return result
 
 async def _exec(txt, state=None, user=''):
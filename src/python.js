@@ -7,9 +7,9 @@
 //! here allows creating multiple states, duplicating states, and evaluating Python
 //! code from a state. Note that evaluation is stateful, that is, it may modify the
 //! state given. Creating fresh states should always be possible. Duplicating states
-//! should normally be possible, but because a deep copy must be done there is the
-//! possibility of types existing in the source state that cannot be effectively duplicated.
-//! If this happens the state duplication may fail.
+//! always succeeds: values are copied when a cell first uses them, and a value that
+//! cannot be copied (an open file, a lock) only makes cells using that name fail in the
+//! duplicate (see pbexec lazystate).
 //!
 //! Create new kernel with newPythonKernel (see documentation of API there)
 //!
@@ -21,7 +21,7 @@ import { signalMap, setStarting, clearInterrupt,
        } from './signal.js';
 
 // Spawn the web worker thread and configure it
-function newPythonWorker() {
+function newPythonWorker(stateBudget) {
     const config = {
         absurl: document.location.origin,
         sharedArray: sharedArray,
@@ -30,6 +30,7 @@ function newPythonWorker() {
         sharedFileSizeArray: sharedFileSizeArray,
         signalMap: signalMap,
         INPUT_BUFFER_SIZE: INPUT_BUFFER_SIZE,
+        stateBudget: stateBudget,
     };
 
     let worker = new Worker(new URL('./worker.mjs', import.meta.url), { type: 'module' });
@@ -105,16 +106,25 @@ function findHandler(name, callback, opts, defaultHandler) {
 //!     - onStdout(msg) - Method to call for one line of stdout
 //!     - onStderr(msg) - Method to call for one line of stderr
 //!     - onOutput(content_type, data) - Method to call for rich MIME-type output
-//!     - onResponse() - Method to call once request is finished (e.g. when state is duplicated, or evaluation is finished)
+//!     - onResponse(data) - Method to call once request is finished (e.g. when state is duplicated, or evaluation is finished),
+//!       data is only set for requests that return something (statestats, evaluate with timing or coverage)
+//!     - stateBudget - Bytes of memory for states, least recently used states are spilled to disk beyond this
+//!       (default 256 MiB, null for no limit). Only spilled states share big buffers they have in common.
 //!
 //! Returned object has the following methods. All methods have callback argument, is a dictionary of optional
 //! handlers as in opts above. Typical use is to override at least onResponse for asynchronous response.
 //!
 //! Methods:
-//! - evaluate(expr, name, callback) - Evaluate expr in state name.
-//! - freshstate(name, callback) - Make name into a fresh blank Python state. Overrides any existing value there.
+//! - evaluate(expr, name, options, callback) - Evaluate expr in state name. With options.timing the time
+//!   spent in each phase (packages, parse, compile, imports, execute, output, input) and per statement is
+//!   passed to onResponse, with options.profile also the functions taking the most time (cProfile).
+//!   With options.coverage the lines and branches of expr that ran are passed in the coverage entry (for grading).
+//! - freshstate(name, callback, setup) - Make name into a fresh Python state. Overrides any existing value there.
+//!   Blank unless setup (Python source) is given, then the state starts as a copy of what setup made. Setup runs
+//!   once and again only when it changes, modules it imports are shared between states.
 //! - duplicatestate(oldName, newName, callback) - Duplicate state from oldName to newName.
 //! - deletestate(name, callback) - Delete state name, free any used memory.
+//! - statestats(callback) - Get statistics of states in memory and spilled to disk (passed to onResponse).
 //! - terminate() - Terminate web worker thread, restart and reconfigure. This is heavier than a normal interrupt of an evaluation.
 //!
 
@@ -165,7 +175,7 @@ export function newPythonKernel(opts) {
 
     var callbacks = [];
     function startup() {
-        var worker = newPythonWorker();
+        var worker = newPythonWorker(opts.stateBudget);
         worker.on('message', function(msg) {
             const defaultHandler = function() { console.log('default handler'); };
             const callback = callbacks;
@@ -187,7 +197,7 @@ export function newPythonKernel(opts) {
                 findHandler('onUpload', callback, opts, defaultHandler)(msg.filename);
                 //setIOComplete();
             } else if (msg.type === 'response') {
-                findHandler('onResponse', callback, opts, defaultHandler)();
+                findHandler('onResponse', callback, opts, defaultHandler)(msg.data);
             } else {
                 throw 'Unknown message type in main thread onmessage';
             }
@@ -206,9 +216,9 @@ export function newPythonKernel(opts) {
             callbacks = callback;
             worker.postMessage({ type:'setglobal', name:name, identifier:identifier, value:value });
         },
-        freshstate: function(name, callback) {
+        freshstate: function(name, callback, setup) {
             callbacks = callback;
-            worker.postMessage({ type:'freshstate', name:name });
+            worker.postMessage({ type:'freshstate', name:name, setup:setup });
         },
         duplicatestate: function(oldName, newName, callback) {
             callbacks = callback;
@@ -218,6 +228,10 @@ export function newPythonKernel(opts) {
             callbacks = callback;
             worker.postMessage({ type:'deletestate', name:name });
         },
+        statestats: function(callback) {
+            callbacks = callback;
+            worker.postMessage({ type:'statestats' });
+        },
         terminate: function() {
             worker.terminate();
             clearInterrupt();
@@ -13,9 +13,13 @@ let sharedFileSizeArray = null;
 let INPUT_BUFFER_SIZE = null;
 let loaded = null;
 let states = null;
+let stateBudget = null;
 
 // Interval to synchronize local filesystem changes to IndexDB
 const PERSISTENT_INTERVAL_MS = 5000;
+// Bytes of memory for states when not configured, checkpoints beyond it are spilled
+// (and deduplicated in the object store)
+const DEFAULT_STATE_BUDGET = 256 * 1024 * 1024;
 
 async function configure(config) {
     // This code runs after we get the configuration data
@@ -26,6 +30,8 @@ async function configure(config) {
     sharedFileArray = config.sharedFileArray;
     sharedFileSizeArray = config.sharedFileSizeArray;
     INPUT_BUFFER_SIZE = config.INPUT_BUFFER_SIZE;
+    // Bytes of memory for states before old ones are spilled to disk (null for no limit)
+    stateBudget = config.stateBudget === undefined ? DEFAULT_STATE_BUDGET : config.stateBudget;
 
     function inputGet() {
         // Signal that we are waiting for input
@@ -60,6 +66,30 @@ async function configure(config) {
         return value;
     }
 
+    function inputGetChunk(maxBytes) {
+        // Like inputGet, but return all bytes available before the next 0 as one Uint8Array
+        // A 0 at the start of the buffer still returns null (flush / EOF marker)
+        const first = inputGet();
+        if (first === null) {
+            return null;
+        }
+        let values = [first];
+        var p = Atomics.load(sharedArray, signalMap['input_start']);
+        var e = Atomics.load(sharedArray, signalMap['input_end']);
+        while (p !== e && values.length < maxBytes) {
+            const value = Atomics.load(sharedInputArray, p);
+            if (value === 0) {
+                // Leave the 0 so next call returns null
+                break;
+            }
+            values.push(value);
+            p = (p + 1) % INPUT_BUFFER_SIZE;
+        }
+        Atomics.store(sharedArray, signalMap['input_start'], p);
+        Atomics.notify(sharedArray, signalMap['input_start']);
+        return new Uint8Array(values);
+    }
+
     loaded = false;
     let pyodide = await loadPyodide({indexURL : absurl + '/lib/pyodide'});
     let version = '🐍 Python ' + pyodide.runPython('import sys; sys.version') + '\n🤖 Pyodide ' + pyodide.version;
@@ -113,6 +143,9 @@ async function configure(config) {
         input_stdin: function() {
             return inputGet();
         },
+        input_stdin_chunk: function(maxBytes) {
+            return inputGetChunk(maxBytes);
+        },
         download_file: function(filename) {
             pyodide.checkInterrupt();
             const content_data = pyodide.FS.readFile(filename);
@@ -158,10 +191,21 @@ async function configure(config) {
     await pyodide.runPythonAsync('await micropip.install("' + absurl + '/lib/pyodide/pbexec_nwhitehead-0.0.1-py3-none-any.whl' + '")');
     pyodide.runPython('from pbexec import pbexec');
     pyodide.runPython('import sys; sys.setrecursionlimit(250)');
-    // Start with fresh state as base
-    states = {
-        base:pyodide.globals.get('pbexec').fresh_state()
-    };
+    // Start with fresh state as base, states live in a Python StateStore that spills old ones to disk
+    // Spilled checkpoints go to a content-addressed object store, big buffers they have in common are kept once
+    // Checkpoints still in memory are not deduplicated, only spilling shares their buffers
+    const objects = pyodide.globals.get('pbexec').ObjectStore('/tmp/pbexec_states/objects');
+    states = pyodide.globals.get('pbexec').StateStore(stateBudget, '/tmp/pbexec_states', objects);
+    objects.destroy();
+    // States are lazy: duplicates share values until a cell uses them, values that cannot be
+    // copied become tombstones raising only where used instead of failing the duplicate
+    states.fresh.callKwargs('base', { lazy: true });
+    // Packages imported by cells are installed with micropip (PyPI and pyodide native packages)
+    // Pyodide knows import names of its packages (e.g. 'import bs4' is package 'beautifulsoup4')
+    pyodide.runPython('from pbexec import imports; import pybook; imports.resolver.installer = imports.MicropipInstaller(); imports.resolver.notify = pybook.output_stdout');
+    const distributions = pyodide.toPy(Object.fromEntries(pyodide._api._import_name_to_package_name));
+    pyodide.globals.get('pbexec').import_resolver.add_distributions(distributions);
+    distributions.destroy();
     // Clear starting flag
     Atomics.store(sharedArray, signalMap['starting'], 0);
     // Clear busy flag
@@ -173,25 +217,35 @@ async function configure(config) {
         if (name === undefined || name === null) {
             name = 'base';
         }
-        return states[name];
+        return states.get(name);
     }
 
-    // Synchronous generation of blank fresh state
-    // Returns index into states variable (actual state cannot be communicated across message channel)
-    function freshState(name) {
-        states[name] = pyodide.globals.get('pbexec').fresh_state();
+    // Generation of fresh state, blank or copied from template made by setup script
+    // One template per distinct setup script, each built once (see pbexec templates)
+    async function freshState(name, setup) {
+        if (setup === undefined || setup === null) {
+            states.fresh.callKwargs(name, { lazy: true });
+            return;
+        }
+        await pyodide.loadPackagesFromImports(setup);
+        const template = pyodide.globals.get('pbexec').templates.for_script(setup);
+        states.fresh.callKwargs(name, { template: template, lazy: true });
+        template.destroy();
     }
 
     // Duplicate a state
     function duplicateState(oldName, newName) {
-        let oldState = states[oldName];
-        let newState = pyodide.globals.get('pbexec').duplicate_state(oldState);
-        states[newName] = newState;
+        states.duplicate.callKwargs(oldName, newName, { lazy: true });
     }
 
     // Delete a state
     function deleteState(name) {
-        delete states[name];
+        states.delete(name);
+    }
+
+    // Statistics of state store (hits, spills, reloads, sizes)
+    function stateStats() {
+        return states.stats().toJs({ dict_converter: Object.fromEntries });
     }
 
     // Version of pyodide.runPythonAsync that goes through exec.wrapped_run_cell
@@ -199,35 +253,15 @@ async function configure(config) {
         Atomics.store(sharedArray, signalMap['busy'], 1);
         const exec_module = pyodide.globals.get('pbexec');
         let theState = getState(state);
+        const packagesStart = performance.now();
         if (options.usePyPI) {
-            const imports = pyodide.pyodide_py.code.find_imports(code).toJs();
-            let packages = []; // what cannot be imported, to install with micropip
-            // micropip covers pyodide native packages and PyPI
-            for (let i = 0; i < imports.length; i++) {
-                const elem = imports[i];
-                try {
-                    pyodide.pyimport(elem);
-                } catch(err) {
-                    // If 'import ...' did not work, schedule the package to be loaded with micropip
-                    packages.push(elem);
-                }
-            }
-            // Use handy function pyodide provides to map import name to package name (e.g. 'import bs4' becomes package 'beautifulsoup4')
-            let import_name_to_package_name = pyodide._api._import_name_to_package_name;
-            // Custom additions to pyodide import_name map
-            import_name_to_package_name.set('png', 'pypng');
-            for (let i = 0; i < packages.length; i++) {
-                const name = packages[i];
-                let packagename = import_name_to_package_name.get(name) ? import_name_to_package_name.get(name) : name;
-                try {
-                    pybook.output_stdout('Installing ' + packagename + '\n');
-                    await pyodide.runPythonAsync('await micropip.install("' + packagename + '")');
-                } catch(err) {
-                    // Catch the Python exception here and ignore besides a log message
-                    // When evaluating the user source, the import will fail giving correct exception at correct location to user
-                    console.log(`Error loading package ${packagename}`);
-                }
+            // Resolver remembers what is importable, installs what is missing all at once
+            // Names that still cannot be imported fail with correct exception when cell runs
+            const report = await exec_module.import_resolver.prepare(code);
+            for (const name of report.get('failed')) {
+                console.log(`Error loading package ${name}`);
             }
+            report.destroy();
         } else {
             // Don't use PyPI, just load any local Pyodide packages
             await pyodide.loadPackagesFromImports(code);
@@ -235,27 +269,57 @@ async function configure(config) {
         const eval_func = exec_module.wrapped_run_cell;
         const default_func = options.no_default_func ? null :
             (options.showArrows ? exec_module.default_func : exec_module.show_value_noarrow);
-        await eval_func(code, /*globals_=*/theState, /*locals_=*/null, /*func=*/default_func, /*history=*/true, /*write=*/true, /*print_exception=*/true, /*propagate_exception=*/false, /*strip=*/1);
+        // Writes are coalesced and sent in batches instead of one message per write
+        const kwargs = { output_buffer: true };
+        let timing = null;
+        let coverage = null;
+        if (options.timing || options.profile) {
+            // Breakdown of time spent, see pbexec timing module
+            timing = pyodide.toPy({ packages: (performance.now() - packagesStart) / 1000 });
+            kwargs.timing = timing;
+            kwargs.profile = !!options.profile;
+        }
+        if (options.coverage) {
+            // Lines and branches that ran, see pbexec linecoverage module
+            coverage = pyodide.toPy({});
+            kwargs.coverage = coverage;
+        }
+        await eval_func.callKwargs(code, theState, null, default_func, kwargs);
+        let result = undefined;
+        if (timing || coverage) {
+            result = timing ? timing.toJs({ dict_converter: Object.fromEntries }) : {};
+        }
+        if (coverage) {
+            result.coverage = coverage.toJs({ dict_converter: Object.fromEntries });
+            coverage.destroy();
+        }
+        if (timing) {
+            timing.destroy();
+        }
+        // Size of the state is only estimated again now that a cell changed it
+        states.changed(state === undefined || state === null ? 'base' : state);
         Atomics.store(sharedArray, signalMap['busy'], 0);
+        return result;
     };
 
     // Set an indentifier in a given state to a value
     function setGlobal(name, identifier, value) {
         let theState = getState(name);
         theState.set(identifier, value);
+        states.changed(name === undefined || name === null ? 'base' : name);
     }
 
     // Switch our message response to update from waiting for config to responding to inputs
     onmessage = async function(e) {
         let input = e.data;
-        if (input.type === 'execute' || input.type === 'setglobal' || input.type === 'freshstate' || input.type === 'duplicatestate' || input.type === 'deletestate') {
+        if (input.type === 'execute' || input.type === 'setglobal' || input.type === 'freshstate' || input.type === 'duplicatestate' || input.type === 'deletestate' || input.type === 'statestats') {
             if (!loaded) {
                 postMessage({ type:'notready' });
             } else {
                 if (input.type === 'execute') {
                     // Now run the code (only send response once code finishes)
-                    await runCellAsync(input.expr, input.name, input.options);
-                    postMessage({ type: 'response' });
+                    const timing = await runCellAsync(input.expr, input.name, input.options);
+                    postMessage({ type: 'response', data: timing });
                 }
                 if (input.type === 'setglobal') {
                     // Set a global variable
@@ -263,7 +327,7 @@ async function configure(config) {
                     postMessage({ type: 'response' });
                 }
                 if (input.type === 'freshstate') {
-                    freshState(input.name);
+                    await freshState(input.name, input.setup);
                     postMessage({ type: 'response' });
                 }
                 if (input.type === 'duplicatestate') {
@@ -274,6 +338,9 @@ async function configure(config) {
                     deleteState(input.name);
                     postMessage({ type: 'response' });
                 }
+                if (input.type === 'statestats') {
+                    postMessage({ type: 'response', data: stateStats() });
+                }
             }
         } else {
             throw 'Unknown message type in webworker onmessage';